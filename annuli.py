@@ -62,6 +62,7 @@ import tempfile
 
 # LEMON modules
 import customparser
+import database
 import diffphot
 import fitsimage
 import keywords
@@ -106,6 +107,7 @@ qphot_group = optparse.OptionGroup(parser, "Initial Photometry",
 qphot_group.add_option(photometry.parser.get_option('--aperture'))
 qphot_group.add_option(photometry.parser.get_option('--annulus'))
 qphot_group.add_option(photometry.parser.get_option('--dannulus'))
+qphot_group.add_option(photometry.parser.get_option('--engine'))
 
 qphot_group.add_option('--min-sky', action = 'store',
                        type = 'float', dest = 'min',
@@ -310,6 +312,18 @@ def main(arguments = None):
             print style.error_exit_message
             return 1
 
+    # The candidate apertures are all measured in the same execution of the
+    # photometry module (see --extra-aperture-pix), which requires them to be
+    # smaller than or equal to the inner radius of the sky annulus. As both
+    # are in number of times the median FWHM, this can be checked up front.
+    if options.upper > options.sky:
+        msg = ("%sError. The upper bound of the candidate apertures (--upper "
+               "= %.2f) must be smaller\n%sthan or equal to the inner radius "
+               "of the sky annulus (--sky = %.2f).")
+        print msg % (style.prefix, options.upper, style.prefix, options.sky)
+        print style.error_exit_message
+        return 1
+
     msg = "%sExamining the headers of the %s FITS files given as input..."
     print msg % (style.prefix, len(input_paths))
 
@@ -350,6 +364,7 @@ def main(arguments = None):
                  [phot_db_path, '--overwrite']
 
     phot_args = ['--maximum', options.maximum,
+                 '--engine', options.engine,
                  '--margin', options.margin,
                  '--cores', options.ncores,
                  '--min-sky', options.min,
@@ -546,31 +561,54 @@ def main(arguments = None):
                 filter_apertures[0], filter_apertures[-1])
         print msg % args
 
-        # For each candidate aperture, and only with the images taken in
-        # this filter, do photometry on the constant stars and compute the
-        # median of the standard deviation of their light curves as a means
-        # of evaluating the suitability of this combination of parameters.
-        for index, aperture in enumerate(filter_apertures):
+        # Do photometry on the constant stars, and only with the images taken
+        # in this filter, for all the candidate apertures at once: the pixels
+        # of each image are read, and the centers of the stars and their sky
+        # levels computed, only once, and the measurements for each aperture
+        # stored in the same LEMONdB (see --extra-aperture-pix).
 
-            print style.prefix
+        print style.prefix
 
-            kwargs = dict(prefix = 'photometry_', suffix = '.LEMONdB')
-            fd, aper_phot_db_path = tempfile.mkstemp(**kwargs)
-            atexit.register(methods.clean_tmp_files, aper_phot_db_path)
-            os.close(fd)
+        kwargs = dict(prefix = 'photometry_', suffix = '.LEMONdB')
+        fd, aper_phot_db_path = tempfile.mkstemp(**kwargs)
+        atexit.register(methods.clean_tmp_files, aper_phot_db_path)
+        os.close(fd)
+
+        paths = [img.path for img in files[pfilter]]
+        basic_args = [sources_img_path] + paths + \
+                     [aper_phot_db_path, '--overwrite']
 
-            paths = [img.path for img in files[pfilter]]
-            basic_args = [sources_img_path] + paths + \
-                         [aper_phot_db_path, '--overwrite']
+        extra_args = ['--filter', str(pfilter),
+                      '--coordinates', coords_path,
+                      '--aperture-pix', filter_apertures[0],
+                      '--annulus-pix', annulus,
+                      '--dannulus-pix', dannulus]
 
-            extra_args = ['--filter', str(pfilter),
-                          '--coordinates', coords_path,
-                          '--aperture-pix', aperture,
-                          '--annulus-pix', annulus,
-                          '--dannulus-pix', dannulus]
+        for aperture in filter_apertures:
+            extra_args += ['--extra-aperture-pix', aperture]
+
+        args = basic_args + phot_args + extra_args
+        check_run(photometry.main, [str(a) for a in args])
+
+        # The apertures as they were stored in the LEMONdB, after having
+        # been converted to string in order to pass them to photometry.main()
+        phot_db = database.LEMONdB(aper_phot_db_path)
+        filter_pparams = phot_db.aperture_pparams
+        del phot_db
+
+        # For each candidate aperture, make its measurements the photometry of
+        # the LEMONdB, compute the light curves of the constant stars and the
+        # median of their standard deviations, as a means of evaluating the
+        # suitability of this combination of parameters.
+        for index, pparams in enumerate(filter_pparams):
+
+            print style.prefix
+            aperture = pparams.aperture
 
-            args = basic_args + phot_args + extra_args
-            check_run(photometry.main, [str(a) for a in args])
+            phot_db = database.LEMONdB(aper_phot_db_path)
+            phot_db.select_aperture_photometry(pparams)
+            phot_db.commit()
+            del phot_db
 
             kwargs = dict(prefix = 'diffphot_', suffix = '.LEMONdB')
             fd, aper_diff_db_path = tempfile.mkstemp(**kwargs)
@@ -579,10 +617,13 @@ def main(arguments = None):
 
             # Reuse the arguments used earlier for diffphot.main(). We only
             # need to change the first argument (path to the input LEMONdB)
-            # and the third one (path to the output LEMONdB)
+            # and the third one (path to the output LEMONdB). The photometry
+            # is linked, not copied, as it is read only once: the output
+            # LEMONdB is no longer opened after the next aperture is selected.
             diff_args[0] = aper_phot_db_path
             diff_args[2] = aper_diff_db_path
-            check_run(diffphot.main, [str(a) for a in diff_args])
+            aper_diff_args = diff_args + ['--link']
+            check_run(diffphot.main, [str(a) for a in aper_diff_args])
 
             miner = mining.LEMONdBMiner(aper_diff_db_path)
 
@@ -595,6 +636,10 @@ def main(arguments = None):
                 msg = "%sNo constant stars for this aperture. Ignoring it..."
                 print msg % style.prefix
                 continue
+            finally:
+                # A read transaction on the linked LEMONdB would prevent
+                # select_aperture_photometry() from modifying it afterwards
+                del miner
 
             # There must be at most 'nconstant' stars, but there may be fewer
             # if this aperture causes one or more of the constant stars to be
@@ -622,7 +667,7 @@ def main(arguments = None):
             args = style.prefix, aperture, len(cstars), stdevs_median
             print msg % args
 
-            percentage = (index + 1) / len(filter_apertures) * 100
+            percentage = (index + 1) / len(filter_pparams) * 100
             msg = "%s%s progress: %.2f %%"
             args = style.prefix, pfilter, percentage
             print msg % args
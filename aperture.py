@@ -0,0 +1,437 @@
+#! /usr/bin/env python
+
+# Copyright (c) 2012 Victor Terron. All rights reserved.
+# Institute of Astrophysics of Andalusia, IAA-CSIC
+#
+# This file is part of LEMON.
+#
+# LEMON is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import division
+
+"""
+This module implements aperture photometry with NumPy, as an alternative to
+IRAF's qphot (see the 'qphot' module) that does not need PyRAF. The FITS image
+is read only once, and all the astronomical objects are measured at the same
+time, without temporary files or IRAF processes. The algorithms are those of
+qphot with its default parameters: centroid centering, the sky computed as the
+mode of the pixels in the annulus (with k-sigma rejection) and the pixels on
+the boundary of the aperture weighted by the fraction of them that is inside.
+The result is a list of qphot.QPhotResult objects, as that of qphot.run().
+
+"""
+
+import logging
+import math
+import numpy
+import pyfits
+import warnings
+
+# LEMON modules
+import qphot
+
+# The zero point of the magnitude scale. This is the default value of the
+# 'zmag' parameter of IRAF's qphot, so that the magnitudes are on the same
+# scale regardless of which of the two modules was used to compute them.
+ZMAG = 25.0
+
+# The maximum number of iterations of the centroid centering algorithm and of
+# the rejection of sky pixels, and the number of standard deviations from the
+# sky value beyond which a pixel is rejected. These are the default values of
+# the 'cmaxiter', 'snreject', 'sloreject' and 'shireject' parameters of qphot,
+# except for 'snreject', which is 50: we stop much earlier, as the iterations
+# rarely reject any more pixels after the first few.
+CENTER_MAXITER = 10
+SKY_MAXITER = 10
+SKY_KSIGMA = 3.0
+
+# The maximum number of pixels of the (objects x pixels x pixels) arrays in
+# which the pixels around the objects are gathered. The objects are measured
+# in chunks of this size, in order to keep memory usage under control when
+# there are thousands of them and the sky annulus is large.
+CHUNK_SIZE = 2 ** 22
+
+def read_data(path):
+    """ Return the data of the primary HDU of a FITS image, as float64 """
+
+    handler = pyfits.open(path, mode = 'readonly')
+    try:
+        return numpy.array(handler[0].data, dtype = numpy.float64)
+    finally:
+        handler.close(output_verify = 'ignore')
+
+def pad(data, width, value):
+    """ Return a copy of a two-dimensional array, padded with a value.
+
+    The returned array has 'width' additional rows and columns on each side,
+    filled with 'value'. In this manner, the pixels around objects close to
+    (or off) the edges of the image can be gathered without special-casing
+    them: in the padded image of the data we use NaN, so that the pixels off
+    the image are identified as such, and in the saturation mask, False.
+
+    """
+
+    shape = (data.shape[0] + 2 * width, data.shape[1] + 2 * width)
+    padded = numpy.empty(shape, dtype = numpy.asarray(value).dtype)
+    padded.fill(value)
+    padded[width:-width, width:-width] = data
+    return padded
+
+def stamps(padded, width, xs, ys, halfwidth):
+    """ Gather the pixels around each object from a padded image.
+
+    Return a three-element tuple. The first element is an array of shape
+    (objects x 2 * halfwidth + 1 x 2 * halfwidth + 1) with, for each object,
+    the square of pixels centered on the pixel closest to (xs, ys), one-based
+    coordinates. 'padded' is the image padded with 'width' pixels (see pad())
+    on each side. The other two elements are the one-based coordinates of the
+    central pixel of each square. Objects so far off the image that their
+    square would fall outside the padded array are centered on the nearest
+    valid pixel: the square, then, only contains padding pixels.
+
+    """
+
+    # Zero-based indexes, in the padded image, of the central pixels
+    offsets = numpy.arange(-halfwidth, halfwidth + 1)
+    cols = numpy.round(numpy.nan_to_num(xs)).astype(int) - 1 + width
+    rows = numpy.round(numpy.nan_to_num(ys)).astype(int) - 1 + width
+    cols = numpy.clip(cols, halfwidth, padded.shape[1] - halfwidth - 1)
+    rows = numpy.clip(rows, halfwidth, padded.shape[0] - halfwidth - 1)
+
+    pixels = padded[(rows[:, numpy.newaxis, numpy.newaxis] +
+                     offsets[:, numpy.newaxis]),
+                    cols[:, numpy.newaxis, numpy.newaxis] + offsets]
+    return pixels, cols + 1 - width, rows + 1 - width
+
+def centroid(padded, width, xs, ys, cbox):
+    """ Compute the accurate centers of the objects.
+
+    This is the centroid centering algorithm of IRAF's qphot: the marginal
+    distributions of the pixels in a box of width 'cbox' around each object
+    are computed, their mean subtracted and the negative values set to zero,
+    and the center found as the intensity-weighted mean of the marginals. The
+    box is moved to the new center and the process repeated until the center
+    stays on the same pixel (or CENTER_MAXITER iterations). Objects for which
+    the box is not entirely on the image, or without any positive value in
+    the marginals, are not recentered. Returns the new xs and ys.
+
+    """
+
+    halfwidth = int(cbox // 2)
+    if not halfwidth:
+        return xs, ys
+
+    xs = numpy.array(xs, dtype = numpy.float64)
+    ys = numpy.array(ys, dtype = numpy.float64)
+    offsets = numpy.arange(-halfwidth, halfwidth + 1)
+    active = numpy.isfinite(xs) & numpy.isfinite(ys)
+
+    for iteration in xrange(CENTER_MAXITER):
+
+        boxes, xcs, ycs = stamps(padded, width, xs, ys, halfwidth)
+        centers = []
+        for marginal in (boxes.sum(axis = 1), boxes.sum(axis = 2)):
+            marginal = marginal - marginal.mean(axis = 1)[:, numpy.newaxis]
+            marginal = numpy.clip(marginal, 0, None)
+            totals = marginal.sum(axis = 1)
+            # NaN if some of the pixels in the box are off the image
+            valid = numpy.isfinite(totals) & (totals > 0)
+            totals[~valid] = 1
+            shifts = (marginal * offsets).sum(axis = 1) / totals
+            centers.append((shifts, valid))
+
+        (xshifts, xvalid), (yshifts, yvalid) = centers
+        update = active & xvalid & yvalid
+        new_xs = numpy.where(update, xcs + xshifts, xs)
+        new_ys = numpy.where(update, ycs + yshifts, ys)
+
+        # Keep iterating only for the objects that moved to another pixel
+        moved = ((numpy.round(new_xs) != xcs) | (numpy.round(new_ys) != ycs))
+        xs, ys = new_xs, new_ys
+        active = update & moved
+        if not active.any():
+            break
+
+    return xs, ys
+
+def distances(xs, ys, xcs, ycs, halfwidth):
+    """ Return the distance from each pixel of the stamps to the objects.
+
+    'xs' and 'ys' are the one-based coordinates of the objects, and 'xcs' and
+    'ycs' those of the central pixels of their stamps, as returned by stamps().
+    The result is an array of shape (objects x 2 * halfwidth + 1 x 2 *
+    halfwidth + 1) with the distance, in pixels, from the center of each pixel
+    of the stamp to the center of the object.
+
+    """
+
+    offsets = numpy.arange(-halfwidth, halfwidth + 1)
+    dx = offsets + (xcs - xs)[:, numpy.newaxis, numpy.newaxis]
+    dy = (offsets[:, numpy.newaxis] +
+          (ycs - ys)[:, numpy.newaxis, numpy.newaxis])
+    return numpy.hypot(dx, dy)
+
+def nearest_saturated(data, xs, ys, radius, maximum):
+    """ Return the distance from each object to its closest saturated pixel.
+
+    Return a one-dimensional array with, for each object, the distance from its
+    center to that of the closest pixel of 'data' (a two-dimensional array with
+    the pixels of the FITS image) above 'maximum', the saturation level, among
+    those less than radius + 0.5 pixels away; or positive infinity if there is
+    none. 'xs' and 'ys' are the one-based coordinates of the centers of the
+    objects. Objects off the image, or with non-finite coordinates, never have
+    saturated pixels. The pixels of 'data' are thus read only once, even if
+    saturation has to be checked for several apertures (see run_apertures()).
+
+    """
+
+    xs = numpy.asarray(xs, dtype = numpy.float64)
+    ys = numpy.asarray(ys, dtype = numpy.float64)
+
+    halfwidth = int(math.ceil(radius + 0.5)) + 1
+    width = halfwidth + 1
+    with numpy.errstate(invalid = 'ignore'):
+        padded = pad(data > maximum, width, False)
+
+    result = numpy.empty(len(xs), dtype = numpy.float64)
+    result.fill(numpy.inf)
+    chunk = max(CHUNK_SIZE // (2 * halfwidth + 1) ** 2, 1)
+    for first in xrange(0, len(xs), chunk):
+        cxs = xs[first:first + chunk]
+        cys = ys[first:first + chunk]
+        satur, xcs, ycs = stamps(padded, width, cxs, cys, halfwidth)
+        radii = distances(cxs, cys, xcs, ycs, halfwidth)
+        with numpy.errstate(invalid = 'ignore'): # NaN coordinates
+            radii[~satur | (radii >= radius + 0.5)] = numpy.inf
+        nearest = radii.reshape(len(radii), -1).min(axis = 1)
+        finite = numpy.isfinite(cxs) & numpy.isfinite(cys)
+        result[first:first + chunk] = numpy.where(finite, nearest, numpy.inf)
+
+    return result
+
+def saturated_objects(data, xs, ys, aperture, maximum):
+    """ Determine which objects have saturated pixels in their apertures.
+
+    Return a one-dimensional boolean array with, for each object, whether one
+    or more of the pixels of 'data' (a two-dimensional array with the pixels of
+    the FITS image) in the aperture are above 'maximum', the saturation level.
+    'xs' and 'ys' are the one-based coordinates of the centers of the objects,
+    and 'aperture' the radius of the aperture, in pixels. A pixel belongs to
+    the aperture if any fraction of it is inside (i.e., if its center is less
+    than aperture + 0.5 pixels away from that of the object), as these are the
+    pixels that contribute to the flux measured by qphot. Objects off the image
+    (or with non-finite coordinates) are never saturated.
+
+    """
+
+    nearest = nearest_saturated(data, xs, ys, aperture, maximum)
+    return nearest < aperture + 0.5
+
+def nan_stats(values):
+    """ Return the mean, median and standard deviation of each row, ignoring
+    NaNs. The same as numpy.nanmean(), numpy.nanmedian() and numpy.nanstd()
+    with ddof = 1, which need NumPy >= 1.8 or 1.9, but computed by sorting
+    the rows, where NaNs go to the end. NaN is returned for the rows with no
+    values, and also as the standard deviation of those with only one. """
+
+    values = numpy.sort(values, axis = 1)
+    valid = ~numpy.isnan(values)
+    counts = valid.sum(axis = 1)
+
+    rows = numpy.arange(len(values))
+    lower = numpy.maximum((counts - 1) // 2, 0)
+    upper = numpy.minimum(counts // 2, values.shape[1] - 1)
+    with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+        mean = numpy.where(valid, values, 0).sum(axis = 1) / counts
+        median = (values[rows, lower] + values[rows, upper]) / 2
+        median[counts == 0] = numpy.nan
+        squares = numpy.where(valid, values - mean[:, numpy.newaxis], 0) ** 2
+        stdev = numpy.sqrt(squares.sum(axis = 1) / (counts - 1))
+        stdev[counts < 2] = numpy.nan
+    return mean, median, stdev
+
+def fit_sky(values):
+    """ Compute the sky level from the pixels in the annulus of each object.
+
+    'values' is a two-dimensional array with, in each row, the pixels in the
+    sky annulus of an object, and NaN for the other elements. The sky is the
+    mode of the distribution, estimated (as IRAF does) as 3 * median - 2 *
+    mean, or the mean if it is smaller than the median. The pixels more than
+    SKY_KSIGMA standard deviations away from the sky are rejected, and the
+    sky computed again, until no pixel is rejected or SKY_MAXITER iterations.
+    Returns two one-dimensional arrays with the sky and the standard deviation
+    of the sky pixels of each object, NaN if it had no sky pixels at all.
+
+    """
+
+    values = numpy.array(values, dtype = numpy.float64)
+    for iteration in xrange(SKY_MAXITER + 1):
+        # Objects entirely off the image have no sky pixels at all: NaN
+        mean, median, stdev = nan_stats(values)
+        with numpy.errstate(invalid = 'ignore'):
+            sky = numpy.where(mean < median, mean, 3 * median - 2 * mean)
+
+        if iteration == SKY_MAXITER:
+            break
+
+        with numpy.errstate(invalid = 'ignore'):
+            deviations = numpy.abs(values - sky[:, numpy.newaxis])
+            reject = deviations > SKY_KSIGMA * stdev[:, numpy.newaxis]
+        if not reject.any():
+            break
+        values[reject] = numpy.nan
+
+    return sky, stdev
+
+def run(img, coordinates, epoch,
+        aperture, annulus, dannulus, maximum,
+        datek, timek, exptimek, uncimgk,
+        cbox = 0):
+    """ Do photometry on a FITS image.
+
+    This function is a drop-in replacement for qphot.run(), to whose
+    documentation you should refer for the meaning of the arguments, and
+    which does photometry on the FITS image (a fitsimage.FITSImage object)
+    without IRAF. The proper-motion corrected celestial coordinates of the
+    astronomical objects are transformed to pixel coordinates with the WCS of
+    the image, and then all the objects are measured at once. Returns a list
+    of qphot.QPhotResult objects, one for each object and in the same order,
+    using None as the magnitude of those objects that could not be measured
+    (because the flux is not positive, or the aperture is not entirely on the
+    image) and positive infinity if they are saturated (i.e., if one or more
+    pixels in the aperture are above the saturation level).
+
+    """
+
+    args = (img, coordinates, epoch, [aperture], annulus, dannulus, maximum,
+            datek, timek, exptimek, uncimgk)
+    return run_apertures(*args, cbox = cbox)[0]
+
+def run_apertures(img, coordinates, epoch,
+                  apertures, annulus, dannulus, maximum,
+                  datek, timek, exptimek, uncimgk,
+                  cbox = 0):
+    """ Do photometry on a FITS image with several apertures at once.
+
+    This is the equivalent of calling run() once for each of the radii, in
+    pixels, in the 'apertures' sequence, but in a single pass over the pixels
+    of the image: the centers of the objects and their sky level, which do not
+    depend on the aperture, are computed only once, and then the flux within
+    each aperture is measured from the same pixels. This is what allows us to
+    compute the curve of growth of the objects, or to evaluate many candidate
+    apertures, at the cost of doing photometry only once. The other arguments
+    are those of run(). Returns a list with, for each aperture and in the same
+    order, the list of qphot.QPhotResult objects that run() would return.
+
+    """
+
+    year = qphot.get_year(img, coordinates, epoch, datek, timek, exptimek)
+    exact = list(qphot.exact_coordinates(coordinates, year, epoch))
+    if not exact:
+        return [[] for aperture in apertures]
+
+    ras  = numpy.array([coord.ra  for coord in exact])
+    decs = numpy.array([coord.dec for coord in exact])
+    xs, ys = img.world2pix(ras, decs)
+
+    # qphot uses an exposure time of one time unit, so magnitudes are not
+    # normalized, if the keyword is not in the header. This is not fatal, but
+    # the user should be warned, as it is most probably not what they want.
+    itime = 1.0
+    if exptimek:
+        try:
+            itime = float(img.read_keyword(exptimek))
+        except KeyError:
+            msg = "%s  Keyword: %s not found" % (img.path, exptimek)
+            warnings.warn(msg, qphot.MissingFITSKeyword)
+
+    logging.info("%s: reading pixels for photometry" % img.path)
+    data = read_data(img.path)
+
+    # Saturation is checked for on the image given by 'uncimgk', if any
+    orig_img_path = qphot.get_saturation_image(img, uncimgk)
+    if orig_img_path == img.path:
+        satur_data = data
+    else:
+        satur_data = read_data(orig_img_path)
+
+    # The square of pixels around each object must contain the sky annulus,
+    # plus the boundary pixels of the largest aperture; the padding, the
+    # squares of the objects that are on the image but close to its edges.
+    outer = annulus + dannulus
+    largest = max(apertures)
+    halfwidth = int(math.ceil(max(outer, largest + 0.5, cbox / 2))) + 1
+    width = halfwidth + 1
+    padded_data = pad(data, width, numpy.nan)
+
+    xs, ys = centroid(padded_data, width, xs, ys, cbox)
+    nearest = nearest_saturated(satur_data, xs, ys, largest, maximum)
+
+    result = [[] for aperture in apertures]
+    size = (2 * halfwidth + 1) ** 2
+    chunk = max(CHUNK_SIZE // size, 1)
+
+    for first in xrange(0, len(xs), chunk):
+        cxs = xs[first:first + chunk]
+        cys = ys[first:first + chunk]
+
+        pixels, xcs, ycs = stamps(padded_data, width, cxs, cys, halfwidth)
+        radii = distances(cxs, cys, xcs, ycs, halfwidth)
+        finite = numpy.isfinite(pixels)
+        values = numpy.where(finite, pixels, 0)
+
+        in_annulus = (radii >= annulus) & (radii <= outer) & finite
+        sky_values = numpy.where(in_annulus, pixels, numpy.nan)
+        sky_values = sky_values.reshape(len(pixels), -1)
+        skies, stdevs = fit_sky(sky_values)
+
+        for aperture, aperture_result in zip(apertures, result):
+
+            # The fraction of each pixel inside the aperture: one if it is
+            # closer than (aperture - 0.5) pixels to the center, zero if it is
+            # farther than (aperture + 0.5), and a linear approximation in
+            # between.
+            weights = numpy.clip(aperture + 0.5 - radii, 0, 1)
+            inside = weights > 0
+
+            sums = (values * weights).sum(axis = (1, 2))
+            areas = weights.sum(axis = (1, 2))
+            off_image = (inside & ~finite).any(axis = (1, 2))
+            fluxes = sums - areas * numpy.nan_to_num(skies)
+            saturated = nearest[first:first + chunk] < aperture + 0.5
+
+            for index in xrange(len(pixels)):
+                x, y = cxs[index], cys[index]
+                if not (numpy.isfinite(x) and numpy.isfinite(y)):
+                    x = y = -1 # as qphot.QPhot.run() does
+
+                sum_ = float(sums[index])
+                flux = float(fluxes[index])
+                stdev = float(stdevs[index])
+
+                if not numpy.isfinite(stdev):
+                    stdev = None
+
+                if saturated[index]:
+                    mag = float('infinity')
+                elif off_image[index] or stdev is None or flux <= 0:
+                    mag = None # INDEF
+                else:
+                    mag = (ZMAG - 2.5 * math.log10(flux) +
+                           2.5 * math.log10(itime))
+
+                args = float(x), float(y), mag, sum_, flux, stdev
+                aperture_result.append(qphot.QPhotResult(*args))
+
+    return result
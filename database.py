@@ -28,6 +28,7 @@ the information that may be needed for the data analysis.
 """
 
 import collections
+import contextlib
 import copy
 import itertools
 import math
@@ -39,13 +40,75 @@ import random
 import string
 import sqlite3
 import tempfile
+import urllib
 
 # LEMON modules
-import astromatic
 import json_parse
 import methods
 import passband
 
+def _unit_vector(ra, dec):
+    """ Return the (x, y, z) Cartesian coordinates, on the unit sphere, of a
+    right ascension and declination, both given in degrees """
+
+    ra, dec = math.radians(ra), math.radians(dec)
+    return (math.cos(dec) * math.cos(ra),
+            math.cos(dec) * math.sin(ra),
+            math.sin(dec))
+
+def _angular_distance(ra1, dec1, ra2, dec2):
+    """ Return the angular distance, in degrees, between celestial coordinates.
+
+    Use the special case of the Vincenty formula for a sphere, which is
+    accurate for all distances (the same one used by AstroPy to compute
+    separations). All the arguments are given in degrees, and may be NumPy
+    arrays, in which case the distances are computed element-wise.
+
+    """
+
+    ra1, dec1, ra2, dec2 = map(numpy.radians, (ra1, dec1, ra2, dec2))
+    delta_ra = ra2 - ra1
+    sin_dec1, cos_dec1 = numpy.sin(dec1), numpy.cos(dec1)
+    sin_dec2, cos_dec2 = numpy.sin(dec2), numpy.cos(dec2)
+
+    num1 = cos_dec2 * numpy.sin(delta_ra)
+    num2 = cos_dec1 * sin_dec2 - sin_dec1 * cos_dec2 * numpy.cos(delta_ra)
+    denominator = sin_dec1 * sin_dec2 + cos_dec1 * cos_dec2 * numpy.cos(delta_ra)
+    return numpy.degrees(numpy.arctan2(numpy.hypot(num1, num2), denominator))
+
+# The tables that, if this LEMONdB is linked to another (see the method
+# LEMONdB.link_photometry), are read from the linked one instead of being
+# stored in this LEMONdB. These are by far the largest tables in a LEMONdB.
+_LINKED_TABLES = ('photometry', 'packed_photometry', 'raw_images',
+                  'aperture_photometry')
+
+# The data type of the packed records: little-endian, double-precision floats
+_PACKED_DTYPE = numpy.dtype('<f8')
+
+def _pack_records(data):
+    """ Pack the (Unix time, magnitude, SNR) records of a star into a BLOB.
+
+    'data' is a (3 x N) array (or anything NumPy can convert to one) with, in
+    this order, the Unix times, magnitudes and SNRs of the N records. They are
+    chronologically sorted and stored as little-endian float64 values, so the
+    BLOB consists of all the Unix times, followed by all the magnitudes and
+    then all the SNRs. A None SNR (allowed in light curves) is stored as NaN.
+    Raises ValueError if more than one record has the same Unix time.
+
+    """
+
+    data = numpy.asarray(data, dtype = _PACKED_DTYPE)
+    data = data[:, numpy.argsort(data[0], kind = 'mergesort')]
+    if numpy.any(numpy.diff(data[0]) == 0):
+        raise ValueError("more than one record for the same Unix time")
+    return sqlite3.Binary(data.tostring())
+
+def _unpack_records(blob):
+    """ Return the (3 x N) array of records packed by _pack_records. This is
+    a read-only view of the BLOB, as numpy.frombuffer() copies no data """
+    return numpy.frombuffer(blob, dtype = _PACKED_DTYPE).reshape((3, -1))
+
+
 class DBStar(object):
     """ Encapsulates the instrumental photometric information for a star.
 
@@ -56,7 +119,7 @@ class DBStar(object):
 
     """
 
-    def __init__(self, id_, pfilter, phot_info, times_indexes,
+    def __init__(self, id_, pfilter, phot_info, times_order = None,
                  dtype = numpy.longdouble):
         """ Instantiation method for the DBStar class.
 
@@ -72,13 +135,14 @@ class DBStar(object):
                     SNR) and as many columns as records for which there is
                     photometric information. For example, in order to get the
                     magnitude of the third image, we would do phot_info[1][2]
-        times_indexes - a dictionary mapping each Unix time for which the star
-                        was observed to its index in phot_info; this gives us
-                        O(1) lookups when 'trimming' an instance. See the
-                        BDStar.issubset and complete_for for further
-                        information. Note that the values in this dictionary
-                        are trusted blindly, so they better have the correct
-                        values for phot_info!
+        times_order - a one-dimensional NumPy array with the indexes that sort
+                      the Unix times in phot_info chronologically, as returned
+                      by numpy.argsort(phot_info[0]). Together with the sorted
+                      Unix times, this allows us to look up Unix times with
+                      numpy.searchsorted() when 'trimming' an instance. See the
+                      DBStar.issubset and complete_for for further information.
+                      If not given, it is computed; otherwise, the values are
+                      trusted blindly, so they better be correct for phot_info!
 
         """
 
@@ -87,7 +151,10 @@ class DBStar(object):
         if phot_info.shape[0] != 3: # number of rows
             raise ValueError("'phot_info' must have exactly three rows")
         self._phot_info = phot_info
-        self._time_indexes = times_indexes
+        if times_order is None:
+            times_order = numpy.argsort(phot_info[0], kind = 'mergesort')
+        self._times_order = times_order
+        self._sorted_times = phot_info[0][times_order]
         self.dtype = dtype
 
     def __str__(self):
@@ -103,9 +170,32 @@ class DBStar(object):
         """ Return the Unix time of the index-th record """
         return self._phot_info[0][index]
 
+    def _lookup_times(self, unix_times):
+        """ Find Unix times among those at which the star was observed.
+
+        Return a two-element tuple: (a) a one-dimensional NumPy array with the
+        index in '_phot_info' of each one of the 'unix_times', and (b) a
+        Boolean NumPy array, True for those Unix times which were found. The
+        elements of (a) for which (b) is False are meaningless.
+
+        """
+
+        unix_times = numpy.asarray(unix_times)
+        if not len(self):
+            found = numpy.zeros(unix_times.shape, dtype = numpy.bool_)
+            return numpy.zeros(unix_times.shape, dtype = numpy.intp), found
+
+        positions = numpy.searchsorted(self._sorted_times, unix_times)
+        positions = numpy.minimum(positions, len(self) - 1)
+        found = self._sorted_times[positions] == unix_times
+        return self._times_order[positions], found
+
     def _time_index(self, unix_time):
         """ Return the index of the Unix time in '_phot_info' """
-        return self._time_indexes[unix_time]
+        indexes, found = self._lookup_times([unix_time])
+        if not found[0]:
+            raise KeyError(unix_time)
+        return int(indexes[0])
 
     def mag(self, index):
         """ Return the magnitude of the index-th record """
@@ -120,14 +210,14 @@ class DBStar(object):
         """ Return the Unix times at which the star was observed """
         return self._phot_info[0]
 
+    def _has_times(self, unix_times):
+        """ Return True if the star was observed at all the Unix times """
+        return bool(numpy.all(self._lookup_times(unix_times)[1]))
+
     def issubset(self, other):
         """ Return True if for each Unix time at which 'self' was observed,
         there is also an observation for 'other'; False otherwise """
-
-        for unix_time in self._unix_times:
-            if unix_time not in other._time_indexes:
-                return False
-        return True
+        return other._has_times(self._sorted_times)
 
     def _trim_to(self, other):
         """ Return a new DBStar which contains the records of 'self' that were
@@ -135,14 +225,14 @@ class DBStar(object):
         be raised if self if not a subset of other -- so you should check for
         that before trimming anything"""
 
-        phot_info = numpy.empty((3, len(other)), dtype = self.dtype)
-        for oindex, unix_time in enumerate(other._unix_times):
-            sindex = self._time_index(unix_time)
-            phot_info[0][oindex] = self.time(sindex)
-            phot_info[1][oindex] = self.mag(sindex)
-            phot_info[2][oindex] = self.snr(sindex)
+        indexes, found = self._lookup_times(other._unix_times)
+        if not numpy.all(found):
+            missing = other._unix_times[~found][0]
+            raise KeyError(missing)
+
+        phot_info = self._phot_info[:, indexes].astype(self.dtype)
         return DBStar(self.id, self.pfilter, phot_info,
-                      other._time_indexes, dtype = self.dtype)
+                      other._times_order, dtype = self.dtype)
 
     def complete_for(self, iterable):
         """ Iterate over the supplied DBStars and trim them.
@@ -163,10 +253,10 @@ class DBStar(object):
     def make_star(id_, pfilter, rows, dtype = numpy.longdouble):
         """ Construct a DBstar instance for some photometric data.
 
-        Feeding the class constructor with NumPy arrays and dictionaries is not
-        particularly practical, so most of the time you may want to use instead
-        this convenience function. It also receives the star ID and the filter
-        of the star, but the photometric records are given as a sequence of
+        Feeding the class constructor with NumPy arrays is not particularly
+        practical, so most of the time you may want to use instead this
+        convenience function. It also receives the star ID and the filter of
+        the star, but the photometric records are given as a sequence of
         three-element tuples (Unix time, magnitude and SNR).
 
         """
@@ -178,18 +268,9 @@ class DBStar(object):
         # not initializes its entries and may therefore be marginally faster
 
         phot_info = numpy.empty((3, len(rows)), dtype = dtype)
-
-        # A cache, mapping each Unix time to its index in phot_info; passed
-        # to the constructor of DBStar for O(1) lookups of Unix times
-        times_indexes = {}
-
-        for index, row in enumerate(rows):
-            unix_time, magnitude, snr = row
-            phot_info[0][index] = unix_time
-            phot_info[1][index] = magnitude
-            phot_info[2][index] = snr
-            times_indexes[unix_time] = index
-        return DBStar(id_, pfilter, phot_info, times_indexes, dtype = dtype)
+        if len(rows):
+            phot_info[:] = numpy.array(rows, dtype = dtype).T
+        return DBStar(id_, pfilter, phot_info, dtype = dtype)
 
 
 # The parameters used for aperture photometry
@@ -202,13 +283,98 @@ typename = 'Image'
 field_names = "path pfilter unix_time object airmass gain ra dec"
 Image = collections.namedtuple(typename, field_names)
 
+# The summary statistics of a light curve, stored in the CURVE_STATS table
+typename = 'CurveStats'
+field_names = "npoints mean stdev amplitude min_time max_time median_snr"
+CurveStats = collections.namedtuple(typename, field_names)
+
+typename = 'PhotometryMatrix'
+field_names = "pfilter star_ids unix_times magnitudes snrs mask"
+class PhotometryMatrix(collections.namedtuple(typename, field_names)):
+    """ The photometric information of all the stars in a filter.
+
+    pfilter - the photometric filter of the information being stored.
+    star_ids - a one-dimensional NumPy array with the ID of the stars in the
+               LEMONdB, in ascending order. The i-th row of the matrices
+               below corresponds to the i-th star.
+    unix_times - a one-dimensional NumPy array with the Unix times, sorted
+                 chronologically, of the images in the photometric filter.
+                 The j-th column of the matrices below corresponds to the j-th
+                 Unix time.
+    magnitudes - a two-dimensional (stars x images) NumPy array with the
+                 magnitudes of the stars; NaN where there is no photometric
+                 record for a star in an image.
+    snrs - a two-dimensional (stars x images) NumPy array with the
+           signal-to-noise ratios, also NaN where there is no record.
+    mask - a two-dimensional (stars x images) Boolean NumPy array, True where
+           there is a photometric record for the star in the image.
+
+    """
+
+    def star(self, index):
+        """ Return the index-th star as a DBStar instance.
+
+        The returned DBStar contains only the records of those images in which
+        the star was observed (that is, the columns where 'mask' is True).
+
+        """
+
+        observed = self.mask[index]
+        phot_info = numpy.empty((3, observed.sum()), dtype = self.magnitudes.dtype)
+        phot_info[0] = self.unix_times[observed]
+        phot_info[1] = self.magnitudes[index][observed]
+        phot_info[2] = self.snrs[index][observed]
+
+        # The Unix times are already sorted, as those of the matrix are
+        times_order = numpy.arange(phot_info.shape[1])
+        id_ = int(self.star_ids[index])
+        return DBStar(id_, self.pfilter, phot_info, times_order,
+                      dtype = self.magnitudes.dtype)
+
+    def stars(self):
+        """ Return a list with all the stars as DBStar instances """
+        return [self.star(index) for index in xrange(len(self.star_ids))]
+
+    def complete_indexes(self):
+        """ Find, for each star, the stars observed in all of its images.
+
+        Return a list with, for the i-th star, a one-dimensional NumPy array
+        with the indexes of the other stars that have a photometric record in
+        each of the images in which the i-th star was observed -- that is, the
+        stars for which DBStar.complete_for would return the trimmed version.
+        The rows of 'mask' are packed into bits, so each star is tested against
+        all the others with a vectorized AND over (images / 8) bytes. Stars with
+        identical masks, which is the most common case, share the result.
+
+        """
+
+        packed = numpy.packbits(self.mask, axis = 1)
+        # Map each packed mask to the stars that are complete for it
+        covering = {}
+        complete = []
+        for index in xrange(len(self.star_ids)):
+            row = packed[index]
+            key = row.tostring()
+            try:
+                indexes = covering[key]
+            except KeyError:
+                # Star j is complete if it has no zero bit where 'row' has a one
+                is_complete = ~numpy.any(row & ~packed, axis = 1)
+                indexes = covering[key] = numpy.flatnonzero(is_complete)
+            complete.append(indexes[indexes != index])
+        return complete
+
+
 class LightCurve(object):
     """ The data points of a graph of light intensity of a celestial object.
 
     Encapsulates a series of Unix times linked to a differential magnitude with
-    a signal-to-noise ratio. Internally stored as a list of three-element
-    tuples, but we are implementing the add method so that we can interact with
-    it as if it were a set, moving us up one level in the abstraction ladder.
+    a signal-to-noise ratio. Internally stored as a NumPy structured array, but
+    we are implementing the add method so that we can interact with it as if it
+    were a set, moving us up one level in the abstraction ladder. The array is
+    over-allocated, so adding points takes amortized constant time, and it is
+    sorted chronologically only when needed, and then only once until new
+    points are added. A None signal-to-noise ratio is stored as NaN.
 
     """
 
@@ -233,34 +399,119 @@ class LightCurve(object):
             msg = "at least one comparison star is needed"
             raise ValueError(msg)
 
-        self._data = []
         self.pfilter = pfilter
         self.cstars = cstars
         self.cweights = cweights
         self.cstdevs = cstdevs
         self.dtype = dtype
 
+        fields = [('unix_time', dtype), ('magnitude', dtype), ('snr', dtype)]
+        self._data = numpy.empty(0, dtype = fields)
+        self._size = 0     # number of points in use in '_data'
+        self._sorted = None # cached, chronologically sorted copy of the points
+
+    def _reserve(self, size):
+        """ Make sure that there is room in the array for 'size' points """
+
+        if size > len(self._data):
+            capacity = max(size, 2 * len(self._data), 16)
+            data = numpy.empty(capacity, dtype = self._data.dtype)
+            data[:self._size] = self._data[:self._size]
+            self._data = data
+
+    @property
+    def _points(self):
+        """ Return a view of the points, in the order in which they were added """
+        return self._data[:self._size]
+
     def add(self, unix_time, magnitude, snr):
         """ Add a data point to the light curve """
-        self._data.append((unix_time, magnitude, snr))
+        self._reserve(self._size + 1)
+        if snr is None:
+            snr = numpy.nan
+        self._data[self._size] = (unix_time, magnitude, snr)
+        self._size += 1
+        self._sorted = None
+
+    def extend(self, unix_times, magnitudes, snrs = None):
+        """ Add multiple data points to the light curve at once.
+
+        The three arguments are sequences or NumPy arrays, of the same length,
+        with the Unix times, magnitudes and signal-to-noise ratios of the data
+        points, respectively. If 'snrs' is None, so is the signal-to-noise
+        ratio of all the points. Use this method, instead of LightCurve.add,
+        to add many points, as the values are copied into the array in bulk.
+
+        """
+
+        size = len(unix_times)
+        if len(magnitudes) != size:
+            raise ValueError("number of magnitudes must equal that of Unix times")
+        if snrs is not None and len(snrs) != size:
+            raise ValueError("number of SNRs must equal that of Unix times")
+
+        self._reserve(self._size + size)
+        points = self._data[self._size:self._size + size]
+        points['unix_time'] = unix_times
+        points['magnitude'] = magnitudes
+        points['snr'] = numpy.nan if snrs is None else snrs
+        self._size += size
+        self._sorted = None
 
     def __len__(self):
-        return len(self._data)
+        return self._size
+
+    @staticmethod
+    def _point(row):
+        """ Return a point as a (unix_time, magnitude, snr) tuple """
+        unix_time, magnitude, snr = row
+        return unix_time, magnitude, None if numpy.isnan(snr) else snr
 
     def __getitem__(self, index):
-        return self._data[index]
+        if isinstance(index, slice):
+            return [self._point(row) for row in self._points[index]]
+        if index >= self._size or index < -self._size:
+            raise IndexError("light curve index out of range")
+        return self._point(self._points[index])
+
+    def _chronological(self):
+        """ Return a read-only array with the points, sorted chronologically.
+        The array is sorted the first time it is needed, and then cached until
+        new points are added to the light curve """
+
+        if self._sorted is None:
+            points = self._points
+            order = numpy.argsort(points['unix_time'], kind = 'mergesort')
+            self._sorted = points[order]
+            self._sorted.flags.writeable = False
+        return self._sorted
 
     def __iter__(self):
         """ Return a copy of the (unix_time, magnitude, snr) tuples,
         chronologically sorted"""
-        return iter(sorted(self._data, key = operator.itemgetter(0)))
+        return itertools.imap(self._point, self._chronological())
+
+    @property
+    def unix_times(self):
+        """ Return a read-only array with the Unix times, sorted """
+        return self._chronological()['unix_time']
+
+    @property
+    def magnitudes(self):
+        """ Return a read-only array with the magnitudes, sorted by time """
+        return self._chronological()['magnitude']
+
+    @property
+    def snrs(self):
+        """ Return a read-only array with the SNRs (None stored as NaN),
+        sorted by time """
+        return self._chronological()['snr']
 
     @property
     def stdev(self):
         if not self:
             raise ValueError("light curve is empty")
-        magnitudes = [mag for unix_time, mag, snr in self._data]
-        return numpy.std(numpy.array(magnitudes, dtype = self.dtype))
+        return numpy.std(self._points['magnitude'])
 
     def weights(self):
         """ Return a generator over the comparison stars and their weights.
@@ -296,22 +547,31 @@ class LightCurve(object):
         if not self:
             raise ValueError("light curve is empty")
 
-        magnitudes = sorted(mag for unix_time, mag, snr in self._data)
+        magnitudes = numpy.sort(self._points['magnitude'])
         func = numpy.median if median else numpy.mean
         return func(magnitudes[-npoints:]) - func(magnitudes[:npoints])
 
+    def noisy_mask(self, snr):
+        """ Return a Boolean NumPy array, True for the points whose
+        signal-to-noise ratio is below 'snr' (or None), in the order
+        in which they are returned by LightCurve.__iter__ """
+
+        with numpy.errstate(invalid = 'ignore'): # NaN comparisons
+            return ~(self.snrs >= snr)
+
     def ignore_noisy(self, snr):
         """ Return a copy of the LightCurve without noisy points.
 
-        The method returns a deep copy of the instance from which those
+        The method returns a copy of the instance from which those
         differential magnitudes whose signal-to-noise ratio is below 'snr'
         have been removed.
 
         """
 
-        curve = copy.deepcopy(self)
-        # _data stores three-element tuples: (Unix time, magnitude, snr)
-        curve._data = [x for x in curve._data if x[-1] >= snr]
+        curve = copy.copy(self)
+        curve._data = self._chronological()[~self.noisy_mask(snr)]
+        curve._size = len(curve._data)
+        curve._sorted = None
         return curve
 
 
@@ -339,6 +599,10 @@ class DuplicateLightCurvePointError(sqlite3.IntegrityError):
     """ If more than one curve point for the same star and image is added"""
     pass
 
+class LinkedDatabaseError(sqlite3.IntegrityError):
+    """ Raised if the LEMONdB to which another is linked has been modified """
+    pass
+
 class LEMONdB(object):
     """ Interface to the SQLite database used to store our results """
 
@@ -349,12 +613,40 @@ class LEMONdB(object):
         self.connection = sqlite3.connect(self.path, isolation_level = None)
         self._cursor = self.connection.cursor()
 
+        # The set of star IDs used by LEMONdB._has_star() for O(1) existence
+        # checks. Loaded the first time it is needed, and invalidated (reset
+        # to None) every time a star is added to the database.
+        self._star_ids_cache = None
+
+        # Map each (Unix time, filter ID) to the ID of the image in the IMAGES
+        # table, used by LEMONdB._get_image_id(). Loaded the first time it is
+        # needed and then kept up to date by add_image() as images are added.
+        self._image_ids_cache = None
+
+        # Whether we are within the with statement of LEMONdB.bulk_load, where
+        # foreign keys are not checked, so LEMONdB.commit() must validate the
+        # rows inserted since the last commit (those with a ROWID greater than
+        # the values in _bulk_rowids) before making them permanent.
+        self._bulk_loading = False
+        self._bulk_rowids = None
+
+        # Whether the tables in _LINKED_TABLES have been modified in the
+        # current transaction, in which case LEMONdB._end() increases the
+        # PHOTOMETRY_VERSION counter stored in the METADATA table. This is
+        # how LEMONdBs linked to this one detect that it has changed.
+        self._photometry_changed = False
+
         # Enable foreign key support (SQLite >= 3.6.19)
         self._execute("PRAGMA foreign_keys = ON")
         self._execute("PRAGMA foreign_keys")
         if not self._rows.fetchone()[0]:
             raise sqlite3.NotSupportedError("foreign key support is not enabled")
 
+        # Whether the photometry is read from another LEMONdB, attached as
+        # 'linked'. This must be done before the tables are created, since
+        # those in _LINKED_TABLES must not be created in this database then.
+        self._linked = self._attach_linked()
+
         self._start()
         self._create_tables()
         self.commit()
@@ -367,6 +659,10 @@ class LEMONdB(object):
         """ Execute SQL query; returns nothing """
         self._cursor.execute(query, t)
 
+    def _executemany(self, query, seq):
+        """ Execute SQL query against all the parameter sequences in 'seq' """
+        self._cursor.executemany(query, seq)
+
     @property
     def _rows(self):
         """ Return an iterator over the rows returned by the last query """
@@ -378,11 +674,33 @@ class LEMONdB(object):
 
     def _end(self):
         """ End the current transaction """
+
+        if self._photometry_changed:
+            self._set_metadata('PHOTOMETRY_VERSION',
+                               self._photometry_version() + 1)
+            self._photometry_changed = False
         self._execute("END TRANSACTION")
 
+    def _photometry_version(self, schema = 'main'):
+        """ Return the number of transactions that have modified the tables in
+        _LINKED_TABLES of the LEMONdB attached as 'schema'. Zero if they have
+        not been modified since this counter was introduced to LEMON """
+
+        t = ('PHOTOMETRY_VERSION', )
+        self._execute("SELECT value FROM %s.metadata WHERE key = ?" % schema, t)
+        row = self._rows.fetchone()
+        return 0 if row is None else row[0]
+
     def commit(self):
         """ Make the changes of the current transaction permanent.
-        Automatically starts a new transaction """
+        Automatically starts a new transaction. Within LEMONdB.bulk_load, the
+        foreign keys of the rows inserted since the previous commit are
+        validated first (see LEMONdB._check_new_rows), so that what is made
+        durable never references a missing star or image """
+
+        if self._bulk_loading:
+            self._check_new_rows(self._bulk_rowids)
+            self._bulk_rowids = self._max_rowids()
         self._end()
         self._start()
 
@@ -418,7 +736,8 @@ class LEMONdB(object):
 
         """
 
-        self._execute("ANALYZE")
+        # Only this database: a linked LEMONdB is attached read-only
+        self._execute("ANALYZE main")
         self.commit()
 
     def _create_tables(self):
@@ -451,6 +770,24 @@ class LEMONdB(object):
             imag   REAL NOT NULL)
         ''')
 
+        # Spatial index of the stars: an R*Tree with the Cartesian coordinates,
+        # on the unit sphere, of the right ascension and declination of each
+        # star. The ID of each entry is that of the star in the STARS table.
+        # This allows us to find the stars within a radius of any celestial
+        # coordinates without having to compute the distance to all of them.
+
+        self._execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS stars_xyz USING rtree (
+            id,
+            min_x, max_x,
+            min_y, max_y,
+            min_z, max_z)
+        ''')
+
+        # Databases created before the R*Tree was introduced need to have it
+        # populated with the stars that were already in the STARS table.
+        self._index_stars()
+
         self._execute('''
         CREATE TABLE IF NOT EXISTS photometric_filters (
             id    INTEGER PRIMARY KEY,
@@ -512,6 +849,154 @@ class LEMONdB(object):
         self._execute("CREATE INDEX IF NOT EXISTS img_by_filter_time "
                       "ON images(filter_id, unix_time)")
 
+        self._create_triggers()
+
+        # Store as a blob entire FITS files. This and the other tables listed
+        # in _LINKED_TABLES are not created if the LEMONdB is linked to another
+        # one: in that case, they are read from the linked LEMONdB instead.
+
+        if not self._linked:
+            self._execute('''
+            CREATE TABLE IF NOT EXISTS raw_images (
+                id   INTEGER PRIMARY KEY,
+                fits BLOB NOT NULL,
+                FOREIGN KEY (id) REFERENCES images(id))
+            ''')
+
+        # For those astronomical objects with known proper motions, store the
+        # x- and y-coordinates where photometry was done in each image. Mostly
+        # useful for debugging purposes, this information allows us to verify
+        # that the proper-motion correction was correctly applied.
+
+        self._execute('''
+        CREATE TABLE IF NOT EXISTS pm_corrections (
+            id         INTEGER PRIMARY KEY,
+            star_id    INTEGER NOT NULL,
+            image_id   INTEGER NOT NULL,
+            x          REAL NOT NULL,
+            y          REAL NOT NULL,
+            FOREIGN KEY (star_id)  REFERENCES stars(id),
+            FOREIGN KEY (image_id) REFERENCES images(id),
+            UNIQUE (star_id, image_id))
+        ''')
+
+        if not self._linked:
+            self._execute('''
+            CREATE TABLE IF NOT EXISTS photometry (
+                id         INTEGER PRIMARY KEY,
+                star_id    INTEGER NOT NULL,
+                image_id   INTEGER NOT NULL,
+                magnitude  REAL NOT NULL,
+                snr        REAL NOT NULL,
+                FOREIGN KEY (star_id)  REFERENCES stars(id),
+                FOREIGN KEY (image_id) REFERENCES images(id),
+                UNIQUE (star_id, image_id))
+            ''')
+
+            self._execute("CREATE INDEX IF NOT EXISTS phot_by_star_image "
+                          "ON photometry(star_id, image_id)")
+            self._execute("CREATE INDEX IF NOT EXISTS phot_by_image "
+                          "ON photometry(image_id)")
+
+            # The photometric records for each one of the apertures measured
+            # at once by the photometry module (see its --extra-aperture-pix
+            # option), in addition to those in PHOTOMETRY. Any of these sets
+            # of records may be then copied to that table, which is the one
+            # from which the light curves are computed, with the method
+            # LEMONdB.select_aperture_photometry.
+
+            self._execute('''
+            CREATE TABLE IF NOT EXISTS aperture_photometry (
+                id         INTEGER PRIMARY KEY,
+                star_id    INTEGER NOT NULL,
+                image_id   INTEGER NOT NULL,
+                pparams_id INTEGER NOT NULL,
+                magnitude  REAL NOT NULL,
+                snr        REAL NOT NULL,
+                FOREIGN KEY (star_id)    REFERENCES stars(id),
+                FOREIGN KEY (image_id)   REFERENCES images(id),
+                FOREIGN KEY (pparams_id) REFERENCES photometric_parameters(id),
+                UNIQUE (star_id, image_id, pparams_id))
+            ''')
+
+            self._execute("CREATE INDEX IF NOT EXISTS aper_phot_by_pparams "
+                          "ON aperture_photometry(pparams_id, image_id)")
+
+        self._execute('''
+        CREATE TABLE IF NOT EXISTS light_curves (
+            id         INTEGER PRIMARY KEY,
+            star_id    INTEGER NOT NULL,
+            image_id   INTEGER NOT NULL,
+            magnitude  REAL NOT NULL,
+            snr        REAL,
+            FOREIGN KEY (star_id)  REFERENCES stars(id),
+            FOREIGN KEY (image_id) REFERENCES images(id),
+            UNIQUE (star_id, image_id))
+        ''')
+
+        self._execute("CREATE INDEX IF NOT EXISTS curve_by_star_image "
+                      "ON light_curves(star_id, image_id)")
+
+        # The summary statistics of each light curve, one row per star and
+        # photometric filter, populated by LEMONdB.add_light_curve. This is
+        # what allows us to sort or filter the stars by, e.g., the standard
+        # deviation of their light curves without having to read them all.
+        # 'amplitude' is the peak-to-peak amplitude, and 'median_snr' may be
+        # NULL if none of the points of the curve has a signal-to-noise ratio.
+
+        self._execute('''
+        CREATE TABLE IF NOT EXISTS curve_stats (
+            star_id    INTEGER NOT NULL,
+            filter_id  INTEGER NOT NULL,
+            npoints    INTEGER NOT NULL,
+            mean       REAL NOT NULL,
+            stdev      REAL NOT NULL,
+            amplitude  REAL NOT NULL,
+            min_time   REAL NOT NULL,
+            max_time   REAL NOT NULL,
+            median_snr REAL,
+            FOREIGN KEY (star_id)   REFERENCES stars(id),
+            FOREIGN KEY (filter_id) REFERENCES photometric_filters(id),
+            PRIMARY KEY (star_id, filter_id))
+        ''')
+
+        # The packed counterparts of the PHOTOMETRY and LIGHT_CURVES tables,
+        # populated by LEMONdB.pack(). Instead of one row per star and image,
+        # there is a single row per star and photometric filter, with all its
+        # records packed into a BLOB of float64 values (see _pack_records).
+
+        for table in ('packed_photometry', 'packed_light_curves'):
+            if self._linked and table in _LINKED_TABLES:
+                continue
+            self._execute('''
+            CREATE TABLE IF NOT EXISTS %s (
+                star_id    INTEGER NOT NULL,
+                filter_id  INTEGER NOT NULL,
+                records    BLOB NOT NULL,
+                FOREIGN KEY (star_id)   REFERENCES stars(id),
+                FOREIGN KEY (filter_id) REFERENCES photometric_filters(id),
+                PRIMARY KEY (star_id, filter_id))
+            ''' % table)
+
+        self._execute('''
+        CREATE TABLE IF NOT EXISTS cmp_stars (
+            id        INTEGER PRIMARY KEY,
+            star_id   INTEGER NOT NULL,
+            filter_id INTEGER NOT NULL,
+            cstar_id  INTEGER NOT NULL,
+            stdev     REAL NOT NULL,
+            weight    REAL NOT NULL,
+            FOREIGN KEY (star_id)    REFERENCES stars(id),
+            FOREIGN KEY (filter_id) REFERENCES photometric_filters(id),
+            FOREIGN KEY (cstar_id)   REFERENCES stars(id))
+        ''')
+
+        self._execute("CREATE INDEX IF NOT EXISTS cstars_by_star_filter "
+                      "ON cmp_stars(star_id, filter_id)")
+
+    def _create_triggers(self):
+        """ Create, if needed, the triggers that validate the IMAGES table """
+
         # Enforce a maximum of one sources image (SOURCES == 1)
         for index, when in enumerate(("INSERT", "UPDATE OF sources")):
             stmt = """CREATE TRIGGER IF NOT EXISTS single_sources_%d
@@ -561,78 +1046,324 @@ class LEMONdB(object):
                        END; """ % (index, when)
             self._execute(stmt)
 
-        # Store as a blob entire FITS files.
-        self._execute('''
-        CREATE TABLE IF NOT EXISTS raw_images (
-            id   INTEGER PRIMARY KEY,
-            fits BLOB NOT NULL,
-            FOREIGN KEY (id) REFERENCES images(id))
-        ''')
+    def _check_integrity(self):
+        """ Validate the foreign keys of the entire database at once.
 
-        # For those astronomical objects with known proper motions, store the
-        # x- and y-coordinates where photometry was done in each image. Mostly
-        # useful for debugging purposes, this information allows us to verify
-        # that the proper-motion correction was correctly applied.
+        Enforce, with a single pass over the whole tables, the foreign keys
+        that are otherwise checked row by row as data is inserted. This is
+        what allows LEMONdB.bulk_load to disable them while data is being
+        stored. sqlite3.IntegrityError is raised if any constraint fails.
 
-        self._execute('''
-        CREATE TABLE IF NOT EXISTS pm_corrections (
-            id         INTEGER PRIMARY KEY,
-            star_id    INTEGER NOT NULL,
-            image_id   INTEGER NOT NULL,
-            x          REAL NOT NULL,
-            y          REAL NOT NULL,
-            FOREIGN KEY (star_id)  REFERENCES stars(id),
-            FOREIGN KEY (image_id) REFERENCES images(id),
-            UNIQUE (star_id, image_id))
-        ''')
+        """
 
-        self._execute('''
-        CREATE TABLE IF NOT EXISTS photometry (
-            id         INTEGER PRIMARY KEY,
-            star_id    INTEGER NOT NULL,
-            image_id   INTEGER NOT NULL,
-            magnitude  REAL NOT NULL,
-            snr        REAL NOT NULL,
-            FOREIGN KEY (star_id)  REFERENCES stars(id),
-            FOREIGN KEY (image_id) REFERENCES images(id),
-            UNIQUE (star_id, image_id))
-        ''')
+        self._execute("PRAGMA foreign_key_check")
+        rows = list(self._rows)
+        if rows:
+            table, rowid, parent, _ = rows[0]
+            msg = ("foreign key constraint failed: %d row(s) violate it (e.g., "
+                   "rowid %d of table %s, which references table %s)")
+            raise sqlite3.IntegrityError(msg % (len(rows), rowid, table, parent))
+
+    def _max_rowids(self):
+        """ Map the name of each table in the LEMONdB to its maximum ROWID """
+
+        self._execute("SELECT name FROM main.sqlite_master "
+                      "WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")
+        rowids = {}
+        for table in [x[0] for x in self._rows]:
+            self._execute("SELECT MAX(rowid) FROM main.%s" % table)
+            rowids[table] = self._rows.fetchone()[0] or 0
+        return rowids
+
+    def _check_new_rows(self, rowids):
+        """ Validate the foreign keys of the rows added since a point in time.
+
+        The same as LEMONdB._check_integrity, but only for the rows of each
+        table with a ROWID greater than the value in 'rowids', a dictionary
+        returned by LEMONdB._max_rowids. As rows are appended with increasing
+        ROWIDs, these are the rows inserted since that call, which are looked
+        up in the referenced tables through their primary keys. In this
+        manner, the cost of the validation does not grow with the size of the
+        tables. Rows that were modified or deleted are not taken into account.
 
-        self._execute("CREATE INDEX IF NOT EXISTS phot_by_star_image "
-                      "ON photometry(star_id, image_id)")
-        self._execute("CREATE INDEX IF NOT EXISTS phot_by_image "
-                      "ON photometry(image_id)")
+        """
 
-        self._execute('''
-        CREATE TABLE IF NOT EXISTS light_curves (
-            id         INTEGER PRIMARY KEY,
-            star_id    INTEGER NOT NULL,
-            image_id   INTEGER NOT NULL,
-            magnitude  REAL NOT NULL,
-            snr        REAL,
-            FOREIGN KEY (star_id)  REFERENCES stars(id),
-            FOREIGN KEY (image_id) REFERENCES images(id),
-            UNIQUE (star_id, image_id))
-        ''')
+        for table, max_rowid in rowids.iteritems():
+            self._execute("PRAGMA main.foreign_key_list(%s)" % table)
+            for row in list(self._rows):
+                parent, from_, to = row[2:5]
+                query = ("SELECT COUNT(*) FROM main.{0} AS child "
+                         "WHERE child.rowid > ? AND child.{2} IS NOT NULL "
+                         "AND NOT EXISTS (SELECT 1 FROM {1} AS p "
+                         "                WHERE p.{3} = child.{2})")
+                self._execute(query.format(table, parent, from_, to),
+                              (max_rowid,))
+                count = self._rows.fetchone()[0]
+                if count:
+                    msg = ("foreign key constraint failed: %d new row(s) of "
+                           "table %s reference a missing row of table %s")
+                    raise sqlite3.IntegrityError(msg % (count, table, parent))
+
+    @contextlib.contextmanager
+    def bulk_load(self, cache_size = 512, mmap_size = 1024):
+        """ A context manager to store large amounts of data fast.
+
+        Within the with statement, the LEMONdB is configured for bulk loading:
+        (a) the write-ahead log is used as the journal, (b) SQLite does not
+        wait for data to be written to disk before continuing, (c) the page
+        cache and the memory-mapped I/O are enlarged to 'cache_size' and
+        'mmap_size' MiB, respectively, and (d) foreign keys are not checked as
+        data is inserted. Instead, the whole database is validated in a single
+        pass (LEMONdB._check_integrity) before exiting the with statement, so
+        the integrity guarantees at the end are the same, and the changes
+        committed. The original configuration is then restored. The triggers
+        of the IMAGES table are still enforced, as they are cheap: only one
+        row is inserted per image.
+
+        The downside is that, since foreign keys are not checked as records are
+        stored, UnknownStarError and UnknownImageError are not raised by the
+        methods that add photometry or light curves for an unknown star. If
+        the validation fails, sqlite3.IntegrityError is raised and the changes
+        not yet committed are rolled back; the same happens if an exception is
+        raised within the with statement, which is then propagated.
+
+        LEMONdB.commit() may be called within the with statement, to make the
+        data stored so far durable when it is being loaded over a long period
+        of time, as the results of a computation arrive. Before committing,
+        the foreign keys of the rows inserted since the previous commit are
+        validated (LEMONdB._check_new_rows), so what is committed references
+        no missing stars or images, at a cost that does not depend on how
+        much data was stored before. Note, however, that the committed changes
+        are not undone if an exception is raised later, and that the LEMONdB
+        is left in the write-ahead log journal mode if the process is killed.
 
-        self._execute("CREATE INDEX IF NOT EXISTS curve_by_star_image "
-                      "ON light_curves(star_id, image_id)")
+        """
 
-        self._execute('''
-        CREATE TABLE IF NOT EXISTS cmp_stars (
-            id        INTEGER PRIMARY KEY,
-            star_id   INTEGER NOT NULL,
-            filter_id INTEGER NOT NULL,
-            cstar_id  INTEGER NOT NULL,
-            stdev     REAL NOT NULL,
-            weight    REAL NOT NULL,
-            FOREIGN KEY (star_id)    REFERENCES stars(id),
-            FOREIGN KEY (filter_id) REFERENCES photometric_filters(id),
-            FOREIGN KEY (cstar_id)   REFERENCES stars(id))
-        ''')
+        # Some PRAGMAs have no effect (foreign_keys), or fail (journal_mode)
+        # within a transaction, so we need to end the current one first. The
+        # values of the others are saved, so that they can be restored later;
+        # None if not supported by this version of SQLite (e.g., mmap_size).
+        self._end()
+        pragmas = ('main.journal_mode', 'synchronous', 'cache_size', 'mmap_size')
+        original = []
+        for name in pragmas:
+            self._execute("PRAGMA %s" % name)
+            row = self._rows.fetchone()
+            original.append((name, row[0] if row is not None else None))
+
+        self._execute("PRAGMA foreign_keys = OFF")
+        self._execute("PRAGMA main.journal_mode = WAL")
+        self._execute("PRAGMA synchronous = OFF")
+        self._execute("PRAGMA cache_size = -%d" % (cache_size * 1024)) # KiB
+        self._execute("PRAGMA mmap_size = %d" % (mmap_size * 1024 ** 2))
+        self._start()
+        self._bulk_rowids = self._max_rowids()
+        self._bulk_loading = True
 
-        self._execute("CREATE INDEX IF NOT EXISTS cstars_by_star_filter "
-                      "ON cmp_stars(star_id, filter_id)")
+        try:
+            yield
+            self._check_integrity()
+            self._end()
+        except:
+            self._execute("ROLLBACK TRANSACTION")
+            self._photometry_changed = False
+            # The cached IDs may include stars or images that no longer exist
+            self._star_ids_cache = None
+            self._image_ids_cache = None
+            raise
+        finally:
+            # Restore their original values
+            self._bulk_loading = False
+            self._bulk_rowids = None
+            self._execute("PRAGMA foreign_keys = ON")
+            for name, value in original:
+                if value is not None:
+                    self._execute("PRAGMA %s = %s" % (name, value))
+            self._start()
+
+    def _attach(self, path):
+        """ Attach, read-only and as 'linked', the LEMONdB stored at 'path'.
+        Must be called outside of a transaction. Raises IOError if the file
+        does not exist -- otherwise, SQLite would create an empty database """
+
+        if not os.path.exists(path):
+            msg = "linked LEMONdB '%s' does not exist" % path
+            raise IOError(msg)
+
+        # A URI filename, so that the database is opened in read-only mode
+        uri = 'file:%s?mode=ro' % urllib.quote(os.path.abspath(path))
+        self._execute("ATTACH DATABASE ? AS linked", (uri,))
+
+    def _linked_metadata(self, key):
+        """ Return the value of a record in the METADATA table of the linked
+        LEMONdB, or None if there is no record with this key """
+
+        t = (key, )
+        self._execute("SELECT value FROM linked.metadata WHERE key = ?", t)
+        row = self._rows.fetchone()
+        return None if row is None else row[0]
+
+    def _attach_linked(self):
+        """ Attach the LEMONdB to which this one is linked, if any.
+
+        Return True if this LEMONdB is linked to another one (see the method
+        LEMONdB.link_photometry), which is then attached as 'linked'; False
+        otherwise. Raises IOError if the linked LEMONdB no longer exists, and
+        LinkedDatabaseError if it is a different database (its ID is not the
+        one it had when the link was created) or if its photometry has been
+        modified since then (its PHOTOMETRY_VERSION counter is different).
+
+        """
+
+        try:
+            path = self._get_metadata('LINKED_DB')
+            linked_id = self._get_metadata('LINKED_DB_ID')
+        # No METADATA table (a new database) or no such record (not linked)
+        except (sqlite3.OperationalError, AttributeError):
+            return False
+
+        try:
+            linked_version = self._get_metadata('LINKED_DB_VERSION')
+        # Linked by an older version of LEMON, which only stored the ID
+        except AttributeError:
+            linked_version = None
+
+        self._attach(path)
+        msg = None
+        if self._linked_metadata('ID') != linked_id:
+            msg = "it is a different database (ID is no longer %s)" % linked_id
+        elif linked_version is not None:
+            version = self._photometry_version('linked')
+            if version != linked_version:
+                msg = ("its photometry was modified after the link was "
+                       "created (version %d, not %d)" % (version, linked_version))
+
+        if msg is not None:
+            self._execute("DETACH DATABASE linked")
+            msg = "linked LEMONdB '%s' has changed: %s" % (path, msg)
+            raise LinkedDatabaseError(msg)
+        return True
+
+    def link_photometry(self, path):
+        """ Read the photometry from another LEMONdB instead of copying it.
+
+        Link this LEMONdB, which must be empty, to the one stored at 'path',
+        from which the tables listed in _LINKED_TABLES (the photometric records
+        and the FITS file on which sources were detected, by far the largest
+        tables in a LEMONdB) will be read. These tables are not stored in this
+        LEMONdB, which will contain only a copy of the other tables of the
+        linked LEMONdB -- its stars, images, etc. -- plus any data that is
+        added afterwards, such as light curves. All the methods of LEMONdB work
+        transparently across both databases: SQLite resolves the name of any
+        table not found in this one by looking for it in the attached LEMONdB.
+
+        The linked LEMONdB is attached every time this LEMONdB is opened, in
+        read-only mode, so trying to add photometric records or to set the
+        sources image raises sqlite3.OperationalError. Its path, ID and the
+        version of its photometry (a counter increased by every transaction
+        that modifies the tables in _LINKED_TABLES) are stored in the METADATA
+        table, and verified every time to make sure that it is the same
+        database, with the same photometry. Therefore, the linked LEMONdB
+        must not be modified or moved (or LEMONdB.materialize must be called
+        before that). Raises ValueError if this LEMONdB is not empty
+        or if the other LEMONdB is itself linked to another one. Changes are
+        committed automatically.
+
+        """
+
+        if self._linked:
+            raise ValueError("LEMONdB is already linked to another one")
+        if len(self) or self._table_count('images'):
+            raise ValueError("only an empty LEMONdB can be linked")
+
+        # ATTACH cannot be run from within a transaction
+        self._end()
+        self._attach(path)
+        self._start()
+
+        try:
+            self._execute("SELECT name "
+                          "FROM linked.sqlite_master "
+                          "WHERE type = 'table'")
+            tables = set(x[0] for x in self._rows)
+
+            if self._linked_metadata('LINKED_DB') is not None:
+                msg = "cannot link to '%s': it is itself linked" % path
+                raise ValueError(msg)
+
+            # Copy the tables not in _LINKED_TABLES (in an order in which the
+            # referenced ones go first, so that foreign keys are satisfied),
+            # and then remove the (empty) tables that are no longer needed.
+            copied = ('metadata', 'photometric_filters',
+                      'photometric_parameters', 'candidate_parameters',
+                      'stars', 'images', 'pm_corrections', 'light_curves',
+                      'packed_light_curves', 'cmp_stars', 'curve_stats')
+
+            for table in copied:
+                if table in tables:
+                    self._execute("INSERT OR REPLACE INTO main.{0} "
+                                  "SELECT * FROM linked.{0}".format(table))
+            self._index_stars()
+
+            # Tables that the linked LEMONdB does not have, because it was
+            # created by an older version of LEMON, are kept here (empty)
+            for table in _LINKED_TABLES:
+                if table in tables:
+                    self._execute("DROP TABLE main.%s" % table)
+
+            self._set_metadata('LINKED_DB', os.path.abspath(path))
+            self._set_metadata('LINKED_DB_ID', self._linked_metadata('ID'))
+            self._set_metadata('LINKED_DB_VERSION',
+                               self._photometry_version('linked'))
+            self._end()
+
+        except:
+            self._execute("ROLLBACK TRANSACTION")
+            self._execute("DETACH DATABASE linked")
+            self._start()
+            raise
+
+        self._linked = True
+        self._star_ids_cache = None
+        self._image_ids_cache = None
+        self._start()
+
+    def materialize(self):
+        """ Make a linked LEMONdB self-contained.
+
+        Copy to this LEMONdB the tables that are read from the LEMONdB to which
+        it is linked (see LEMONdB.link_photometry), and remove the link, so
+        that the linked LEMONdB is no longer needed. Changes are committed
+        automatically. Nothing is done if this LEMONdB is not linked.
+
+        """
+
+        if not self._linked:
+            return
+
+        self._execute("SELECT name "
+                      "FROM linked.sqlite_master "
+                      "WHERE type = 'table'")
+        tables = set(x[0] for x in self._rows)
+
+        # CREATE TABLE always creates the tables in this database, even if
+        # there is already one with the same name in the attached LEMONdB.
+        self._linked = False
+        self._create_tables()
+        for table in _LINKED_TABLES:
+            if table in tables:
+                self._execute("INSERT INTO main.{0} "
+                              "SELECT * FROM linked.{0}".format(table))
+
+        self._del_metadata('LINKED_DB')
+        self._del_metadata('LINKED_DB_ID')
+        try:
+            self._del_metadata('LINKED_DB_VERSION')
+        except AttributeError:
+            pass
+        self._end()
+        self._execute("DETACH DATABASE linked")
+        self._start()
 
     def _table_count(self, table):
         """ Return the number of rows in 'table' """
@@ -678,9 +1409,9 @@ class LEMONdB(object):
             args = rows[0]
             return PhotometricParameters(*args)
 
-    def _add_pparams(self, pparams):
-        """ Add a PhotometricParameters instance and return its ID or do
-        nothing and simply return the ID if already present in the database"""
+    def _get_pparams_id(self, pparams):
+        """ Return the ID of a PhotometricParameters instance, or None if it
+        is not in the database """
 
         t = [pparams.aperture, pparams.annulus, pparams.dannulus]
         self._execute("SELECT id "
@@ -689,12 +1420,19 @@ class LEMONdB(object):
                       "WHERE aperture = ? "
                       "  AND annulus  = ? "
                       "  AND dannulus = ?", t)
-        try:
-            return list(self._rows)[0][0]
-        except IndexError:
-            t.insert(0, None)
+        row = self._rows.fetchone()
+        return None if row is None else row[0]
+
+    def _add_pparams(self, pparams):
+        """ Add a PhotometricParameters instance and return its ID or do
+        nothing and simply return the ID if already present in the database"""
+
+        id_ = self._get_pparams_id(pparams)
+        if id_ is None:
+            t = (None, pparams.aperture, pparams.annulus, pparams.dannulus)
             self._execute("INSERT INTO photometric_parameters VALUES (?, ?, ?, ?)", t)
-            return self._cursor.lastrowid
+            id_ = self._cursor.lastrowid
+        return id_
 
     def add_candidate_pparams(self, candidate_annuli, pfilter):
         """ Store a CandidateAnnuli instance into the LEMONdB.
@@ -820,6 +1558,7 @@ class LEMONdB(object):
         id_ = rows[0][0]
         t = (id_, buffer(blob))
         self._execute("INSERT OR REPLACE INTO raw_images VALUES (?, ?)", t)
+        self._photometry_changed = True
 
     def add_image(self, image, _is_sources_img = False):
         """ Store information about a FITS image in the database.
@@ -888,8 +1627,13 @@ class LEMONdB(object):
 
             self._execute("INSERT INTO images "
                           "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", t)
+            image_id = self._cursor.lastrowid
             self._release(mark)
 
+            if self._image_ids_cache is not None:
+                key = self._image_key(image.unix_time, t[2])
+                self._image_ids_cache[key] = image_id
+
         except Exception as e:
             self._rollback_to(mark)
 
@@ -917,27 +1661,38 @@ class LEMONdB(object):
             # above, so re-raise the original exception, whatever it is.
             raise e
 
+    @staticmethod
+    def _image_key(unix_time, filter_id):
+        """ Return the key of an image in LEMONdB._image_ids_cache """
+
+        # Note the cast to Python's built-in float, so that NumPy floats (such
+        # as those returned by DBStar.time) are hashed as the values that are
+        # read from the database. The sources image may have no Unix time.
+        if unix_time is not None:
+            unix_time = float(unix_time)
+        return unix_time, filter_id
+
     def _get_image_id(self, unix_time, pfilter):
         """ Return the ID of the Image with this Unix time and filter.
         Raises KeyError if there is no image for this date and filter"""
 
-        # Note the cast to Python's built-in float. Otherwise, if the method
-        # gets a NumPy float, SQLite raises "sqlite3.InterfaceError: Error
-        # binding parameter - probably unsupported type"
-        t = (float(unix_time), hash(pfilter))
-        self._execute("SELECT id "
-                      "FROM images INDEXED BY img_by_filter_time "
-                      "WHERE unix_time = ? "
-                      "  AND filter_id = ?", t)
-        rows = list(self._rows)
-        if not rows:
+        # The IMAGES table is small and rarely modified, so instead of running
+        # a query every time this method is called, all the image IDs are read
+        # into memory the first time they are needed. LEMONdB.add_image()
+        # takes care of adding to the cache the new images after that.
+        if self._image_ids_cache is None:
+            self._execute("SELECT unix_time, filter_id, id FROM images")
+            self._image_ids_cache = dict(
+                (self._image_key(unix_time, filter_id), id_)
+                for unix_time, filter_id, id_ in self._rows)
+
+        try:
+            key = self._image_key(unix_time, hash(pfilter))
+            return self._image_ids_cache[key]
+        except KeyError:
             msg = "%.4f (%s) and filter %s"
             args = unix_time, methods.utctime(unix_time), pfilter
             raise KeyError(msg % args)
-        else:
-            assert len(rows) == 1
-            assert len(rows[0]) == 1
-            return rows[0][0]
 
     def get_image(self, unix_time, pfilter):
         """ Return the Image observed at a Unix time and photometric filter.
@@ -977,13 +1732,31 @@ class LEMONdB(object):
         try:
             stmt = "INSERT INTO stars VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
             self._execute(stmt, t)
+            self._star_ids_cache = None
         except sqlite3.IntegrityError:
-            if __debug__:
-                self._execute("SELECT id FROM stars")
-                assert (star_id,) in self._rows
+            assert self._star_exists(star_id)
             msg = "star with ID = %d already in database" % star_id
             raise DuplicateStarError(msg)
 
+        self._add_star_xyz(star_id, ra, dec)
+
+    def _add_star_xyz(self, star_id, ra, dec):
+        """ Add a star to the spatial index (the STARS_XYZ R*Tree) """
+
+        x, y, z = _unit_vector(ra, dec)
+        t = (star_id, x, x, y, y, z, z)
+        self._execute("INSERT INTO stars_xyz VALUES (?, ?, ?, ?, ?, ?, ?)", t)
+
+    def _index_stars(self):
+        """ Add to the spatial index the stars that are not yet in it """
+
+        if self._table_count('stars') != self._table_count('stars_xyz'):
+            self._execute("SELECT id, ra, dec "
+                          "FROM stars "
+                          "WHERE id NOT IN (SELECT id FROM stars_xyz)")
+            for star_id, ra, dec in list(self._rows):
+                self._add_star_xyz(star_id, ra, dec)
+
     def get_star(self, star_id):
         """ Return the coordinates and magnitude of a star.
 
@@ -1016,6 +1789,37 @@ class LEMONdB(object):
         self._execute("SELECT id FROM stars ORDER BY id ASC")
         return list(x[0] for x in self._rows)
 
+    def _star_exists(self, star_id):
+        """ Return True if there is a star with this ID in the database.
+
+        Unlike LEMONdB._has_star, this method always queries the database,
+        looking up the ID in the primary key of the STARS table. It is meant
+        for those places (such as the error paths of the methods that store
+        data) where only one check is done, and after which loading the set
+        of all the star IDs into memory would not be worth it.
+
+        """
+
+        # Note the cast to Python's built-in int -- see get_photometry()
+        t = (int(star_id),)
+        self._execute("SELECT EXISTS (SELECT 1 FROM stars WHERE id = ?)", t)
+        return bool(self._rows.fetchone()[0])
+
+    def _has_star(self, star_id):
+        """ Return True if there is a star with this ID in the database.
+
+        The IDs of the stars are loaded into memory, as a set, the first time
+        the method is called, so that subsequent checks take constant time
+        instead of querying the database. This set is discarded, and loaded
+        again when needed, every time a star is added with add_star().
+
+        """
+
+        if self._star_ids_cache is None:
+            self._execute("SELECT id FROM stars")
+            self._star_ids_cache = set(x[0] for x in self._rows)
+        return star_id in self._star_ids_cache
+
     def add_pm_correction(self, star_id, unix_time, pfilter, pm_x, pm_y):
         """ Store the proper-motion corrected pixel coordinates of a star.
 
@@ -1081,7 +1885,7 @@ class LEMONdB(object):
             rows = tuple(self._rows)
             return rows[0]
         except IndexError:
-            if star_id not in self.star_ids:
+            if not self._has_star(star_id):
                 msg = "star with ID = %d not in database" % star_id
                 raise KeyError(msg)
             else:
@@ -1104,17 +1908,24 @@ class LEMONdB(object):
             # Raises KeyError if no image has this Unix time and filter
             image_id = self._get_image_id(unix_time, pfilter)
 
+            # A record already in the packed format is not detected by the
+            # UNIQUE constraint of the PHOTOMETRY table, so we look for it
+            args = [star_id], image_id, unix_time, hash(pfilter)
+            if self._packed_stars(*args):
+                raise sqlite3.IntegrityError("record already packed")
+
             # Note the casts to Python's built-in float. Otherwise, if the
             # method gets a NumPy float, SQLite raises "sqlite3.InterfaceError:
             # Error binding parameter - probably unsupported type"
             t = (None, star_id, image_id, float(magnitude), float(snr))
             self._execute("INSERT INTO photometry VALUES (?, ?, ?, ?, ?)", t)
+            self._photometry_changed = True
 
         except KeyError, e:
             raise UnknownImageError(str(e))
 
         except sqlite3.IntegrityError:
-            if not star_id in self.star_ids:
+            if not self._star_exists(star_id):
                 msg = "star with ID = %d not in database" % star_id
                 raise UnknownStarError(msg)
 
@@ -1123,6 +1934,249 @@ class LEMONdB(object):
             args = (star_id, unix_time, methods.utctime(unix_time), pfilter)
             raise DuplicatePhotometryError(msg % args)
 
+    def add_photometry_batch(self, image, records):
+        """ Store all the photometric records of stars in the same image.
+
+        This is the bulk version of LEMONdB.add_photometry, intended to be used
+        when the photometry of an entire image has to be stored: the ID of the
+        image is looked up only once, and all the records are inserted with a
+        single prepared statement. 'image' is the Image to which the records
+        belong, while 'records' is an iterable of three-element tuples with
+        the ID of the star, the magnitude and the signal-to-noise ratio.
+
+        The database is modified atomically, so in case an error is encountered
+        no record is stored. The exceptions raised are the same as those of
+        LEMONdB.add_photometry, but reported in aggregate: UnknownImageError if
+        the Unix time and photometric filter of 'image' do not match those of
+        any of the images previously added, UnknownStarError if one or more of
+        the star IDs are not in the database, and DuplicatePhotometryError if
+        one or more of the stars already have a record for this image (or if
+        the same star is listed more than once in 'records'). In the last two
+        cases, the error message lists all the offending star IDs.
+
+        """
+
+        self._add_photometry_batch(image, records)
+
+    def add_aperture_photometry_batch(self, image, pparams, records):
+        """ Store the photometric records of an image for some parameters.
+
+        This is the counterpart of LEMONdB.add_photometry_batch for the
+        photometry done with several apertures at once: the records, with
+        the same format, are associated to 'pparams', the PhotometricParameters
+        with which they were measured, and stored separately from those that
+        LEMONdB.get_photometry returns (and from which the light curves are
+        computed). Use LEMONdB.select_aperture_photometry to make the records
+        of one of the stored PhotometricParameters the photometry of the
+        LEMONdB. The exceptions raised are those of add_photometry_batch,
+        with DuplicatePhotometryError referring to the records of a star and
+        image for these same photometric parameters.
+
+        """
+
+        self._add_photometry_batch(image, records, pparams = pparams)
+
+    def _add_photometry_batch(self, image, records, pparams = None):
+        """ Store the photometric records of stars in the same image, in the
+        PHOTOMETRY table or, if 'pparams' is given, in APERTURE_PHOTOMETRY and
+        associated to these PhotometricParameters. See add_photometry_batch """
+
+        unix_time = image.unix_time
+        pfilter = image.pfilter
+
+        try:
+            # Raises KeyError if no image has this Unix time and filter
+            image_id = self._get_image_id(unix_time, pfilter)
+        except KeyError, e:
+            raise UnknownImageError(str(e))
+
+        if pparams is None:
+            table, index, key = 'photometry', 'phot_by_image', ()
+        else:
+            table, index = 'aperture_photometry', 'aper_phot_by_pparams'
+            key = (self._add_pparams(pparams),)
+
+        # Note the casts to Python's built-in types. Otherwise, if the method
+        # gets NumPy numbers, SQLite raises "sqlite3.InterfaceError: Error
+        # binding parameter - probably unsupported type"
+        rows = [(None, int(star_id), image_id) + key +
+                (float(magnitude), float(snr))
+                for star_id, magnitude, snr in records]
+
+        # Records in the packed format: see LEMONdB.add_photometry
+        packed = []
+        if pparams is None:
+            star_ids = [row[1] for row in rows]
+            args = star_ids, image_id, unix_time, hash(pfilter)
+            packed = self._packed_stars(*args)
+
+        mark = self._savepoint()
+        try:
+            if packed:
+                raise sqlite3.IntegrityError("records already packed")
+            placeholders = ', '.join(['?'] * (5 + len(key)))
+            self._executemany("INSERT INTO %s "
+                              "VALUES (%s)" % (table, placeholders), rows)
+            self._release(mark)
+            self._photometry_changed = True
+
+        except sqlite3.IntegrityError:
+            self._rollback_to(mark)
+
+            star_ids = [row[1] for row in rows]
+            unknown = sorted(id_ for id_ in set(star_ids)
+                             if not self._star_exists(id_))
+            if unknown:
+                msg = "stars with ID = %s not in database"
+                raise UnknownStarError(msg % ', '.join(map(str, unknown)))
+
+            # Stars that already have a record for this image, as well as
+            # those that appear more than once among the new records.
+            if pparams is None:
+                self._execute("SELECT star_id "
+                              "FROM photometry INDEXED BY phot_by_image "
+                              "WHERE image_id = ?", (image_id,))
+            else:
+                self._execute("SELECT star_id "
+                              "FROM aperture_photometry "
+                              "     INDEXED BY aper_phot_by_pparams "
+                              "WHERE pparams_id = ? "
+                              "  AND image_id = ?", key + (image_id,))
+            duplicates = set(x[0] for x in self._rows)
+            duplicates.update(packed)
+            counts = collections.Counter(star_ids)
+            duplicates.update(id_ for id_, n in counts.iteritems() if n > 1)
+            duplicates = sorted(duplicates.intersection(star_ids))
+
+            msg = "photometry for stars with ID = %s, Unix time = %4.f " \
+                  "(%s) and filter %s already in database"
+            args = (', '.join(map(str, duplicates)),
+                    unix_time, methods.utctime(unix_time), pfilter)
+            if pparams is not None:
+                msg += " for %s"
+                args += (pparams,)
+            raise DuplicatePhotometryError(msg % args)
+
+    @property
+    def aperture_pparams(self):
+        """ Return the PhotometricParameters with photometry for each aperture.
+
+        Return a list, sorted by the aperture radius, of the PhotometricParameters
+        for which records have been stored with add_aperture_photometry_batch,
+        and any of which can be passed to LEMONdB.select_aperture_photometry.
+
+        """
+
+        self._execute("SELECT DISTINCT pparams_id FROM aperture_photometry")
+        pparams = [self._get_pparams(x[0]) for x in list(self._rows)]
+        return sorted(pparams, key = operator.attrgetter('aperture'))
+
+    def select_aperture_photometry(self, pparams):
+        """ Make the records of some PhotometricParameters the photometry.
+
+        Replace all the photometric records of the LEMONdB (those returned by
+        LEMONdB.get_photometry, both as rows and in the packed format) with the
+        records stored, with add_aperture_photometry_batch, for 'pparams'. In
+        this manner, the light curves (with, e.g., the diffphot module) can be
+        computed for each one of the apertures measured at once, without doing
+        photometry again. Light curves already in the database, if any, are not
+        updated. The database is modified atomically, and KeyError is raised
+        if there are no records for these photometric parameters.
+
+        """
+
+        id_ = self._get_pparams_id(pparams)
+        self._execute("SELECT EXISTS (SELECT 1 "
+                      "FROM aperture_photometry "
+                      "     INDEXED BY aper_phot_by_pparams "
+                      "WHERE pparams_id = ?)", (id_,))
+        if not self._rows.fetchone()[0]:
+            msg = "no aperture photometry for %s" % (pparams,)
+            raise KeyError(msg)
+
+        mark = self._savepoint()
+        try:
+            self._execute("DELETE FROM packed_photometry")
+            self._execute("DELETE FROM photometry")
+            self._execute("INSERT INTO photometry "
+                          "SELECT NULL, star_id, image_id, magnitude, snr "
+                          "FROM aperture_photometry "
+                          "     INDEXED BY aper_phot_by_pparams "
+                          "WHERE pparams_id = ?", (id_,))
+            self._release(mark)
+            self._photometry_changed = True
+        except:
+            self._rollback_to(mark)
+            raise
+
+    def _get_packed(self, table, star_id, filter_id):
+        """ Return the packed records of a star in a photometric filter.
+
+        Return the (3 x N) NumPy array, as returned by _unpack_records, stored
+        in 'table' (PACKED_PHOTOMETRY or PACKED_LIGHT_CURVES) for the star with
+        ID 'star_id' in the photometric filter with ID 'filter_id' -- i.e., the
+        hash of the Passband. If there is no such row, None is returned.
+
+        """
+
+        t = (int(star_id), filter_id)
+        self._execute("SELECT records "
+                      "FROM %s "
+                      "WHERE star_id = ? AND filter_id = ?" % table, t)
+        row = self._rows.fetchone()
+        return None if row is None else _unpack_records(row[0])
+
+    def _packed_stars(self, star_ids, image_id, unix_time, filter_id):
+        """ Return the stars that have a packed photometric record in an image.
+
+        Return a list with the IDs, among those in 'star_ids', of the stars
+        that have a record at 'unix_time' in the PACKED_PHOTOMETRY table, for
+        the photometric filter with ID 'filter_id' (see LEMONdB._get_packed).
+        Only the images already stored the last time the LEMONdB was packed
+        can have records in the packed format: those with an ID not greater
+        than the PACKED_IMAGE_ID record of the METADATA table, set by the
+        method LEMONdB.pack. For any other 'image_id', by far the most common
+        case, an empty list is returned without reading any BLOB.
+
+        """
+
+        try:
+            if image_id > self._get_metadata('PACKED_IMAGE_ID'):
+                return []
+        except AttributeError:  # never packed, or unpacked since then
+            return []
+
+        found = []
+        for star_id in star_ids:
+            packed = self._get_packed('packed_photometry', star_id, filter_id)
+            if packed is None:
+                continue
+            # The packed records are chronologically sorted
+            index = numpy.searchsorted(packed[0], unix_time)
+            if index < packed.shape[1] and packed[0, index] == unix_time:
+                found.append(star_id)
+        return found
+
+    @staticmethod
+    def _merge_records(packed, rows):
+        """ Combine packed records with (Unix time, magnitude, SNR) rows.
+
+        Return a (3 x N) float64 NumPy array with the records in 'packed' (as
+        returned by LEMONdB._get_packed, or None) and those in 'rows', which
+        are usually those read from the PHOTOMETRY or LIGHT_CURVES tables. The
+        records are chronologically sorted; a None SNR is converted to NaN.
+
+        """
+
+        if packed is None:
+            packed = numpy.empty((3, 0), dtype = _PACKED_DTYPE)
+        if not rows:
+            return packed
+
+        rows = numpy.array(rows, dtype = _PACKED_DTYPE).T
+        data = numpy.hstack((packed, rows))
+        return data[:, numpy.argsort(data[0], kind = 'mergesort')]
+
     def get_photometry(self, star_id, pfilter):
         """ Return the photometric information of the star.
 
@@ -1133,7 +2187,7 @@ class LEMONdB(object):
 
         """
 
-        if star_id not in self.star_ids:
+        if not self._has_star(star_id):
             msg = "star with ID = %d not in database" % star_id
             raise KeyError(msg)
 
@@ -1148,9 +2202,78 @@ class LEMONdB(object):
                       "WHERE phot.star_id = ? "
                       "  AND img.filter_id = ? "
                       "ORDER BY img.unix_time ASC", t)
+        rows = list(self._rows)
 
-        args = star_id, pfilter, list(self._rows)
-        return DBStar.make_star(*args, dtype = self.dtype)
+        packed = self._get_packed('packed_photometry', *t)
+        if packed is None:
+            args = star_id, pfilter, rows
+            return DBStar.make_star(*args, dtype = self.dtype)
+
+        # The records in the packed format are already a (3 x N) array, which
+        # is exactly what DBStar needs, so there is no need to loop over them.
+        # They are also chronologically sorted by LEMONdB._merge_records.
+        data = self._merge_records(packed, rows)
+        times_order = numpy.arange(data.shape[1])
+        phot_info = data.astype(self.dtype)
+        return DBStar(star_id, pfilter, phot_info, times_order, dtype = self.dtype)
+
+    def get_photometry_matrix(self, pfilter):
+        """ Return the photometric information of all the stars in a filter.
+
+        The method returns a PhotometryMatrix instance with the photometric
+        information, in the 'pfilter' photometric filter, of all the stars in
+        the LEMONdB. Unlike LEMONdB.get_photometry, which is invoked once per
+        star, all the records are read with a single query and converted to
+        (stars x images) NumPy arrays in bulk, with no per-record Python loops.
+        Stars with no photometric records in this filter are also included in
+        the matrix, with all their values masked out. The Unix times are those
+        of the images in this filter for which there is at least one record.
+
+        """
+
+        t = (hash(pfilter),)
+        self._execute("SELECT phot.star_id, img.unix_time, "
+                      "       phot.magnitude, phot.snr "
+                      "FROM photometry AS phot, "
+                      "     images AS img INDEXED BY img_by_filter_time "
+                      "ON phot.image_id = img.id "
+                      "WHERE img.filter_id = ?", t)
+
+        rows = list(self._rows)
+        values = itertools.chain.from_iterable(rows)
+        data = numpy.fromiter(values, dtype = numpy.float64, count = 4 * len(rows))
+        data = data.reshape((len(rows), 4))
+
+        # Add the records in the packed format, if any, as more rows
+        self._execute("SELECT star_id, records "
+                      "FROM packed_photometry "
+                      "WHERE filter_id = ?", t)
+        chunks = [data]
+        for star_id, blob in self._rows:
+            packed = _unpack_records(blob)
+            ids = numpy.empty((1, packed.shape[1]), dtype = numpy.float64)
+            ids.fill(star_id)
+            chunks.append(numpy.vstack((ids, packed)).T)
+        data = numpy.concatenate(chunks)
+
+        star_ids = numpy.array(self.star_ids, dtype = numpy.int64)
+        unix_times = numpy.unique(data[:, 1])
+        star_indexes = numpy.searchsorted(star_ids, data[:, 0])
+        time_indexes = numpy.searchsorted(unix_times, data[:, 1])
+
+        shape = (len(star_ids), len(unix_times))
+        magnitudes = numpy.empty(shape, dtype = self.dtype)
+        magnitudes.fill(numpy.nan)
+        snrs = magnitudes.copy()
+        mask = numpy.zeros(shape, dtype = numpy.bool_)
+
+        magnitudes[star_indexes, time_indexes] = data[:, 2]
+        snrs[star_indexes, time_indexes] = data[:, 3]
+        mask[star_indexes, time_indexes] = True
+
+        args = (pfilter, star_ids, unix_times.astype(self.dtype),
+                magnitudes, snrs, mask)
+        return PhotometryMatrix(*args)
 
     def _star_pfilters(self, star_id):
         """ Return the photometric filters for which the star has data.
@@ -1162,11 +2285,11 @@ class LEMONdB(object):
 
         """
 
-        if star_id not in self.star_ids:
+        if not self._has_star(star_id):
             msg = "star with ID = %d not in database" % star_id
             raise KeyError(msg)
 
-        t = (star_id, )
+        t = (star_id, star_id)
         self._execute("""SELECT DISTINCT f.name
                          FROM (SELECT DISTINCT image_id
                                FROM photometry INDEXED BY phot_by_star_image
@@ -1174,7 +2297,13 @@ class LEMONdB(object):
                          INNER JOIN images AS img
                          ON phot.image_id = img.id
                          INNER JOIN photometric_filters AS f
-                         ON img.filter_id = f.id """, t)
+                         ON img.filter_id = f.id
+                         UNION
+                         SELECT f.name
+                         FROM packed_photometry AS packed
+                         INNER JOIN photometric_filters AS f
+                         ON packed.filter_id = f.id
+                         WHERE packed.star_id = ? """, t)
 
         return sorted(passband.Passband(x[0]) for x in self._rows)
 
@@ -1197,7 +2326,13 @@ class LEMONdB(object):
                          INNER JOIN images AS img
                          ON phot.image_id = img.id
                          INNER JOIN photometric_filters AS f
-                         ON img.filter_id = f.id """)
+                         ON img.filter_id = f.id
+                         UNION
+                         SELECT f.name
+                         FROM (SELECT DISTINCT filter_id
+                               FROM packed_photometry) AS packed
+                         INNER JOIN photometric_filters AS f
+                         ON packed.filter_id = f.id """)
 
         return sorted(passband.Passband(x[0]) for x in self._rows)
 
@@ -1229,7 +2364,7 @@ class LEMONdB(object):
             raise UnknownImageError(str(e))
 
         except sqlite3.IntegrityError:
-            if not star_id in self.star_ids:
+            if not self._star_exists(star_id):
                 msg = "star with ID = %d not in database" % star_id
                 raise UnknownStarError(msg)
 
@@ -1272,7 +2407,7 @@ class LEMONdB(object):
 
         except sqlite3.IntegrityError:
             self._rollback_to(mark)
-            if star_id not in self.star_ids:
+            if not self._star_exists(star_id):
                 msg = "star with ID = %d not in database" % star_id
                 raise UnknownStarError(msg)
             else:
@@ -1314,11 +2449,132 @@ class LEMONdB(object):
                 self._add_curve_point(*args)
             for weight in light_curve.weights():
                 self._add_cmp_star(star_id, light_curve.pfilter, *weight)
+            self._add_curve_stats(star_id, light_curve)
             self._release(mark)
         except:
             self._rollback_to(mark)
             raise
 
+    @staticmethod
+    def _curve_stats(light_curve):
+        """ Return the CurveStats of a LightCurve, which must not be empty """
+
+        unix_times = light_curve.unix_times
+        magnitudes = light_curve.magnitudes
+        snrs = light_curve.snrs
+        snrs = snrs[~numpy.isnan(snrs)] # None SNRs are stored as NaN
+        median_snr = float(numpy.median(snrs)) if len(snrs) else None
+
+        return CurveStats(len(light_curve),
+                          float(numpy.mean(magnitudes)),
+                          float(light_curve.stdev),
+                          float(light_curve.amplitude()),
+                          float(unix_times[0]),
+                          float(unix_times[-1]),
+                          median_snr)
+
+    def _add_curve_stats(self, star_id, light_curve):
+        """ Store in the CURVE_STATS table the statistics of a light curve """
+
+        if not light_curve:
+            return
+        stats = self._curve_stats(light_curve)
+        t = (int(star_id), hash(light_curve.pfilter)) + tuple(stats)
+        self._execute("INSERT OR REPLACE INTO curve_stats "
+                      "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", t)
+
+    def _missing_curve_stats(self, pfilter):
+        """ Compute the statistics of the curves not in CURVE_STATS.
+
+        Databases created before the CURVE_STATS table was introduced have
+        light curves whose statistics have never been computed. Find those in
+        the 'pfilter' photometric filter, read each one of them with
+        LEMONdB.get_light_curve, and return a dictionary which maps the ID of
+        each star to the CurveStats of its light curve. These statistics are
+        not stored, so that reading from the LEMONdB never modifies it.
+
+        """
+
+        t = (hash(pfilter),) * 2
+        self._execute("""SELECT DISTINCT curve.star_id
+                         FROM light_curves AS curve
+                         INNER JOIN images AS img
+                         ON curve.image_id = img.id
+                         WHERE img.filter_id = ?
+                           AND NOT EXISTS (SELECT 1 FROM curve_stats AS s
+                                           WHERE s.star_id = curve.star_id
+                                             AND s.filter_id = img.filter_id)
+                         UNION
+                         SELECT packed.star_id
+                         FROM packed_light_curves AS packed
+                         WHERE packed.filter_id = ?
+                           AND NOT EXISTS (SELECT 1 FROM curve_stats AS s
+                                           WHERE s.star_id = packed.star_id
+                                             AND s.filter_id = packed.filter_id)
+                         """, t)
+
+        stats = {}
+        for (star_id,) in list(self._rows):
+            curve = self.get_light_curve(star_id, pfilter)
+            stats[star_id] = self._curve_stats(curve)
+        return stats
+
+    def get_curve_stats(self, star_id, pfilter):
+        """ Return the summary statistics of the light curve of a star.
+
+        The method returns a CurveStats namedtuple with the number of points
+        of the light curve of the star in a photometric filter, the mean and
+        standard deviation of its differential magnitudes, its peak-to-peak
+        amplitude, the Unix times of its first and last points and the median
+        of their signal-to-noise ratios. These values are read from the
+        CURVE_STATS table, so the light curve itself is not loaded -- unless
+        it was stored by an older version of LEMON, in which case they are
+        computed from the light curve, but not stored. Raises KeyError is no
+        star in the database has the specified ID, while, if the star exists
+        but has no light curve in this photometric filter, None is returned.
+
+        """
+
+        t = (int(star_id), hash(pfilter))
+        self._execute("SELECT npoints, mean, stdev, amplitude, "
+                      "       min_time, max_time, median_snr "
+                      "FROM curve_stats "
+                      "WHERE star_id = ? AND filter_id = ?", t)
+        row = self._rows.fetchone()
+        if row is not None:
+            return CurveStats(*row)
+
+        if not self._has_star(star_id):
+            msg = "star with ID = %d not in database" % star_id
+            raise KeyError(msg)
+
+        # The statistics of a curve stored by an older version of LEMON
+        curve = self.get_light_curve(star_id, pfilter)
+        if curve is None:
+            return None
+        return self._curve_stats(curve)
+
+    def get_curves_stats(self, pfilter):
+        """ Return the summary statistics of all the curves in a filter.
+
+        The method returns a dictionary which maps the ID of each star with a
+        light curve in the 'pfilter' photometric filter to the CurveStats of
+        that curve (see LEMONdB.get_curve_stats). All of them are read with a
+        single query, so this is the way to go when the statistics of the
+        light curves of many stars are needed. If there are no light curves
+        in this photometric filter, an empty dictionary is returned.
+
+        """
+
+        t = (hash(pfilter),)
+        self._execute("SELECT star_id, npoints, mean, stdev, amplitude, "
+                      "       min_time, max_time, median_snr "
+                      "FROM curve_stats "
+                      "WHERE filter_id = ?", t)
+        stats = dict((row[0], CurveStats(*row[1:])) for row in self._rows)
+        stats.update(self._missing_curve_stats(pfilter))
+        return stats
+
     def get_light_curve(self, star_id, pfilter):
         """ Return the light curve of a star.
 
@@ -1350,7 +2606,12 @@ class LEMONdB(object):
                       "ORDER BY img.unix_time ASC", t)
         curve_points = list(self._rows)
 
-        if curve_points:
+        # A (3 x N) array, which we can add to the LightCurve in bulk. Both
+        # the packed format and the LightCurve class store None SNRs as NaN.
+        packed = self._get_packed('packed_light_curves', *t)
+        curve_points = self._merge_records(packed, curve_points)
+
+        if curve_points.shape[1]:
             # ... as well as the comparison stars.
             self._execute("SELECT cstar_id, weight, stdev "
                           "FROM cmp_stars INDEXED BY cstars_by_star_filter "
@@ -1367,7 +2628,7 @@ class LEMONdB(object):
                 cstars, cweights, cstdevs = zip(*rows)
 
         else:
-            if star_id not in self.star_ids:
+            if not self._has_star(star_id):
                 msg = err_msg + "not in database"
                 raise KeyError(msg)
 
@@ -1375,10 +2636,147 @@ class LEMONdB(object):
             return None
 
         curve = LightCurve(pfilter, cstars, cweights, cstdevs, dtype = self.dtype)
-        for point in curve_points:
-            curve.add(*point)
+        curve.extend(*curve_points)
         return curve
 
+    def pack(self):
+        """ Store the photometry and light curves in the packed format.
+
+        Move all the records in the PHOTOMETRY and LIGHT_CURVES tables, which
+        store one row per star and image, to PACKED_PHOTOMETRY and
+        PACKED_LIGHT_CURVES, respectively. In these tables there is a single
+        row per star and photometric filter, with all its records packed into
+        a BLOB of float64 values. This shrinks the database several-fold, as
+        there are no longer per-record IDs and indexes, and makes reading the
+        photometry or light curve of a star a single BLOB fetch that is
+        decoded with numpy.frombuffer(), with no per-record loops. All the
+        other methods of LEMONdB work transparently with both formats, even
+        if they are mixed: records added after the database is packed are
+        stored as rows, until this method is called again.
+
+        The packed records are identified by their Unix time, not by the ID of
+        the image, so the UNIQUE constraint of the PHOTOMETRY table can no
+        longer detect that a star has more than one record for the same image.
+        Instead, LEMONdB.add_photometry (and add_photometry_batch) look for
+        the Unix time of the image in the packed records of the stars, but
+        only if the image was already stored when the LEMONdB was packed. In
+        addition, sqlite3.IntegrityError is raised, and the database left
+        untouched, if a duplicate record is found when packing. Changes are
+        committed automatically, and the database is then rebuilt with the
+        VACUUM command in order to return the space no longer used to the
+        operating system.
+        If the LEMONdB is linked to another one (see LEMONdB.link_photometry),
+        only the light curves are packed, and the same goes for unpack().
+
+        """
+
+        tables = [('photometry', 'packed_photometry'),
+                  ('light_curves', 'packed_light_curves')]
+        # The photometry of a linked LEMONdB is stored in the other database
+        if self._linked:
+            del tables[0]
+
+        mark = self._savepoint()
+        try:
+            for rows_table, packed_table in tables:
+
+                # The rows are read from a dedicated cursor, one star and
+                # photometric filter at a time, instead of loading the entire
+                # table into memory; the packed records are read and stored
+                # through the main cursor meanwhile.
+                rows = self.connection.cursor()
+                rows.execute("SELECT t.star_id, img.filter_id, "
+                             "       img.unix_time, t.magnitude, t.snr "
+                             "FROM %s AS t "
+                             "INNER JOIN images AS img "
+                             "ON t.image_id = img.id "
+                             "ORDER BY t.star_id, img.filter_id" % rows_table)
+
+                key = operator.itemgetter(0, 1)
+                for (star_id, filter_id), group in itertools.groupby(rows, key):
+                    records = [x[2:] for x in group]
+                    packed = self._get_packed(packed_table, star_id, filter_id)
+                    data = self._merge_records(packed, records)
+                    try:
+                        blob = _pack_records(data)
+                    except ValueError, e:
+                        msg = "star with ID = %d in filter ID = %d: %s"
+                        raise sqlite3.IntegrityError(msg % (star_id, filter_id, e))
+
+                    t = (star_id, filter_id, blob)
+                    self._execute("INSERT OR REPLACE INTO %s "
+                                  "VALUES (?, ?, ?)" % packed_table, t)
+
+                rows.close()
+                self._execute("DELETE FROM %s" % rows_table)
+
+            # The images that may have records in the packed format: those
+            # already stored now (see LEMONdB._packed_stars)
+            if not self._linked:
+                self._execute("SELECT IFNULL(MAX(id), 0) FROM images")
+                self._set_metadata('PACKED_IMAGE_ID', self._rows.fetchone()[0])
+                self._photometry_changed = True
+            self._release(mark)
+
+        except:
+            self._rollback_to(mark)
+            raise
+
+        self.commit()
+        # VACUUM cannot be run from within a transaction
+        self._end()
+        self._execute("VACUUM")
+        self._start()
+
+    def unpack(self):
+        """ Store the packed photometry and light curves as rows again.
+
+        The inverse of LEMONdB.pack: move all the records in the packed format
+        back to the PHOTOMETRY and LIGHT_CURVES tables, with one row per star
+        and image. This may be needed by tools that query these tables directly
+        instead of using this class. Each record is stored with the same method
+        that adds it as a row, so the exceptions that may be raised are those of
+        LEMONdB.add_photometry and LEMONdB._add_curve_point (for example,
+        UnknownImageError if a Unix time does not match that of any image).
+        The database is modified atomically, so in case an error is encountered
+        it is left untouched.
+
+        """
+
+        tables = [('packed_photometry', self.add_photometry),
+                  ('packed_light_curves', self._add_curve_point)]
+        if self._linked:
+            del tables[0]
+
+        mark = self._savepoint()
+        try:
+            # No record will be in the packed format: the records added back
+            # as rows must not be looked for in it (see LEMONdB._packed_stars)
+            if not self._linked:
+                self._execute("DELETE FROM metadata "
+                              "WHERE key = 'PACKED_IMAGE_ID'")
+            for packed_table, add_record in tables:
+                # As in LEMONdB.pack, read the blobs one at a time from a
+                # dedicated cursor, as add_record uses the main one.
+                rows = self.connection.cursor()
+                rows.execute("SELECT packed.star_id, f.name, packed.records "
+                             "FROM %s AS packed "
+                             "INNER JOIN photometric_filters AS f "
+                             "ON packed.filter_id = f.id" % packed_table)
+
+                for star_id, name, blob in rows:
+                    pfilter = passband.Passband(name)
+                    for record in _unpack_records(blob).T.tolist():
+                        add_record(star_id, record[0], pfilter, *record[1:])
+
+                rows.close()
+                self._execute("DELETE FROM %s" % packed_table)
+            self._release(mark)
+
+        except:
+            self._rollback_to(mark)
+            raise
+
     def get_instrumental_magnitudes(self, star_id, pfilter):
         """ Return the instrumental magnitudes of an astronomical object.
 
@@ -1400,8 +2798,14 @@ class LEMONdB(object):
                             i.filter_id = ?
                       """, t)
 
+        rows = list(self._rows)
+
+        packed = self._get_packed('packed_photometry', *t)
+        if packed is not None:
+            rows.extend(packed.T.tolist())
+
         cls = collections.namedtuple('InstrumentalMagnitude', "magnitude snr")
-        return dict((r[0], cls(*r[1:])) for r in self._rows)
+        return dict((r[0], cls(*r[1:])) for r in rows)
 
     def airmasses(self, pfilter):
         """ Return the airmasses of the images in a photometric filter.
@@ -1451,29 +2855,18 @@ class LEMONdB(object):
                            curve.cstdevs,
                            dtype = curve.dtype)
 
-        unix_times, magnitudes, snrs = zip(*curve)
-        zero_t = min(unix_times)
-
-        phased_x = []
-        for utime, mag, snr in zip(unix_times, magnitudes, snrs):
-            # How far into the cycle is this Unix time?
-            fractional_part = math.modf((utime - zero_t) / period)[0]
-            phased_x.append(fractional_part)
-        assert len(phased_x) == len(unix_times)
+        unix_times = curve.unix_times
+        zero_t = unix_times[0]
 
-        x_max = 1;
-        phased_unix_times = phased_x[:]
-        for _ in xrange(repeat - 1): # -1 as there is already one (phased_x)
-            phased_unix_times += [utime + x_max for utime in phased_x]
-            x_max += 1;
+        # How far into the cycle is each Unix time?
+        phased_x = numpy.modf((unix_times - zero_t) / period)[0]
 
-        assert len(phased_unix_times) == len(unix_times) * repeat
-        phased_magnitudes = magnitudes * repeat
-        phased_snr = snrs * repeat
-
-        for utime, mag, snr in \
-            zip(phased_unix_times, phased_magnitudes, phased_snr):
-                phase.add(utime, mag, snr)
+        # The cycle is repeated by adding 1, 2, ..., repeat - 1 to phased_x
+        offsets = numpy.repeat(numpy.arange(repeat), len(phased_x))
+        phased_unix_times = numpy.tile(phased_x, repeat) + offsets
+        phased_magnitudes = numpy.tile(curve.magnitudes, repeat)
+        phased_snrs = numpy.tile(curve.snrs, repeat)
+        phase.extend(phased_unix_times, phased_magnitudes, phased_snrs)
 
         assert len(phase) == len(curve) * repeat
         return phase
@@ -1502,7 +2895,7 @@ class LEMONdB(object):
         rmag = self.get_star(star_id)[-1]
         magnitudes.sort(key = lambda x: abs(rmag - x[1]))
         for id_, imag in magnitudes:
-            if self.get_light_curve(id_, pfilter):
+            if self.get_curve_stats(id_, pfilter) is not None:
                 yield id_, imag
 
     @property
@@ -1636,33 +3029,70 @@ class LEMONdB(object):
         os.close(fd)
         return path
 
+    def stars_within(self, ra, dec, radius):
+        """ Find the stars within a radius of a right ascension and declination.
+
+        Return a list of two-element tuples, with the ID of each star whose
+        angular distance to the specified coordinates (ra, dec) is less than
+        or equal to 'radius' and the distance itself, sorted by increasing
+        distance. All the values are given in degrees. The spatial index of
+        the stars is used so that only the candidates whose Cartesian
+        coordinates fall within the cube that circumscribes the cone are
+        examined, instead of computing the distance to all the stars.
+
+        """
+
+        if radius < 0:
+            raise ValueError("'radius' must be a non-negative number")
+
+        # The chord length, on the unit sphere, subtended by the radius. Any
+        # star within the cone is at an Euclidean distance of at most 'chord'
+        # from the center, so it must be inside the cube of side 2 * chord.
+        radius = min(radius, 180)
+        chord = 2 * math.sin(math.radians(radius) / 2)
+        x, y, z = _unit_vector(ra, dec)
+        t = (x - chord, x + chord, y - chord, y + chord, z - chord, z + chord)
+        self._execute("SELECT s.id, s.ra, s.dec "
+                      "FROM stars_xyz AS r, stars AS s "
+                      "ON r.id = s.id "
+                      "WHERE r.max_x >= ? AND r.min_x <= ? "
+                      "  AND r.max_y >= ? AND r.min_y <= ? "
+                      "  AND r.max_z >= ? AND r.min_z <= ? ", t)
+
+        rows = list(self._rows)
+        if not rows:
+            return []
+
+        star_ids, stars_ra, stars_dec = zip(*rows)
+        distances = _angular_distance(ra, dec, numpy.array(stars_ra),
+                                      numpy.array(stars_dec))
+        return sorted(((id_, float(distance))
+                       for id_, distance in zip(star_ids, distances)
+                       if distance <= radius), key = operator.itemgetter(1))
+
     def star_closest_to_world_coords(self, ra, dec):
         """ Find the star closest to a right ascension and declination.
 
-        Compute the angular distance from the right ascension and declination
-        of each star in the LEMONdB to the specified coordinates (ra, dec).
         Returns a two-element tuple containing the ID of the closest star to
-        these coordinates and its angular distance, in degrees, respectively.
-        Raises ValueError if there are no stars in the LEMONdB.
+        these coordinates (ra, dec) and its angular distance, in degrees,
+        respectively. Raises ValueError if there are no stars in the LEMONdB.
+
+        The stars are searched for with LEMONdB.stars_within, in a radius that
+        starts at one arcsecond and is doubled until at least one star is
+        found. The closest star is then guaranteed to be among them, since any
+        star closer than it would also be within the radius.
 
         """
 
         if not len(self):
             raise ValueError("database is empty")
 
-        self._execute("SELECT id, ra, dec FROM stars")
-
-        closest_id = None
-        closest_distance = float('inf')
-        coordinates = astromatic.Coordinates(ra, dec)
-        for star_id, star_ra, star_dec in self._rows:
-            star_coords = astromatic.Coordinates(star_ra, star_dec)
-            star_distance = coordinates.distance(star_coords)
-            if star_distance < closest_distance:
-                closest_id = star_id
-                closest_distance = star_distance
-
-        return closest_id, closest_distance
+        radius = 1 / 3600
+        while True:
+            stars = self.stars_within(ra, dec, radius)
+            if stars:
+                return stars[0]
+            radius *= 2
 
 def _add_metadata_property(name):
     """ Dynamically add a property to the LEMONdB class.
@@ -1693,5 +3123,9 @@ _add_metadata_property('DATE')     # date of creation of the LEMONdB
 _add_metadata_property('AUTHOR')   # who ran LEMON to create the LEMONdB
 _add_metadata_property('HOSTNAME') # where the LEMONdB was created
 _add_metadata_property('ID')       # unique identifier of the LEMONdB
+_add_metadata_property('APPEND_DATE')     # last time photometry was appended
+_add_metadata_property('APPEND_AUTHOR')   # who appended it
+_add_metadata_property('APPEND_HOSTNAME') # where it was appended
+_add_metadata_property('DIFFPHOT_OPTIONS') # JSON, light curves options
 _add_metadata_property('VMIN')     # values for the log scale (APLpy)
 _add_metadata_property('VMAX')
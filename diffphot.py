@@ -43,6 +43,7 @@ that the former is brighter than the latter.
 """
 
 import copy
+import json
 import logging
 import optparse
 import os
@@ -224,11 +225,9 @@ class StarSet(object):
             self.pfilter = star.pfilter
             self._unix_times = star._unix_times
 
-            # A cache, mapping each Unix time to its index in phot_info; passed
-            # to the constructor of DBStar for O(1) lookups of Unix times
-            self._times_indexes = {}
-            for time_index, unix_time in enumerate(self._unix_times):
-                self._times_indexes[unix_time] = time_index
+            # The indexes that sort the Unix times chronologically; passed to
+            # the constructor of DBStar so that it does not have to sort them
+            self._times_order = star._times_order
 
             # Three-dimensional array: first dimension maps to the star; second
             # to the type of info (index 0 for mag, 1 for SNR) and third to the
@@ -245,9 +244,8 @@ class StarSet(object):
             if star.id in self.star_ids:
                 raise ValueError("star with ID = %d already in the set" % star.id)
 
-            for unix_time in self._unix_times:
-                if unix_time not in star._time_indexes:
-                    raise ValueError("stars must have info for the same Unix times")
+            if not star._has_times(self._unix_times):
+                raise ValueError("stars must have info for the same Unix times")
 
             self._star_ids.append(star.id)
             self._phot_info[index] = star._phot_info[1:]
@@ -299,6 +297,25 @@ class StarSet(object):
         del self._star_ids[index]
         assert len(self.star_ids) == len(self), "%d vs %d" % (len(self.star_ids), len(self))
 
+    def _subset(self, indexes):
+        """ Return a new StarSet with the stars at the given indexes.
+
+        The new StarSet shares the Unix times with this one, so the DBStars do
+        not have to be parsed again (see StarSet._add), and only the rows of
+        the stars in 'indexes' are copied from the internal array, which is
+        therefore not modified. The stars are kept in the order of 'indexes'.
+
+        """
+
+        set_ = object.__new__(StarSet)
+        set_.dtype = self.dtype
+        set_.pfilter = self.pfilter
+        set_._unix_times = self._unix_times
+        set_._times_order = self._times_order
+        set_._star_ids = [self._star_ids[x] for x in indexes]
+        set_._phot_info = self._phot_info[indexes]
+        return set_
+
     def __getitem__(self, index):
         """ Return the index-th star as a DBStar instance """
 
@@ -313,7 +330,7 @@ class StarSet(object):
 
         id_ = self._star_ids[index]
         return database.DBStar(id_, self.pfilter, sphot_info,
-                               self._times_indexes, self.dtype)
+                               self._times_order, self.dtype)
 
     def flux_proportional_weights(self):
         """ Return the Weights proportional to the flux of each star.
@@ -363,7 +380,7 @@ class StarSet(object):
         pogsonr = 100 ** 0.2  # fifth root of 100 (Pogson's Ratio)
         return Weights.inversely_proportional(pogsonr ** mag_medians)
 
-    def light_curve(self, weights, star, no_snr = False, _exclude_index = None):
+    def light_curve(self, weights, star, _exclude_index = None):
         """ Generate the light curve of a DBStar.
 
         Use the stars in the set to compute an artificial comparison star,
@@ -385,25 +402,20 @@ class StarSet(object):
         returned by the DBStar.complete_for method, which identifies precisely
         the DBStars that can be used as the artificial comparison star.
 
-        The calculation of the signal-to-noise ratio of each differential
-        magnitude is, being currently written in pure Python, considerably
-        slow. It is barely noticeable when a few conversions from SNR to error
-        in magnitudes (or vice versa) are done, but when invoked thousands of
-        times it causes an unbearable performance hit. Until the 'snr' module
-        is rewritten in C, the 'no_snr' keyword argument, if set to True, will
-        make the method skip the calculation of the differential SNRs, using
-        None instead. This is probably only needed by StarSet.broeg_weights,
-        which does not care about the signal-to-noise ratios, but only the
-        standard deviation of the light curves, and can therefore avoid
-        computing them.
+        The differential magnitudes and signal-to-noise ratios of all the
+        points of the light curve are computed at once, working with the
+        (stars x images) matrices of magnitudes and SNRs, as the functions in
+        the 'snr' module accept NumPy arrays, so there is no need to skip the
+        calculation of the differential SNRs when only the magnitudes of the
+        light curve are needed.
 
         If specified, the '_exclude_index' argument determines the index of the
         star in the set that will not be used as comparison star, regardless of
         its weight. It is equivalent to setting the index-th coefficient to
-        zero and then rescaling the weights. This parameter is here (and most
-        probably only needed) because of the method StarSet.broeg_weights,
-        which computes the light curve of each one of the stars in the set
-        using all the others as comparison.
+        zero and then rescaling the weights. This parameter was added for the
+        method StarSet.broeg_weights, which computes the light curve of each
+        one of the stars in the set using all the others as comparison, even
+        though it now does that directly from the matrix of magnitudes.
 
         """
 
@@ -438,23 +450,19 @@ class StarSet(object):
         args = self.pfilter, self.star_ids, rweights, cstdevs
         curve = database.LightCurve(*args, dtype = self.dtype)
 
-        for index, unix_time in enumerate(self._unix_times):
-            # The magnitude and SNR of the comparison star
-            cmags = self._phot_info[:, 0, index]
-            csnrs = self._phot_info[:, 1, index]
-            cmag = numpy.average(cmags, weights = rweights)
-            csnr = None if no_snr else snr.mean_snr(csnrs, weights = rweights)
-
-            smag = star.mag(index)
-            ssnr = star.snr(index)
-
-            dmag = smag - cmag
-            dsnr = None if no_snr else snr.difference_snr(ssnr, csnr)
-            curve.add(unix_time, dmag, dsnr)
+        # The magnitudes and SNRs of the comparison star, in all the images
+        coeffs = numpy.asarray(rweights)
+        cmags = numpy.average(self._phot_info[:, 0, :], axis = 0,
+                              weights = coeffs)
+        csnrs = snr.mean_snr(self._phot_info[:, 1, :], weights = coeffs)
+        dsnrs = snr.difference_snr(star._phot_info[2], csnrs)
 
+        dmags = star._phot_info[1] - cmags
+        curve.extend(self._unix_times, dmags, dsnrs)
         return curve
 
-    def broeg_weights(self, pct = 0.01, max_iters = None, minimum = None):
+    def broeg_weights(self, pct = 0.01, max_iters = None, minimum = None,
+                      initial = None):
         """ Determine the weights that give the optimum comparison star.
 
         This is our implementation of C. Broeg's algorithm ('A new algorithm
@@ -510,6 +518,11 @@ class StarSet(object):
                    when calculating the percentage change between two Weights;
                    used in order to prevent scientifically-insignificant values
                    from making the algorithm stop or iterate more than needed.
+        - initial: the weights with which the first series of light curves is
+                   computed, instead of the flux-proportional ones. Starting
+                   from weights already close to the optimum (for example,
+                   those found for a superset of these stars, as StarSet.best
+                   does) saves most of the iterations.
 
         """
 
@@ -526,25 +539,58 @@ class StarSet(object):
         if len(self) == 2:
             return Weights([0.5, 0.5])
 
-        if self.nimages < 2:
-            raise ValueError("at least two images are needed")
+        if initial is None:
+            initial = self.flux_proportional_weights()
+        elif len(initial) != len(self):
+            msg = "number of initial weights must match that of stars"
+            raise ValueError(msg)
+
+        mags = self._phot_info[:, 0, :]
+        return self._broeg_iterations(mags, initial, pct, max_iters, minimum,
+                                      dtype = self.dtype)
+
+    @staticmethod
+    def _broeg_iterations(mags, initial, pct, max_iters, minimum,
+                          dtype = numpy.longdouble):
+        """ Run Broeg's algorithm on a (stars x images) matrix of magnitudes.
 
-        # Initial weights are inversely proportional to the magnitude of each
-        # star. Then, the differential magnitude of each comparison star is
-        # calculated with respect to the others using the same (rescaled)
-        # weights. The standard deviation of the light curve that results from
-        # using these (rescaled) weights is used in order to compute the new
-        # weights for each star. We stop when the absolute percent change
-        # between the old weights and the new one is below the threshold
+        This is the actual implementation of StarSet.broeg_weights, starting
+        from the 'initial' weights, which works directly with the matrix of
+        magnitudes of the stars. In this manner, StarSet.best can determine
+        the weights of the stars not yet discarded without having to build a
+        StarSet for them. At least three stars are expected.
 
-        weights = [self.flux_proportional_weights()]
-        curves_stdevs = numpy.empty(len(self), dtype = self.dtype)
+        """
+
+        if mags.shape[1] < 2:
+            raise ValueError("at least two images are needed")
+
+        # Initial weights are, unless others were given, inversely
+        # proportional to the magnitude of each star. Then, the differential
+        # magnitude of each comparison star is calculated with respect to the
+        # others using the same (rescaled) weights. The standard deviation of
+        # the light curve that results from using these (rescaled) weights is
+        # used in order to compute the new weights for each star. We stop when
+        # the absolute percent change between the old weights and the new one
+        # is below the threshold.
+        #
+        # Instead of calling StarSet.light_curve once per star, excluding it
+        # from the comparison, all the leave-one-out light curves are computed
+        # at once from the (stars x images) matrix of magnitudes. The weighted
+        # sum of the magnitudes of all the stars is calculated for each image,
+        # and then the contribution of each star subtracted from it: dividing
+        # by the sum of the remaining weights gives the magnitudes of the
+        # artificial comparison star used for each one of the stars. This is
+        # the same as rescaling the weights with the index-th coefficient set
+        # to zero, as StarSet.light_curve does, without any Python loop.
+
+        weights = [initial]
         for iteration in xrange(max_iters or sys.getrecursionlimit()):
-            for star_index in xrange(len(self)):
-                star_curve = self.light_curve(weights[-1], self[star_index],
-                                              _exclude_index = star_index,
-                                              no_snr = True)
-                curves_stdevs[star_index] = star_curve.stdev
+            coeffs = numpy.asarray(weights[-1], dtype = dtype)
+            totals = numpy.dot(coeffs, mags)
+            others = (coeffs.sum() - coeffs)[:, numpy.newaxis]
+            cmags = (totals - coeffs[:, numpy.newaxis] * mags) / others
+            curves_stdevs = numpy.std(mags - cmags, axis = 1)
 
             # Avoid the division by zero if, somehow, a star ends up having a
             # standard deviation of zero, as Weights.inversely_proportional
@@ -626,9 +672,14 @@ class StarSet(object):
         less variable) stars in the set, and therefore the optimal to be used
         as comparison when a light curve is computed. In order to achieve this,
         the method iterates by identifying the 'fraction' less constant stars
-        (StarSet.worst), discarding them and recomputing the light curves of
-        the remaining stars. The process continues until there are only 'n'
-        stars left, which are returned. The original StarSet is not modified.
+        (as StarSet.worst does), discarding them and recomputing the light
+        curves of the remaining stars. The process continues until there are
+        only 'n' stars left, which are returned. The original StarSet is not
+        modified: the stars not yet discarded are kept as an array of indexes,
+        so the magnitudes are copied only once per iteration, and only those
+        of these stars. The Broeg weights of each iteration are computed
+        starting from those of the previous one, restricted to the stars that
+        were not discarded, as they are already close to the optimum.
 
         Ideally, stars would be discarded one by one, but this is terribly
         CPU-expensive for medium and large data sets, so in practice we are
@@ -661,7 +712,19 @@ class StarSet(object):
                    "as there are in the set")
             raise ValueError(msg)
 
-        set_ = copy.deepcopy(self)
+        # The indexes of the stars not yet discarded, and their weights
+        active = numpy.arange(len(self))
+        weights = self.flux_proportional_weights()
+
+        def discard(nworst, **kwargs):
+            """ Discard the 'nworst' stars with the lowest Broeg weights """
+            mags = self._phot_info[active, 0, :]
+            initial = Weights(weights[active]).normalize()
+            bweights = self._broeg_iterations(mags, initial,
+                                              dtype = self.dtype, **kwargs)
+            weights[active] = bweights
+            worst_indexes = bweights.argsort()[:nworst]
+            return numpy.delete(active, worst_indexes)
 
         # We do not discard stars here until only 'n' stars are left, as at
         # least three stars are needed in order to determine their variability
@@ -672,66 +735,263 @@ class StarSet(object):
         # we can discard the last batch of stars until only 'n' are left.
 
         kwargs = dict(pct = pct, max_iters = max_iters, minimum = minimum)
-        while len(set_) > max(n, 3):
+        while len(active) > max(n, 3):
 
-            worst_indexes = set_.worst(fraction, **kwargs)
+            # The number of stars to discard, as StarSet.worst computes it
+            nworst = max(int(round(fraction * len(active))), 1)
 
-            # The stars whose indexes have been returned by StarSet.worst
-            # cannot be blindly deleted, as the difference between the number
-            # of them and that of stars left in 'set_' may be higher than the
-            # number of stars that have to be deleted in order to get 'n' stars
-            # left. For example, assume there are 100 stars and we want the
-            # best 30, with a fraction of 0.5. 50 stars would be deleted in the
-            # first loop, while 25 more would be removed in the second. There
-            # would then be 100 - 50 - 25 = 25 stars left, when we wanted 30!
+            # The worst stars cannot be blindly deleted, as the difference
+            # between the number of them and that of stars left in 'active'
+            # may be higher than the number of stars that have to be deleted
+            # in order to get 'n' stars left. For example, assume there are
+            # 100 stars and we want the best 30, with a fraction of 0.5. 50
+            # stars would be deleted in the first loop, while 25 more would be
+            # removed in the second. There would then be 100 - 50 - 25 = 25
+            # stars left, when we wanted 30!
 
-            del worst_indexes[(len(set_) - max(n, 3)):]
-            # Remove the stars going backwards, from highest to lowest index
-            for index in sorted(worst_indexes, reverse = True):
-                del set_[index]
+            nworst = min(nworst, len(active) - max(n, 3))
+            active = discard(nworst, **kwargs)
 
         # If there are only three stars left but there are still stars to
         # discard we must identify them all at once, independently of the value
         # of 'fraction'. The reason for this is that a minimum of three stars
         # in needed to realibly determine their variability.
 
-        assert len(set_) >= n
-        if len(set_) != n:
-            worst_indexes = set_.worst(1.0, pct = pct, max_iters = max_iters)
-            del worst_indexes[(len(set_) - n):]
-            for index in sorted(worst_indexes, reverse = True):
-                del set_[index]
+        assert len(active) >= n
+        if len(active) != n:
+            nworst = len(active) - n
+            active = discard(nworst, pct = pct, max_iters = max_iters,
+                             minimum = None)
+
+        assert len(active) == n
+        return self._subset(active)
+
+# The light curves are stored in the database as the workers return them,
+# and the transaction committed every COMMIT_EVERY light curves, so that an
+# error (or the process being killed) does not lose all the work done so far.
+COMMIT_EVERY = 250
+
+# The photometry of all the stars in the filter for which light curves are
+# being computed (a PhotometryMatrix, with its arrays in shared memory) and,
+# for each star, the indexes of the stars that are complete for it (see
+# PhotometryMatrix.complete_indexes). They are set by main() before the pool
+# of workers is created, so that the workers inherit them when they are
+# forked, instead of receiving (via pickling) all the stars with each task.
+matrix = None
+complete_indexes = None
+
+# The candidates to comparison stars for the last coverage mask for which
+# this worker computed a light curve: a three-element tuple with the mask (as
+# a string), the sorted indexes in 'matrix' of the stars that are complete for
+# it and a StarSet with these stars, trimmed to the images of the mask. Only
+# the last one is kept, as main() sorts the tasks by coverage mask, and resets
+# it (to None) before the workers for each filter are forked.
+candidates = None
+
+def mask_candidates(index, star):
+    """ Return the candidates to comparison stars of the index-th star.
+
+    All the stars with the same coverage mask (that is, observed in the same
+    images) have the same candidates to comparison stars: the stars that are
+    complete for the mask, including themselves. Return a two-element tuple
+    with the sorted indexes in 'matrix' of these stars and a StarSet with them,
+    trimmed to the images of the mask, which is built only once for each mask
+    and kept in the global variable 'candidates'. 'star' is the DBStar of the
+    index-th star.
 
-        assert len(set_) == n
-        return set_
+    """
+
+    global candidates
+
+    key = matrix.mask[index].tostring()
+    if candidates is None or candidates[0] != key:
+        indexes = numpy.sort(numpy.append(complete_indexes[index], index))
+        stars = StarSet([matrix.star(x)._trim_to(star) for x in indexes])
+        candidates = key, indexes, stars
+    return candidates[1:]
+
+def complete_stars(index, star):
+    """ Return a StarSet with the stars complete for the index-th star.
 
-# The Queue is global -- this works, but note that we could have
-# passed its reference to the function managed by pool.map_async.
-# See http://stackoverflow.com/a/3217427/184363
-queue = methods.Queue()
+    These are the candidates to comparison stars shared by all the stars with
+    the same coverage mask (see mask_candidates) except for the star itself,
+    which is the only cheap step left for each star: copying the rows of the
+    other stars out of the StarSet of the mask (StarSet._subset). The result
+    is identical to a StarSet of the stars in complete_indexes[index] trimmed
+    to 'star', in the same order, so StarSet.best returns the same ensemble.
+
+    """
+
+    indexes, stars = mask_candidates(index, star)
+    return stars._subset(numpy.flatnonzero(indexes != index))
+
+# The comparison ensembles already computed by this worker, keyed by the
+# coverage mask of the stars for which they were found (see the function
+# approximate_ensemble, used only with --approximate-ensembles). Each worker
+# fills its own copy, and main() empties the dictionary of the parent process
+# before the workers for each filter are forked, so that they do not inherit
+# the ensembles of the previous filter.
+ensembles = {}
+
+def approximate_ensemble(index, star, ncstars, options):
+    """ Approximate the best comparison stars of the index-th star in 'matrix'.
+
+    Instead of running StarSet.best independently for each star with the same
+    coverage mask, the best 'ncstars' + 1 stars among all the candidates of the
+    mask (see mask_candidates), including the star, are found only once and
+    cached in the global 'ensembles' dictionary. For each star, then, only the
+    cheap exclusion is left: if the star is one of the best, it is removed from
+    the ensemble; otherwise, the worst of the 'ncstars' + 1 stars is discarded.
+
+    This is an approximation: the result is not necessarily identical to that
+    of StarSet.best, as the star took part in the elimination of the other
+    stars, and that is why it is only used if the --approximate-ensembles
+    option is given. In exchange, the number of Broeg iterations is divided by
+    (roughly) the number of stars that share a coverage mask, which in a
+    typical field is most of them. 'star' is the DBStar of the index-th star
+    and 'options' are those of the script.
+
+    """
+
+    kwargs = dict(fraction = options.worst_fraction, pct = options.pct,
+                  minimum = options.wminimum, max_iters = options.max_iters)
+
+    key = matrix.mask[index].tostring()
+    try:
+        ensemble = ensembles[key]
+    except KeyError:
+        stars = mask_candidates(index, star)[1]
+        ensemble = stars.best(ncstars + 1, **kwargs)
+        ensembles[key] = ensemble
+
+    if star.id in ensemble.star_ids:
+        # StarSet.__delitem__ modifies the list of IDs in place
+        ensemble = copy.deepcopy(ensemble)
+        del ensemble[ensemble.star_ids.index(star.id)]
+        return ensemble
+    else:
+        return ensemble.best(ncstars, **kwargs)
+
+# The path to the output database of a previous execution, whose light
+# curves are extended with the new images instead of being computed again
+# (see the --previous option), or None if it was not given. Set by main(),
+# while each worker reads the light curves from its own connection to the
+# LEMONdB, opened the first time it is needed (see previous_light_curve),
+# as the connection of the parent process cannot be used after the fork.
+previous_path = None
+previous_lemondb = None
+
+def previous_light_curve(star):
+    """ Return the previous light curve of a star, if any.
+
+    Read from the LEMONdB given with --previous the light curve of the star
+    in the photometric filter of 'star', a DBStar. None is returned if the
+    option was not given, or if the star has no light curve in that LEMONdB
+    (or is not in it at all, as would be the case if stars were added). Each
+    light curve is read by the worker that extends it, one at a time, instead
+    of loading all of them in the parent process before the workers fork.
+
+    """
+
+    global previous_lemondb
+
+    if previous_path is None:
+        return None
+
+    # The connection is kept together with the ID of the process that opened
+    # it, so that each worker opens its own, even if the global is inherited
+    pid = os.getpid()
+    if previous_lemondb is None or previous_lemondb[0] != pid:
+        previous_lemondb = pid, database.LEMONdB(previous_path)
+
+    try:
+        return previous_lemondb[1].get_light_curve(int(star.id), star.pfilter)
+    except KeyError:
+        return None
+
+def extended_light_curve(index, star, curve):
+    """ Extend a previous light curve of the index-th star in 'matrix'.
+
+    The comparison stars of a light curve, and their weights, were determined
+    using the images available at the time. When new images are added to the
+    database (for example, a new night of observations), we can keep them and
+    compute only the differential magnitudes of the star in the new images,
+    instead of running Broeg's algorithm again. 'star' is the DBStar of the
+    index-th star and 'curve' its previous LightCurve, which is modified in
+    place and returned. If no new images are found, 'curve' is returned as is.
+
+    None is returned if the light curve cannot be extended, and must therefore
+    be computed from scratch: this happens if the star has no previous light
+    curve, if the star was not observed at some of the points of the previous
+    curve or if any of the comparison stars was not observed in all the new
+    images in which the star was.
+
+    """
+
+    if curve is None:
+        return None
+
+    previous_times = curve.unix_times
+    if not numpy.all(numpy.in1d(previous_times, star._unix_times)):
+        return None
+
+    new = ~numpy.in1d(star._unix_times, previous_times)
+    if not new.any():
+        return curve
+
+    new_star = database.DBStar(star.id, star.pfilter, star._phot_info[:, new],
+                               dtype = star.dtype)
+    try:
+        cstars = []
+        for cstar_id in curve.cstars:
+            cindex = numpy.flatnonzero(matrix.star_ids == cstar_id)[0]
+            cstars.append(matrix.star(cindex)._trim_to(new_star))
+    except (IndexError, KeyError):
+        # Comparison star not in the database, or not observed at all the
+        # Unix times at which the star was observed in the new images
+        return None
+
+    # StarSet.light_curve() expects the standard deviations of the light
+    # curves of the comparison stars in the 'values' attribute of the weights
+    weights = Weights(curve.cweights)
+    weights.values = numpy.array(curve.cstdevs)
+    new_points = StarSet(cstars).light_curve(weights, new_star)
+    curve.extend(new_points.unix_times, new_points.magnitudes, new_points.snrs)
+    return curve
 
 @methods.print_exception_traceback
 def parallel_light_curves(args):
-    """ Method argument of map_async to compute light curves in parallel.
+    """ Method argument of imap_unordered to compute light curves in parallel.
 
     Functions defined in classes don't pickle, so we have moved this code here
-    in order to be able to use it with multiprocessing's map_async. As it
+    in order to be able to use it with multiprocessing's imap_unordered. As it
     receives a single argument, values are passed in a tuple which is then
-    unpacked.
+    unpacked: the index of the star in the global 'matrix' and the options.
+    Returns a two-element tuple with the ID of the star and its light curve,
+    or None if it could not be generated.
 
     """
 
-    star, all_stars, options = args
+    index, options = args
+    star = matrix.star(index)
     logging.debug("Star %d: photometry on %d images, enforced minimum of %d" %
                  (star.id, len(star), options.min_images))
 
     if len(star) < options.min_images:
         logging.debug("Star %d: ignored (minimum of %d images not met)" %
                      (star.id, options.min_images))
-        queue.put((star.id, None))
-        return
-
-    complete_for = star.complete_for(all_stars)
+        return star.id, None
+
+    curve = extended_light_curve(index, star, previous_light_curve(star))
+    if curve is not None:
+        logging.debug("Star %d: previous light curve extended to %d points" %
+                      (star.id, len(curve)))
+        return star.id, curve
+
+    # The stars that are 'complete' for this one have already been identified
+    # (see PhotometryMatrix.complete_indexes), and trimmed only once for all
+    # the stars with the same coverage mask (see complete_stars)
+    complete_for = complete_stars(index, star)
     logging.debug("Star %d: %d complete stars, enforced minimum = %d" %
                  (star.id, len(complete_for), options.min_cstars))
 
@@ -739,8 +999,7 @@ def parallel_light_curves(args):
     if ncstars < options.min_cstars:
         logging.debug("Star %d: ignored (minimum of %d comparison stars "
                       "not met)" % (star.id, options.min_cstars))
-        queue.put((star.id, None))
-        return
+        return star.id, None
 
     logging.debug("Star %d: will use %d complete stars (out of %d) as "
                   "comparison)" % (star.id, ncstars, len(complete_for)))
@@ -754,14 +1013,19 @@ def parallel_light_curves(args):
     logging.debug("Star %d: maximum Broeg iterations: %.4f" %
                  (star.id, options.max_iters))
 
-    complete_stars = StarSet(complete_for)
-    comparison_stars = \
-        complete_stars.best(ncstars, fraction = options.worst_fraction,
-                            pct = options.pct, minimum = options.wminimum,
-                            max_iters = options.max_iters)
+    # The ensemble shared with the other stars that have the same coverage
+    # mask cannot be used with fewer than two comparison stars, as that would
+    # leave StarSet.best with fewer than the three stars that it needs.
+    if options.approximate_ensembles and ncstars >= 2:
+        comparison_stars = approximate_ensemble(index, star, ncstars, options)
+    else:
+        comparison_stars = \
+            complete_for.best(ncstars, fraction = options.worst_fraction,
+                                pct = options.pct, minimum = options.wminimum,
+                                max_iters = options.max_iters)
 
     logging.debug("Star %d: identified the %d best stars (out of %d)" %
-                 (star.id, len(comparison_stars), len(complete_stars)))
+                 (star.id, len(comparison_stars), len(complete_for)))
     logging.debug("Star %d: best stars IDs: %s" %
                  (star.id, [x.id for x in comparison_stars]))
 
@@ -774,14 +1038,64 @@ def parallel_light_curves(args):
     light_curve = comparison_stars.light_curve(cweights, star)
     logging.debug("Star %d: light curve sucessfully generated "
                   "(stdev = %.4f)" % (star.id, light_curve.stdev))
-    queue.put((star.id, light_curve))
+    return star.id, light_curve
 
 
 parser = customparser.get_parser(description)
-parser.usage = "%prog [OPTION]... INPUT_DB OUTPUT_DB"
+parser.usage = "%prog [OPTION]... INPUT_DB OUTPUT_DB\n" \
+               "       %prog --materialize OUTPUT_DB"
 parser.add_option('--overwrite', action = 'store_true', dest = 'overwrite',
                   help = "overwrite output database if it already exists")
 
+parser.add_option('--resume', action = 'store_true', dest = 'resume',
+                  help = "continue an interrupted execution: the output "
+                  "database must already exist, and the light curves stored "
+                  "in it are not generated again, but only those of the "
+                  "remaining stars. The options that determine the light "
+                  "curves (those in the 'Light Curves', 'Broeg's Algorithm' "
+                  "and 'Worst and Best Stars' sections) are saved in the "
+                  "output database, and must be the same as in the execution "
+                  "that is being resumed.")
+
+parser.add_option('--previous', action = 'store', type = 'str',
+                  dest = 'previous', default = None,
+                  help = "the output database of a previous execution of "
+                  "this module, before new images were added to the input "
+                  "database (e.g., with the --append option of the "
+                  "photometry module). The light curves stored in it are "
+                  "extended with the new images, reusing their comparison "
+                  "stars and weights, instead of being generated again. The "
+                  "light curves that cannot be extended (for example, because "
+                  "a comparison star was not observed in some new image) are "
+                  "computed from scratch. The options that determine the "
+                  "light curves must be the same as in the previous "
+                  "execution.")
+
+parser.add_option('--link', action = 'store_true', dest = 'link',
+                  help = "do not make a copy of the input database. Instead, "
+                  "the output database stores a reference to it, from which "
+                  "the photometric records are read, and only the other, much "
+                  "smaller tables are copied. The input database must not be "
+                  "modified or moved as long as the output database is used, "
+                  "unless the latter is made self-contained with the "
+                  "--materialize option.")
+
+parser.add_option('--materialize', action = 'store_true',
+                  dest = 'materialize',
+                  help = "do not generate any light curves. Instead, make "
+                  "the output database of a previous execution with the "
+                  "--link option, given as the only argument, "
+                  "self-contained: the photometric records are copied from "
+                  "the input database, to which it no longer refers, so that "
+                  "the latter can be modified, moved or deleted.")
+
+parser.add_option('--pack', action = 'store_true', dest = 'pack',
+                  help = "store the photometric records and light curves in "
+                  "the packed format, with a single row per star and "
+                  "photometric filter instead of one per star and image. This "
+                  "makes the output database several times smaller, and "
+                  "faster to read from.")
+
 parser.add_option('--cores', action = 'store', type = 'int',
                   dest = 'ncores', default = defaults.ncores,
                   help = defaults.desc['ncores'])
@@ -856,9 +1170,81 @@ best_group.add_option('--worst-fraction', action = 'store', type = 'float',
                       "reliable the identification of the constant stars in "
                       "the field will be, but also more CPU-expensive "
                       "[default: %default]")
+
+best_group.add_option('--approximate-ensembles', action = 'store_true',
+                      dest = 'approximate_ensembles', default = False,
+                      help = "approximate the comparison stars by reusing "
+                      "them among the stars observed in the same images: the "
+                      "best stars are identified only once for all of them, "
+                      "and then the star for which the light curve is "
+                      "generated is excluded. This is much faster, but the "
+                      "comparison stars may differ from those identified "
+                      "independently for each star, as it is done by "
+                      "default")
 parser.add_option_group(best_group)
 customparser.clear_metavars(parser)
 
+# The destinations of the options on which the light curves depend. Their
+# values are stored, as JSON, in the output LEMONdB, so that --resume can
+# verify that an interrupted execution is continued with the same values.
+CURVES_OPTIONS = [option.dest for group in (curves_group, broeg_group, best_group)
+                  for option in group.option_list]
+
+def curves_options(options):
+    """ Return a dictionary with the values of the CURVES_OPTIONS """
+    return dict((dest, getattr(options, dest)) for dest in CURVES_OPTIONS)
+
+def same_curves_options(db, options):
+    """ Check that the light curves of a LEMONdB used the same options.
+
+    Compare the values of the CURVES_OPTIONS stored in 'db' by a previous
+    execution of this module to those in 'options'. Return True if they are
+    the same; otherwise, print an error message for each difference (or if
+    the database was not created by this module) and return False.
+
+    """
+
+    try:
+        stored_options = json.loads(db.diffphot_options)
+    except AttributeError:
+        print "%sError. The database '%s' was not created by this module." % \
+              (style.prefix, db.path)
+        return False
+
+    current_options = curves_options(options)
+    different = sorted(dest for dest in CURVES_OPTIONS
+                       if stored_options.get(dest) != current_options[dest])
+    for dest in different:
+        msg = "%sError. Option '%s' was %r, but is now %r."
+        args = (style.prefix, dest, stored_options.get(dest),
+                current_options[dest])
+        print msg % args
+    return not different
+
+def open_lemondb(path):
+    """ Open the LEMONdB stored at 'path', checking the one linked to it.
+
+    Return the LEMONdB, or print an error message and return None if it is
+    linked (see the --link option) to another LEMONdB that no longer exists
+    or that has changed since the link was created -- for example, because
+    the photometry of more images was appended to it. The light curves must
+    be computed again in that case, as they may no longer match the input.
+
+    """
+
+    try:
+        return database.LEMONdB(path)
+    except (IOError, database.LinkedDatabaseError), e:
+        # End the line of the progress message being printed, if any
+        if getattr(sys.stdout, 'softspace', False):
+            print
+        print "%sError. Cannot open the database '%s': %s." % \
+              (style.prefix, path, e)
+        print "%sThe light curves must be computed again, or the link " \
+              "removed with --materialize before modifying the linked " \
+              "database." % style.prefix
+        return None
+
 def main(arguments = None):
     """ main() function, encapsulated in a method to allow for easy invokation.
 
@@ -876,6 +1262,9 @@ def main(arguments = None):
 
     """
 
+    # Set for each photometric filter; see parallel_light_curves()
+    global matrix, complete_indexes, candidates, ensembles, previous_path
+
     if arguments is None:
         arguments = sys.argv[1:] # ignore argv[0], the script name
     (options, args) = parser.parse_args(args = arguments)
@@ -889,6 +1278,33 @@ def main(arguments = None):
         logging_level = logging.DEBUG
     logging.basicConfig(format = style.LOG_FORMAT, level = logging_level)
 
+    if options.materialize:
+        if len(args) != 1:
+            parser.print_help()
+            return 2  # used for command line syntax errors
+
+        output_db_path = args[0]
+        if not os.path.exists(output_db_path):
+            print "%sError. Database '%s' does not exist." % \
+                  (style.prefix, output_db_path)
+            print style.error_exit_message
+            return 1
+
+        print "%sCopying the photometric records from the linked " \
+              "database..." % style.prefix ,
+        sys.stdout.flush()
+        methods.owner_writable(output_db_path, True) # chmod u+w
+        db = open_lemondb(output_db_path)
+        if db is None:
+            print style.error_exit_message
+            return 1
+        db.materialize()
+        del db
+        methods.owner_writable(output_db_path, False) # chmod u-w
+        print 'done.'
+        print "%sYou're done ^_^" % style.prefix
+        return 0
+
     if len(args) != 2:
         parser.print_help()
         return 2  # used for command line syntax errors
@@ -907,7 +1323,33 @@ def main(arguments = None):
         print style.error_exit_message
         return 1
 
-    if os.path.exists(output_db_path):
+    if options.previous:
+        if not os.path.exists(options.previous):
+            print "%sError. Database '%s' does not exist." % \
+                  (style.prefix, options.previous)
+            print style.error_exit_message
+            return 1
+
+        previous_db = open_lemondb(options.previous)
+        if (previous_db is None or
+            not same_curves_options(previous_db, options)):
+            print style.error_exit_message
+            return 1
+
+    if options.resume:
+        if options.overwrite:
+            print "%sError. The --resume and --overwrite options are " \
+                  "mutually exclusive." % style.prefix
+            print style.error_exit_message
+            return 1
+
+        if not os.path.exists(output_db_path):
+            print "%sError. Cannot resume: the output database '%s' does " \
+                  "not exist." % (style.prefix, output_db_path)
+            print style.error_exit_message
+            return 1
+
+    elif os.path.exists(output_db_path):
         if not options.overwrite:
             print "%sError. The output database '%s' already exists." % \
                   (style.prefix, output_db_path)
@@ -923,13 +1365,50 @@ def main(arguments = None):
     # inconceivable that the astronomer may need to recompute the curves more
     # than once, each time with a different set of parameters.
 
-    print "%sMaking a copy of the input database..." % style.prefix ,
-    sys.stdout.flush()
-    shutil.copy2(input_db_path, output_db_path)
-    methods.owner_writable(output_db_path, True) # chmod u+w
-    print 'done.'
+    # With --link, the photometric records (by far the largest table of the
+    # database) are not copied, but read from the input database instead.
+
+    # With --resume, the output database (whatever the way in which it was
+    # created, a copy or a link) already exists: we only need to verify that
+    # the light curves that it contains were computed with the same options.
+
+    if options.resume:
+        print "%sResuming the output database..." % style.prefix ,
+        sys.stdout.flush()
+        methods.owner_writable(output_db_path, True) # chmod u+w
+        db = open_lemondb(output_db_path)
+        if db is None:
+            print style.error_exit_message
+            return 1
+        print 'done.'
+
+        if not same_curves_options(db, options):
+            print style.error_exit_message
+            return 1
+
+    elif options.link:
+        print "%sLinking to the input database..." % style.prefix ,
+        sys.stdout.flush()
+        db = database.LEMONdB(output_db_path)
+        db.link_photometry(input_db_path)
+        print 'done.'
+
+    else:
+        print "%sMaking a copy of the input database..." % style.prefix ,
+        sys.stdout.flush()
+        shutil.copy2(input_db_path, output_db_path)
+        methods.owner_writable(output_db_path, True) # chmod u+w
+        print 'done.'
+
+        db = open_lemondb(output_db_path)
+        if db is None:
+            print style.error_exit_message
+            return 1
+
+    if not options.resume:
+        db.diffphot_options = json.dumps(curves_options(options), sort_keys = True)
+        db.commit()
 
-    db = database.LEMONdB(output_db_path);
     nstars = len(db)
     print "%sThere are %d stars in the database" % (style.prefix, nstars)
 
@@ -940,60 +1419,101 @@ def main(arguments = None):
               (style.prefix, pfilter)
         print "%sLoading photometric information..." % style.prefix ,
         sys.stdout.flush()
-        all_stars = [db.get_photometry(star_id, pfilter) for star_id in db.star_ids]
+        # The global variables read by parallel_light_curves(): see the
+        # comment where they are defined. Must be set before the pool of
+        # workers is created. The arrays of the matrix are moved to shared
+        # memory so that the workers do not end up with a copy of them.
+        matrix = db.get_photometry_matrix(pfilter)
+        matrix = matrix._replace(**dict((field, methods.shared_array(value))
+                                        for field, value in matrix._asdict().items()
+                                        if isinstance(value, numpy.ndarray)))
+        nstars = len(matrix.star_ids)
         print 'done.'
 
+        # For each star, the indexes of the stars observed in all its images.
+        # These are the candidates to comparison stars, so that the workers do
+        # not need to test the coverage of all the other stars again.
+        complete_indexes = matrix.complete_indexes()
+        candidates = None
+        ensembles = {}
+
+        # With --resume, the stars whose light curve is already stored in the
+        # database are skipped. Those for which it could not be generated are
+        # evaluated again, but this is cheap, as they are discarded before
+        # any comparison star is identified.
+        tasks = xrange(nstars)
+        if options.resume:
+            stored = set(db.get_curves_stats(pfilter))
+            tasks = [x for x in tasks if matrix.star_ids[x] not in stored]
+            print "%s%d light curves already stored, %d stars left." % \
+                  (style.prefix, nstars - len(tasks), len(tasks))
+        ntasks = len(tasks)
+
+        # With --previous, the workers read the light curves of the previous
+        # execution, one at a time, and only extend them with the points of
+        # the new images (see previous_light_curve).
+        previous_path = options.previous
+
         # The generation of each light curve is a task independent from the
-        # others, so we can use a pool of workers and do it in parallel.
+        # others, so we can use a pool of workers and do it in parallel. Each
+        # task consists only of the index of the star in the global 'matrix'.
+        # The tasks are sorted by coverage mask, so that the stars that share
+        # it are consecutive and each worker, as it takes the next task, finds
+        # the candidates to comparison stars (and the ensemble, with the
+        # --approximate-ensembles option) already computed. See the function
+        # mask_candidates.
         pool = multiprocessing.Pool(options.ncores)
-        map_async_args = ((star, all_stars, options) for star in all_stars)
-        result = pool.map_async(parallel_light_curves, map_async_args)
-
-        methods.show_progress(0.0)
-        while not result.ready():
-            time.sleep(1)
-            methods.show_progress(queue.qsize() / len(all_stars) * 100)
-            # Do not update the progress bar when debugging; instead, print it
-            # on a new line each time. This prevents the next logging message,
-            # if any, from being printed on the same line that the bar.
-            if logging_level < logging.WARNING:
-                print
-
-        result.get() # reraise exceptions of the remote call, if any
-        methods.show_progress(100) # in case the queue was ready too soon
-        print
-
-        # The multiprocessing queue contains two-element tuples,
-        # mapping the ID of each star to its light curve.
-        print "%sStoring the light curves in the database..." % style.prefix
+        order = sorted(tasks, key = lambda x: matrix.mask[x].tostring())
+        imap_args = ((index, options) for index in order)
+
+        # The light curves are stored as the workers return them (two-element
+        # tuples, mapping the ID of each star to its light curve), instead of
+        # waiting for all of them, so that writing to the database overlaps
+        # with the computation and only a few light curves are kept in memory.
+        print "%sGenerating and storing the light curves..." % style.prefix
         methods.show_progress(0)
-        light_curves = (queue.get() for x in xrange(queue.qsize()))
-        for index, (star_id, curve) in enumerate(light_curves):
-
-            # NoneType is returned by parallel_light_curves when the light
-            # curve could not be calculated -- because it did not meet the
-            # minimum number of images or comparison stars.
-            if curve is None:
-                logging.debug("Nothing for star %d; light curve could not "
-                              "be generated" % star_id)
-                continue
-
-            logging.debug("Storing light curve for star %d in database" % star_id)
-            db.add_light_curve(star_id, curve)
-            logging.debug("Light curve for star %d successfully stored" % star_id)
-
-            methods.show_progress(100 * (index + 1) / len(all_stars))
-            if logging_level < logging.WARNING:
+        # Bulk-load mode: see the equivalent comment in photometry.main()
+        with db.bulk_load():
+            light_curves = pool.imap_unordered(parallel_light_curves, imap_args)
+            for index, (star_id, curve) in enumerate(light_curves):
+
+                # Make durable what has been stored so far: an error in a
+                # later task would otherwise roll back all the light curves.
+                # The commit validates the new rows (see bulk_load()).
+                if index and not index % COMMIT_EVERY:
+                    db.commit()
+
+                methods.show_progress(100 * (index + 1) / ntasks)
+                if logging_level < logging.WARNING:
+                    print
+
+                # NoneType is returned by parallel_light_curves when the light
+                # curve could not be calculated -- because it did not meet the
+                # minimum number of images or comparison stars.
+                if curve is None:
+                    logging.debug("Nothing for star %d; light curve could not "
+                                  "be generated" % star_id)
+                    continue
+
+                logging.debug("Storing light curve for star %d in database" % star_id)
+                db.add_light_curve(star_id, curve)
+                logging.debug("Light curve for star %d successfully stored" % star_id)
+
+            else:
+                logging.info("Light curves for %s generated" % pfilter)
+                # The transaction is committed by bulk_load() on exit
+
+                methods.show_progress(100.0)
                 print
 
-        else:
-            logging.info("Light curves for %s generated" % pfilter)
-            logging.debug("Committing database transaction")
-            db.commit()
-            logging.info("Database transaction commited")
+        pool.close()
+        pool.join()
 
-            methods.show_progress(100.0)
-            print
+    if options.pack:
+        print "%sPacking the light curves..." % style.prefix ,
+        sys.stdout.flush()
+        db.pack()
+        print 'done.'
 
     print "%sUpdating statistics about tables and indexes..." % style.prefix ,
     sys.stdout.flush()
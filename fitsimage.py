@@ -698,6 +698,25 @@ class FITSImage(object):
 
         return ra, dec
 
+    def world2pix(self, ra, dec):
+        """ Transform world coordinates to pixel coordinates.
+
+        Return a two-element tuple with the x- and y-coordinates to which the
+        specified right ascension and declination correspond in the FITS
+        image. The pixel coordinates are one-based, as in IRAF: the center of
+        the first pixel of the image is (1, 1). 'ra' and 'dec' may also be
+        NumPy arrays, in which case so are the returned coordinates. Raises
+        NoWCSInformationError under the same conditions as pix2world().
+
+        """
+
+        # Make sure the header contains an astrometric solution; otherwise,
+        # WCS.all_world2pix() would happily return meaningless coordinates.
+        self.center_wcs()
+
+        wcs = self._get_wcs()
+        return wcs.all_world2pix(ra, dec, 1)
+
     def center_wcs(self):
         """ Return the world coordinates of the central pixel of the image.
 
@@ -630,10 +630,9 @@ class StarDetailsGUI(object):
 
         for pfilter in self.db.pfilters:
             label = "Stdev %s" % pfilter.letter
-            curve = self.db.get_light_curve(star_id, pfilter)
-            if curve:
-                stdev = curve.stdev if curve else UNKNOWN_VALUE
-                store.append((label, stdev, bool(stdev)))
+            stats = self.db.get_curve_stats(star_id, pfilter)
+            if stats:
+                store.append((label, stats.stdev, bool(stats.stdev)))
 
         # Creation of the filter, from the model
         self.starinfo_filter = self.starinfo_store.filter_new()
@@ -664,7 +663,7 @@ class StarDetailsGUI(object):
             button.set_mode(draw_indicator = False)
 
             # Disable the button if there is no curve in this filter
-            if not self.db.get_light_curve(star_id, pfilter):
+            if not self.db.get_curve_stats(star_id, pfilter):
                 button.set_sensitive(False)
             else:
                 button.connect('button-press-event', self.show_pfilter, pfilter)
@@ -1300,6 +1299,11 @@ class LEMONJuicerGUI(object):
 
                 self.view.append_column(column)
 
+            # The statistics of all the light curves in each filter, read at
+            # once, so that the curves themselves do not need to be loaded.
+            curves_stats = [db.get_curves_stats(pfilter)
+                            for pfilter in db_pfilters]
+
             nstars = len(db)
             for star_index, star_id in enumerate(db.star_ids):
 
@@ -1312,11 +1316,11 @@ class LEMONJuicerGUI(object):
                 dec_str = methods.dec_str(dec)
                 row = [star_id, ra_str, ra, dec_str, dec, imag]
 
-                for pfilter in db_pfilters:
-                    # None returned if the star doesn't have this light curve
-                    curve = db.get_light_curve(star_id, pfilter)
-                    if curve:
-                        row += [curve.stdev, True]
+                for pfilter_stats in curves_stats:
+                    # None if the star doesn't have this light curve
+                    stats = pfilter_stats.get(star_id)
+                    if stats:
+                        row += [stats.stdev, True]
                     else:
                         row += [UNKNOWN_VALUE, False]
 
@@ -22,6 +22,7 @@ import contextlib
 import functools
 import logging
 import math
+import mmap
 import multiprocessing
 import multiprocessing.queues
 import numpy
@@ -573,6 +574,26 @@ class Queue(multiprocessing.queues.Queue):
         while not self.empty():
             self.get()
 
+def shared_array(array):
+    """ Return a copy of a NumPy array that lives in shared memory.
+
+    The data of the returned array is stored in an anonymous memory map, which
+    the child processes created with fork() -- such as the workers of a
+    multiprocessing.Pool -- share with the parent instead of getting a copy of
+    it. Therefore, if the array is created before the pool of workers, they
+    can read it (and write to it, in which case the changes are seen by all the
+    processes) without it having to be pickled and sent along with each task.
+
+    """
+
+    array = numpy.asarray(array)
+    # mmap.mmap() cannot map an empty file, so empty arrays take one byte
+    buffer_ = mmap.mmap(-1, max(array.nbytes, 1))
+    shared = numpy.frombuffer(buffer_, dtype = array.dtype, count = array.size)
+    shared = shared.reshape(array.shape)
+    shared[...] = array
+    return shared
+
 def print_exception_traceback(func):
     """ Decorator to print the stack trace of an exception.
 
@@ -487,15 +487,14 @@ class LEMONdBMiner(database.LEMONdB):
         returned, either because 'minimum' is set to a too high value or
         because the database has no information on the curves of the stars.
 
+        The standard deviations are read from the statistics of the light
+        curves (LEMONdB.get_curves_stats), so the curves are not loaded.
+
         """
 
-        curves_stdevs = []
-        for star_id in self.star_ids:
-            star_curve = self.get_light_curve(star_id, pfilter)
-            # NoneType returned if the star has no light curve
-            if star_curve is None or len(star_curve) < minimum:
-                continue
-            curves_stdevs.append((star_id, star_curve.stdev))
+        curves_stdevs = [(star_id, stats.stdev) for star_id, stats
+                         in self.get_curves_stats(pfilter).iteritems()
+                         if stats.npoints >= minimum]
 
         if not curves_stdevs:
             msg = "no light curves with at least %d points in %s"
@@ -543,13 +542,14 @@ class LEMONdBMiner(database.LEMONdB):
             if index == sort_index:
                 continue # stdevs already calculated!
 
+            curves_stats = self.get_curves_stats(pfilter)
             for star_id in most_similar_ids:
-                star_curve = self.get_light_curve(star_id, pfilter)
-                # NoneType returned if the star has no light curve
-                if star_curve is None or len(star_curve) < minimum:
+                stats = curves_stats.get(star_id)
+                # None if the star has no light curve
+                if stats is None or stats.npoints < minimum:
                     stdevs[pfilter][star_id] = None
                 else:
-                    stdevs[pfilter][star_id] = star_curve.stdev
+                    stdevs[pfilter][star_id] = stats.stdev
 
         header = []
         header.append('Star')
@@ -662,15 +662,14 @@ class LEMONdBMiner(database.LEMONdB):
                             discarded = True
                             break
 
-                        # Extract the light curve of each similar star and
-                        # compute its standard deviation. Then, calculate their
-                        # median (or arithmetic mean) and check whether the
-                        # ratio between the amplitude and this value is above
-                        # the threshold.
+                        # Take the standard deviation of the light curve of
+                        # each similar star. Then, calculate their median (or
+                        # arithmetic mean) and check whether the ratio between
+                        # the amplitude and this value is above the threshold.
 
                         stdevs = []
                         for id_ in similar:
-                            stdevs.append(self.get_light_curve(id_, pfilter).stdev)
+                            stdevs.append(self.get_curve_stats(id_, pfilter).stdev)
                         func = numpy.median if noisy_use_median else numpy.mean
                         cmp_stdevs.append(func(stdevs))
                         ratio = amplitude / cmp_stdevs[-1]
@@ -29,10 +29,15 @@ qphot.QPhot instance. Temporary files are used for both qphot and txdump, but
 they are automatically removed, so the entire process takes place in memory,
 from the user's perspective.
 
+PyRAF is only needed to actually run qphot: the QPhotResult class and the
+functions that apply the proper-motion correction are also used by the
+'aperture' module, which does photometry with NumPy and without IRAF, so
+this module can be imported even if PyRAF is not installed.
+
 """
 
 import collections
-import itertools
+import copy
 import logging
 import math
 import os
@@ -62,14 +67,21 @@ os.environ['PYRAF_NO_DISPLAY'] = '1'
 # directories, by temporarily changing the current working directory to that of
 # LEMON, where the pyraf/ directory and login.cl were generated by setup.py.
 
-with methods.tmp_chdir(os.path.dirname(os.path.abspath(__file__))):
-    import pyraf.iraf
-    from pyraf.iraf import digiphot, apphot  # 'digiphot.apphot' package
+try:
+    with methods.tmp_chdir(os.path.dirname(os.path.abspath(__file__))):
+        import pyraf.iraf
+        from pyraf.iraf import digiphot, apphot  # 'digiphot.apphot' package
+except ImportError:
+    pyraf = None # only the NumPy photometry (see 'aperture') is available
+
+if pyraf is not None:
 
-# Turn PyRAF process caching off; otherwise, if we spawn multiple processes
-# and run them in parallel, each one of them would use the same IRAF running
-# executable, which could sometimes result in the most arcane of errors.
-pyraf.iraf.prcacheOff()
+    # Turn PyRAF process caching off; otherwise, if we spawn multiple
+    # processes and run them in parallel, each one of them would use the same
+    # IRAF running executable, which could sometimes result in the most arcane
+    # of errors. Each worker process may enable its own cache once it has been
+    # forked: see init_session().
+    pyraf.iraf.prcacheOff()
 
 # Decorate pyraf.subproc.Subprocess.__del__() to catch the SubprocessError
 # exception that it occasionally raises (when the process is not gone after
@@ -84,8 +96,35 @@ pyraf.iraf.prcacheOff()
 # of <Subprocess '/iraf/iraf/bin.linux/x_images.e -c', at
 # 7f9f3f408710>> ignored
 
-func = methods.log_uncaught_exceptions(pyraf.subproc.Subprocess.__del__)
-pyraf.subproc.Subprocess.__del__ = func
+    func = methods.log_uncaught_exceptions(pyraf.subproc.Subprocess.__del__)
+    pyraf.subproc.Subprocess.__del__ = func
+
+def init_session():
+    """ Prepare IRAF to be used for all the images of a worker process.
+
+    This function is meant to be the 'initializer' of a multiprocessing.Pool
+    whose workers run qphot. Process caching is turned off at import time, so
+    that processes spawned with multiprocessing do not share the same IRAF
+    executables, but that also means that the executables of qphot and txdump
+    are started (and their parameters loaded) again for every image. Instead,
+    each worker process, once forked, enables its own process cache, loads
+    the parameters of both tasks and locks their executables into the cache,
+    where they are kept running and reused for all the images on which the
+    worker does photometry. Does nothing if PyRAF is not installed.
+
+    """
+
+    if pyraf is None:
+        return
+
+    pyraf.iraf.prcacheOn()
+    with methods.tmp_chdir(os.path.dirname(os.path.abspath(__file__))):
+        for task in (apphot.qphot, pyraf.iraf.txdump):
+            task.getParList()
+        pyraf.iraf.prcache('qphot', 'txdump')
+
+    msg = "IRAF session initialized in process %d"
+    logging.debug(msg % os.getpid())
 
 class MissingFITSKeyword(RuntimeWarning):
     """ Warning about keywords that cannot be read from a header (non-fatal) """
@@ -297,7 +336,28 @@ class QPhot(list):
 
         """
 
+        self.run_apertures(annulus, dannulus, [aperture], exptimek, cbox=cbox)
+        return len(self)
+
+    def run_apertures(self, annulus, dannulus, apertures, exptimek, cbox = 0):
+        """ Run IRAF's qphot on the FITS image with several apertures.
+
+        The same as QPhot.run(), but 'apertures' is a sequence of aperture
+        radii, in pixels, with which qphot is run only once: it measures all
+        the apertures with the same centers and sky, and txdump outputs the
+        magnitude, sum and flux of each aperture in a single line per object.
+        Returns a list with, for each aperture and in the same order, a QPhot
+        object with the measurements of the astronomical objects: the first
+        one is this QPhot itself, and the others copies of it.
+
+        """
+
+        if pyraf is None:
+            raise ImportError("PyRAF is needed in order to run IRAF's qphot")
+
         self.clear() # empty object
+        napertures = len(apertures)
+        results = [[] for _ in xrange(napertures)]
 
         try:
             # Temporary file to which the APPHOT text database produced by
@@ -325,6 +385,7 @@ class QPhot(list):
             stderr = methods.StreamToWarningFilter(*args)
 
             # Run qphot on the image and save the output to our temporary file.
+            aperture = ','.join(str(x) for x in apertures)
             kwargs = dict(cbox = cbox, annulus = annulus, dannulus = dannulus,
                           aperture = aperture, coords = self.coords_path,
                           output = qphot_output, exposure = exptimek,
@@ -348,7 +409,9 @@ class QPhot(list):
 
             # The type casting of Stdout to string is needed as txdump will not
             # work with unicode, if we happen to come across it: PyRAF requires
-            # that redirection be to a file handle or string.
+            # that redirection be to a file handle or string. The fields that
+            # are arrays, with one value for each aperture (mag, sum and flux),
+            # are output with all of their values, one after the other.
 
             txdump_fields = ['xcenter', 'ycenter', 'mag', 'sum', 'flux', 'stdev']
             pyraf.iraf.txdump(qphot_output, fields = ','.join(txdump_fields),
@@ -393,27 +456,10 @@ class QPhot(list):
                         logging.debug(msg % self.path)
                         ycenter = -1
 
+                    # The standard deviation of the sky, the same for all
+                    # the apertures, comes after the values of each aperture
                     try:
-                        mag_str = fields[2]
-                        mag     = float(mag_str)
-                        msg = "%s: mag = %.5f" % (self.path, mag)
-                        logging.debug(msg)
-                    except ValueError:  # float("INDEF")
-                        assert mag_str == 'INDEF'
-                        msg = "%s: mag = None ('INDEF')" % self.path
-                        logging.debug(msg)
-                        mag = None
-
-                    sum_ = float(fields[3])
-                    msg = "%s: sum = %.5f" % (self.path, sum_)
-                    logging.debug(msg)
-
-                    flux = float(fields[4])
-                    msg = "%s: flux = %.5f" % (self.path, flux)
-                    logging.debug(msg)
-
-                    try:
-                        stdev_str = fields[5]
+                        stdev_str = fields[2 + 3 * napertures]
                         stdev = float(stdev_str)
                         msg = "%s: stdev = %.5f" % (self.path, stdev)
                         logging.debug(msg)
@@ -423,8 +469,30 @@ class QPhot(list):
                         logging.debug(msg)
                         stdev = None
 
-                    args = xcenter, ycenter, mag, sum_, flux, stdev
-                    self.append(QPhotResult(*args))
+                    for index in xrange(napertures):
+
+                        try:
+                            mag_str = fields[2 + index]
+                            mag     = float(mag_str)
+                            msg = "%s: mag = %.5f" % (self.path, mag)
+                            logging.debug(msg)
+                        except ValueError:  # float("INDEF")
+                            assert mag_str == 'INDEF'
+                            msg = "%s: mag = None ('INDEF')" % self.path
+                            logging.debug(msg)
+                            mag = None
+
+                        sum_ = float(fields[2 + napertures + index])
+                        msg = "%s: sum = %.5f" % (self.path, sum_)
+                        logging.debug(msg)
+
+                        flux = float(fields[2 + 2 * napertures + index])
+                        msg = "%s: flux = %.5f" % (self.path, flux)
+                        logging.debug(msg)
+
+                        args = xcenter, ycenter, mag, sum_, flux, stdev
+                        results[index].append(QPhotResult(*args))
+
 
         finally:
 
@@ -442,8 +510,41 @@ class QPhot(list):
             except NameError:
                 pass
 
-        return len(self)
+        self.extend(results[0])
+        qphots = [self]
+        for records in results[1:]:
+            img_qphot = copy.copy(self)
+            img_qphot[:] = records
+            qphots.append(img_qphot)
+        return qphots
+
 
+def exact_coordinates(coordinates, year, epoch):
+    """ Apply proper-motion correction to the coordinates of the objects.
+
+    Loop over 'coordinates', an iterable of astromatic.Coordinates objects, and
+    return a generator over their exact positions for a given date: those of
+    the objects with a known proper motion are corrected, while the others are
+    returned as they are. See Coordinates.get_exact_coordinates().
+
+    """
+
+    for coord in coordinates:
+
+        # Do not apply any correction if pm_ra and pm_dec are None (which means
+        # that the proper motion of the object is unknown) or zero (because in
+        # this case the coordinates are always the same). Make sure also that
+        # either none or both proper motions are None: we cannot know one but
+        # not the other!
+
+        if None in (coord.pm_ra, coord.pm_dec):
+            assert coord.pm_ra  is None
+            assert coord.pm_dec is None
+
+        if coord.pm_ra or coord.pm_dec:
+            coord = coord.get_exact_coordinates(year, epoch = epoch)
+
+        yield coord
 
 def get_coords_file(coordinates, year, epoch):
     """ Return a coordinates file with the exact positions of the objects.
@@ -470,25 +571,86 @@ def get_coords_file(coordinates, year, epoch):
     fd, path = tempfile.mkstemp(**kwargs)
     fmt = '\t'.join(['%.10f', '%.10f\n'])
 
-    for coord in coordinates:
+    for coord in exact_coordinates(coordinates, year, epoch):
+        os.write(fd, fmt % coord[:2])
 
-        # Do not apply any correction if pm_ra and pm_dec are None (which means
-        # that the proper motion of the object is unknown) or zero (because in
-        # this case the coordinates are always the same). Make sure also that
-        # either none or both proper motions are None: we cannot know one but
-        # not the other!
+    os.close(fd)
+    return path
 
-        if None in (coord.pm_ra, coord.pm_dec):
-            assert coord.pm_ra  is None
-            assert coord.pm_dec is None
+def get_year(img, coordinates, epoch, datek, timek, exptimek):
+    """ Return the year to which the coordinates of the objects are corrected.
+
+    Return the date of observation of the FITS image (a fitsimage.FITSImage
+    object), as a decimal year, if at least one of the astromatic.Coordinates
+    objects in 'coordinates' has a known proper motion. Otherwise, 'epoch' is
+    returned, so that the proper-motion correction leaves the coordinates as
+    they are. KeyError is raised if the 'datek' or 'timek' keywords are needed
+    but cannot be found in the FITS header. The arguments have the same
+    meaning as in run().
+
+    """
+
+    kwargs = dict(date_keyword = datek,
+                  time_keyword = timek,
+                  exp_keyword = exptimek)
+
+    # The date of observation is only actually needed when we need to apply
+    # proper motion corrections. Therefore, don't call FITSImage.year() unless
+    # one or more of the astromatic.Coordinates objects have a proper motion.
+    # This avoids an unnecessary KeyError exception when we do photometry on a
+    # FITS image without the 'datek' or 'timek' keywords (for example, a mosaic
+    # created with IPAC's Montage): when that happens we cannot apply proper
+    # motion corrections, that's right, but that's not an issue if none of our
+    # objects have a known proper motion.
+
+    for coord in coordinates:
 
         if coord.pm_ra or coord.pm_dec:
-            coord = coord.get_exact_coordinates(year, epoch = epoch)
+            try:
+                year = img.year(**kwargs)
+                break
 
-        os.write(fd, fmt % coord[:2])
+            except KeyError as e:
+                # Include the missing FITS keyword in the exception message
+                regexp = "keyword '(?P<keyword>.*?)' not found"
+                match = re.search(regexp, str(e))
+                assert match is not None
+                msg = ("{0}: keyword '{1}' not found. It is needed in order "
+                       "to be able to apply proper-motion correction, as one "
+                       "or more astronomical objects have known proper motions"
+                       .format(img.path, match.group('keyword')))
+                raise KeyError(msg)
 
-    os.close(fd)
-    return path
+        else:
+            # No object has a known proper motion, so don't call
+            # FITSImage.year().  Use the same value as the epoch, so that when
+            # exact_coordinates() applies the proper motion correction the
+            # input and output coordinates are the same.
+            year = epoch
+
+    return year
+
+def get_saturation_image(img, uncimgk):
+    """ Return the path to the FITS image used to check for saturation.
+
+    This is the path stored in the 'uncimgk' keyword of the FITS image, 'img'
+    (a fitsimage.FITSImage object), or the path to 'img' itself if 'uncimgk'
+    is an empty string or None. IOError is raised if the image given by the
+    keyword does not exist. See the documentation of run() for details.
+
+    """
+
+    if not uncimgk:
+        orig_img_path = img.path
+
+    else:
+        orig_img_path = img.read_keyword(uncimgk)
+        if not os.path.exists(orig_img_path):
+            msg = "image %s (keyword '%s' of image %s) does not exist"
+            args = orig_img_path, uncimgk, img.path
+            raise IOError(msg % args)
+
+    return orig_img_path
 
 def run(img, coordinates, epoch,
         aperture, annulus, dannulus, maximum,
@@ -553,159 +715,76 @@ def run(img, coordinates, epoch,
 
     """
 
-    kwargs = dict(date_keyword = datek,
-                  time_keyword = timek,
-                  exp_keyword = exptimek)
+    args = (img, coordinates, epoch, [aperture], annulus, dannulus, maximum,
+            datek, timek, exptimek, uncimgk)
+    return run_apertures(*args, cbox = cbox)[0]
 
-    # The date of observation is only actually needed when we need to apply
-    # proper motion corrections. Therefore, don't call FITSImage.year() unless
-    # one or more of the astromatic.Coordinates objects have a proper motion.
-    # This avoids an unnecessary KeyError exception when we do photometry on a
-    # FITS image without the 'datek' or 'timek' keywords (for example, a mosaic
-    # created with IPAC's Montage): when that happens we cannot apply proper
-    # motion corrections, that's right, but that's not an issue if none of our
-    # objects have a known proper motion.
 
-    for coord in coordinates:
+def run_apertures(img, coordinates, epoch,
+                  apertures, annulus, dannulus, maximum,
+                  datek, timek, exptimek, uncimgk,
+                  cbox = 0):
+    """ Do photometry on a FITS image with several apertures.
 
-        if coord.pm_ra or coord.pm_dec:
-            try:
-                year = img.year(**kwargs)
-                break
+    The counterpart of aperture.run_apertures() for IRAF: return a list with,
+    for each of the radii, in pixels, in the 'apertures' sequence and in the
+    same order, the QPhot object that run() returns for that aperture. The
+    other arguments are those of run(). qphot is run only once, measuring all
+    the apertures (see QPhot.run_apertures()), and the pixels of the image are
+    also read only once to check for saturation.
 
-            except KeyError as e:
-                # Include the missing FITS keyword in the exception message
-                regexp = "keyword '(?P<keyword>.*?)' not found"
-                match = re.search(regexp, str(e))
-                assert match is not None
-                msg = ("{0}: keyword '{1}' not found. It is needed in order "
-                       "to be able to apply proper-motion correction, as one "
-                       "or more astronomical objects have known proper motions"
-                       .format(img.path, match.group('keyword')))
-                raise KeyError(msg)
+    """
 
-        else:
-            # No object has a known proper motion, so don't call
-            # FITSImage.year().  Use the same value as the epoch, so that when
-            # get_coords_file() below applies the proper motion correction the
-            # input and output coordinates are the same.
-            year = epoch
+    year = get_year(img, coordinates, epoch, datek, timek, exptimek)
 
     # The proper-motion corrected objects coordinates
     coords_path = get_coords_file(coordinates, year, epoch)
 
     img_qphot = QPhot(img.path, coords_path)
-    img_qphot.run(annulus, dannulus, aperture, exptimek, cbox=cbox)
+    qphots = img_qphot.run_apertures(annulus, dannulus, apertures, exptimek,
+                                     cbox=cbox)
 
     # How do we know whether one or more pixels in the aperture are above a
-    # saturation threshold? As suggested by Frank Valdes at the IRAF.net
-    # forums, we can make a mask of the saturated values, on which we can do
-    # photometry using the same aperture. If we get a non-zero flux, we know it
-    # has saturation: http://iraf.net/forum/viewtopic.php?showtopic=1466068
-
-    if not uncimgk:
-        orig_img_path = img.path
-
-    else:
-        orig_img_path = img.read_keyword(uncimgk)
-        if not os.path.exists(orig_img_path):
-            msg = "image %s (keyword '%s' of image %s) does not exist"
-            args = orig_img_path, uncimgk, img.path
-            raise IOError(msg % args)
-
-    try:
-        # Temporary file to which the saturation mask is saved
-        basename = os.path.basename(orig_img_path)
-        mkstemp_prefix = "%s_satur_mask_%d_ADUS_" % (basename, maximum)
-        kwargs = dict(prefix = mkstemp_prefix,
-                      suffix = '.fits', text = True)
-        mask_fd, satur_mask_path = tempfile.mkstemp(**kwargs)
-        os.close(mask_fd)
-
-        # IRAF's imexpr won't overwrite the file. Instead, it will raise an
-        # IrafError exception stating that "IRAF task terminated abnormally
-        # ERROR (1121, "FXF: EOF encountered while reading FITS file".
-        os.unlink(satur_mask_path)
-
-        # The expression that will be given to 'imexpr'. The space after the
-        # colon is needed to avoid sexigesimal interpretation. 'a' is the first
-        # and only operand, linked to our image at the invokation of the task.
-        expr = "a>%d ? 1 : 0" % maximum
-        logging.debug("%s: imexpr = '%s'" % (img.path, expr))
-        logging.debug("%s: a = %s" % (img.path, orig_img_path))
-        logging.info("%s: Running IRAF's imexpr..." % img.path)
-        pyraf.iraf.images.imexpr(expr, a = orig_img_path,
-                                 output = satur_mask_path, verbose = 'yes',
-                                 Stdout = methods.LoggerWriter('debug'))
-
-        assert os.path.exists(satur_mask_path)
-
-        msg = "%s: IRAF's imexpr OK" % img.path
-        logging.info(msg)
-        msg = "%s: IRAF's imexpr output = %s"
-        logging.debug(msg % (img.path, satur_mask_path))
-
-        # Now we just do photometry again, on the same pixels, but this time on
-        # the saturation mask. Those objects for which we get a non-zero flux
-        # will be known to be saturated and their magnitude set to infinity.
-
-        # If 'cbox' is other than zero, the center of each object may have been
-        # recentered by qphot using the centroid centering algorithm. When that
-        # is the case, we need to feed run() with these more accurate centers.
-        # Since the QPhotResult objects contain x- and y-coordinates (qphot
-        # does not support 'world' coordinates as the output system), we need
-        # to convert them back to right ascension and declination.
-
-        if cbox:
-
-            root, _ = os.path.splitext(os.path.basename(img.path))
-            kwargs = dict(prefix = root + '_',
-                          suffix = '_satur.coords',
-                          text = True)
-
-            os.unlink(coords_path)
-            fd, coords_path = tempfile.mkstemp(**kwargs)
-            for object_phot in img_qphot:
-                centered_x, centered_y = object_phot.x, object_phot.y
-                ra, dec = img.pix2world(centered_x, centered_y)
-                os.write(fd, "{0} {1}\n".format(ra, dec))
-            os.close(fd)
-
-        mask_qphot = QPhot(satur_mask_path, coords_path)
-        # No centering this time: if cbox != 0 the accurate centers for each
-        # astronomical object have been computed using the centroid centering
-        # algorithm, so we're already feeding run() with the accurate values.
-        mask_qphot.run(annulus, dannulus, aperture, exptimek, cbox=0)
-        os.unlink(coords_path)
-
-        assert len(img_qphot) == len(mask_qphot)
-        for object_phot, object_mask in itertools.izip(img_qphot, mask_qphot):
-
-            if __debug__:
-
-                # In cbox != 0 we cannot expect the coordinates to be the exact
-                # same: the previous call to run() returned x and y coordinates
-                # that we converted to celestial coordinates, and now qphot is
-                # giving as output image coordinates again. It is unavoidable
-                # to lose some precision. Anyway, this does not affect the
-                # result: photometry was still done on almost the absolute
-                # exact coordinates that we wanted it to.
-
-                if not cbox:
-                    assert object_phot.x == object_mask.x
-                    assert object_phot.y == object_mask.y
-
-            if object_mask.flux > 0:
-                object_phot = object_phot._replace(mag = float('infinity'))
-    finally:
-
-        # Remove saturation mask. The try-except is necessary because an
-        # exception may be raised before 'satur_mask_path' is defined.
-
-        try:
-            methods.clean_tmp_files(satur_mask_path)
-        except NameError:
-            pass
-
-    return img_qphot
-
+    # saturation threshold? IRAF's qphot provides no way of knowing it, so we
+    # read the pixels of the image (or of the original one, if 'uncimgk' is
+    # given) and look for values above 'maximum' within the aperture of each
+    # object, centered on the coordinates output by qphot. These are already
+    # the accurate centers if 'cbox' is other than zero, so no conversion
+    # back to celestial coordinates is needed. Note that this used to be done
+    # making a mask of the saturated values with IRAF's imexpr, and doing
+    # photometry on it, as suggested by Frank Valdes at the IRAF.net forums
+    # (http://iraf.net/forum/viewtopic.php?showtopic=1466068), but that meant
+    # writing a full-size FITS image to disk and running qphot twice. The
+    # distance to the nearest saturated pixel is computed for the largest
+    # aperture, and then compared to each one of them.
+
+    # Imported here, as the 'aperture' module depends on this one
+    from aperture import read_data, nearest_saturated
+
+    os.unlink(coords_path)
+    orig_img_path = get_saturation_image(img, uncimgk)
+    logging.debug("%s: checking saturation on %s" % (img.path, orig_img_path))
+
+    # The centers that qphot could not output are set to -1 (the fallback
+    # value; see QPhot.run_apertures()), which is finite: the objects could
+    # be flagged as saturated if there are saturated pixels near the corner
+    # of the image. Map them to NaN, for which there is never saturation.
+    nan = float('nan')
+    xs = [nan if object_phot.x == -1 else object_phot.x
+          for object_phot in img_qphot]
+    ys = [nan if object_phot.y == -1 else object_phot.y
+          for object_phot in img_qphot]
+    data = read_data(orig_img_path)
+    nearest = nearest_saturated(data, xs, ys, max(apertures), maximum)
+
+    for aperture, aperture_qphot in zip(apertures, qphots):
+        saturated = nearest < aperture + 0.5
+        for index, object_phot in enumerate(aperture_qphot):
+            if saturated[index]:
+                infinity = float('infinity')
+                aperture_qphot[index] = object_phot._replace(mag = infinity)
+
+        msg = "%s: %d objects saturated (more than %d ADUs, aperture %s)"
+        logging.info(msg % (img.path, saturated.sum(), maximum, aperture))
+
+    return qphots
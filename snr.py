@@ -75,9 +75,14 @@ def error_to_snr(error):
     determined: a plus if the error is negative and a minus if it turns out
     to be negative.
 
+    'error' may also be a NumPy array, in which case each one of its elements
+    is converted and an array of signal-to-noise ratios is returned.
+
     """
 
-    return (1 if error < 0 else -1) / (math.pow(10, error / -2.5) - 1)
+    error = numpy.asarray(error)
+    sign = numpy.where(error < 0, 1, -1)
+    return sign / (10 ** (error / -2.5) - 1)
 
 def difference_error(*errors):
     """ Return the absolute error of the difference of a series of errors.
@@ -100,9 +105,15 @@ def difference_error(*errors):
     between two or more stars. However, it may be perfectly used for additions
     too, and of course also for a combination of additions and subtractions.
 
+    The errors may also be NumPy arrays of the same shape, in which case they
+    are combined element-wise: for example, the i-th element of the returned
+    array will be the error of the difference of the i-th elements of each
+    array. This is how the errors of all the points of a light curve can be
+    computed at once, without looping over them in Python.
+
     """
 
-    return math.sqrt(sum(e ** 2 for e in errors))
+    return numpy.sqrt(sum(numpy.square(e) for e in errors))
 
 def difference_snr(*snrs):
     """ Return the SNR of the difference of a series of SNRs.
@@ -115,6 +126,8 @@ def difference_snr(*snrs):
     As it is the case with difference_error, this method, despite its name, may
     also be used to compute the resulting signal-to-noise ratio of the addition
     of different SNRs, as well as the combination of additions and subtractions.
+    As with difference_error, the SNRs may be NumPy arrays of the same shape,
+    which are combined element-wise, and an array of SNRs is returned.
 
     """
 
@@ -125,7 +138,7 @@ def difference_snr(*snrs):
     # converting back to SNR.
 
     errors = [snr_to_error(s)[1] for s in snrs]
-    assert all(e >= 0 for e in errors)
+    assert all(numpy.all(e >= 0) for e in errors)
     error = difference_error(*errors)
     return error_to_snr(error)
 
@@ -149,6 +162,12 @@ def mean_error(errors, weights = None):
     is the equation implemented by the method, indeed, where the coefficients
     default to 1/n if no weights are given.
 
+    'errors' may also be a two-dimensional NumPy array. In that case the mean
+    is computed along the first axis, returning one error per column: if each
+    row contains the errors of a star in the different images, the returned
+    array gives the error of the (weighted) mean of all the stars in each
+    image. The i-th weight then corresponds to the i-th row of the array.
+
     Thanks so much to the people at Math Stack Exchange for their help:
     http://math.stackexchange.com/q/123276/
 
@@ -160,15 +179,20 @@ def mean_error(errors, weights = None):
               [0.5, 0.5], [1.0, 1.0] and [2.6, 2.6], e.g., are equivalent.
     """
 
+    errors = numpy.asarray(errors)
     if weights is None:
         # All the values contribute equally (and weights sum up to one)
-        weights = [1 / len(errors)] * len(errors)
+        weights = numpy.repeat(1 / len(errors), len(errors))
     elif len(weights) != len(errors):
         raise ValueError("number of weights must equal that of errors")
     else:
         # Normalize the values so that they sum up to one
-        weights = [w / math.fsum(weights) for w in weights]
-    return math.sqrt(math.fsum(((w  ** 2) * (e ** 2) for e, w in zip(errors, weights))))
+        weights = numpy.asarray(weights)
+        weights = weights / weights.sum()
+
+    # Broadcast the i-th weight along all the columns of the i-th row
+    weights = weights.reshape((-1,) + (1,) * (errors.ndim - 1))
+    return numpy.sqrt(numpy.sum(weights ** 2 * errors ** 2, axis = 0))
 
 def mean_snr(snrs, weights = None):
     """ Return the SNR of the arithmetic mean of a series of SNSRs.
@@ -178,6 +202,11 @@ def mean_snr(snrs, weights = None):
     converting the SNRs to errors in magnitudes, computing the absolute error
     and converting the resulting value back to its equivalent SNR.
 
+    'snrs' may also be a two-dimensional NumPy array, with as many rows as
+    stars and as many columns as images. The SNR of the mean of the stars is
+    then computed for all the images in a single call, and returned as a
+    one-dimensional array with one element per column (see mean_error).
+
     Keyword arguments:
     weights - the coefficients of the weighted mean. The i-th weight is
               interpreted to correspond to the i-th error received by the
@@ -193,8 +222,10 @@ def mean_snr(snrs, weights = None):
     # the errors become positive, and as such they would be considered when
     # converting back to SNR.
 
-    errors = [snr_to_error(s)[1] for s in snrs]
-    assert all(e >= 0 for e in errors)
+    if not isinstance(snrs, numpy.ndarray):
+        snrs = numpy.array(list(snrs))
+    errors = snr_to_error(snrs)[1]
+    assert numpy.all(errors >= 0)
     error = mean_error(errors, weights = weights)
     return error_to_snr(error)
 
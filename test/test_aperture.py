@@ -0,0 +1,307 @@
+#! /usr/bin/env python
+
+# Copyright (c) 2012 Victor Terron. All rights reserved.
+# Institute of Astrophysics of Andalusia, IAA-CSIC
+#
+# This file is part of LEMON.
+#
+# LEMON is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import division
+
+import astropy.wcs
+import math
+import numpy
+import os
+import pyfits
+import random
+import tempfile
+import warnings
+
+# LEMON modules
+from test import unittest
+import aperture
+import astromatic
+import qphot
+import test.test_fitsimage
+
+NITERS = 10  # How many times random-data tests cases are run
+
+class ApertureTest(unittest.TestCase):
+
+    SIZE = 256          # pixels along each axis of the synthetic images
+    SKY = 1000.0        # ADUs
+    SKY_NOISE = 10.0    # standard deviation of the sky, in ADUs
+    SKY_TOLERANCE = 5.0 # maximum error of the sky level, in ADUs
+    SIGMA = 2.0         # of the Gaussian profile of the stars, in pixels
+    EXPTIME = 60.0      # seconds
+
+    RUN_KWARGS = dict(
+        epoch = 2000,
+        aperture = 10,
+        annulus  = 14,
+        dannulus = 6,
+        maximum = 60000,
+        datek = 'DATE-OBS',
+        timek = None,
+        exptimek = 'EXPTIME',
+        uncimgk = None)
+
+    @classmethod
+    def get_wcs(cls):
+        """ Return a simple astropy.wcs.WCS, with one arcsecond per pixel """
+
+        wcs = astropy.wcs.WCS(naxis = 2)
+        wcs.wcs.crpix = [cls.SIZE / 2, cls.SIZE / 2]
+        wcs.wcs.cdelt = [-1 / 3600, 1 / 3600]
+        wcs.wcs.crval = [100.0, 10.0]
+        wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+        return wcs
+
+    @classmethod
+    def mkfits(cls, stars, **keywords):
+        """ Return a FITSImage with stars with Gaussian profiles.
+
+        'stars' is a sequence of three-element tuples with the one-based x-
+        and y-coordinates of each star and its flux, in ADUs. The stars are
+        added to a flat sky of SKY ADUs, with Gaussian noise of standard
+        deviation SKY_NOISE. Keyword/value pairs are stored in the header.
+
+        """
+
+        ys, xs = numpy.mgrid[1:cls.SIZE + 1, 1:cls.SIZE + 1]
+        data = numpy.random.normal(cls.SKY, cls.SKY_NOISE, xs.shape)
+        for x, y, flux in stars:
+            r2 = (xs - x) ** 2 + (ys - y) ** 2
+            norm = flux / (2 * math.pi * cls.SIGMA ** 2)
+            data += norm * numpy.exp(-r2 / (2 * cls.SIGMA ** 2))
+
+        hdu = pyfits.PrimaryHDU(data)
+        for card in cls.get_wcs().to_header().cards:
+            hdu.header[card.keyword] = card.value
+        hdu.header['EXPTIME'] = cls.EXPTIME
+        for keyword, value in keywords.iteritems():
+            hdu.header[keyword] = value
+
+        fd, path = tempfile.mkstemp(suffix = '.fits')
+        os.close(fd)
+        os.unlink(path)
+        hdu.writeto(path)
+        return test.test_fitsimage.FITSImage(path)
+
+    @classmethod
+    def random_stars(cls, n, margin = 30):
+        """ Return 'n' random stars (x, y, flux), at least 'margin' pixels away
+        from the edges of the image """
+
+        stars = []
+        for _ in xrange(n):
+            x = random.uniform(margin, cls.SIZE - margin)
+            y = random.uniform(margin, cls.SIZE - margin)
+            flux = random.uniform(5e4, 5e5)
+            stars.append((x, y, flux))
+        return stars
+
+    @classmethod
+    def to_coordinates(cls, stars):
+        """ Return the astromatic.Coordinates of the (x, y, flux) stars """
+
+        coords = []
+        for x, y, _ in stars:
+            ra, dec = cls.get_wcs().all_pix2world(x, y, 1)
+            coords.append(astromatic.Coordinates(float(ra), float(dec)))
+        return coords
+
+    def test_run(self):
+
+        # Stars that do not overlap: the flux must be recovered within the
+        # noise, as the aperture includes (almost) all of it, the sky must
+        # be that of the image and the magnitudes normalized to the exposure
+        # time. With a non-zero 'cbox' the centers must be found even if the
+        # input coordinates are slightly off.
+
+        for _ in xrange(NITERS):
+            stars = []
+            for star in self.random_stars(12):
+                if all(math.hypot(star[0] - x, star[1] - y) > 45
+                       for x, y, _ in stars):
+                    stars.append(star)
+
+            with self.mkfits(stars) as img:
+
+                for cbox, shift in ((0, 0), (5, 1.5)):
+
+                    input_stars = [(x + shift, y - shift, f)
+                                   for x, y, f in stars]
+                    coords = self.to_coordinates(input_stars)
+                    kwargs = dict(self.RUN_KWARGS, cbox = cbox)
+                    result = aperture.run(img, coords, **kwargs)
+                    self.assertEqual(len(result), len(stars))
+
+                    for phot, (x, y, flux) in zip(result, stars):
+                        self.assertTrue(isinstance(phot, qphot.QPhotResult))
+                        self.assertAlmostEqual(phot.x, x, delta = 0.1)
+                        self.assertAlmostEqual(phot.y, y, delta = 0.1)
+
+                        # The noise of the sky within the aperture, plus the
+                        # error of the sky level (the mode is estimated from
+                        # a few hundred pixels), over the entire aperture
+                        area = math.pi * kwargs['aperture'] ** 2
+                        noise = self.SKY_NOISE * math.sqrt(area) * 5
+                        noise += area * self.SKY_TOLERANCE
+                        self.assertAlmostEqual(phot.flux, flux, delta = noise)
+                        sky = phot.sum - phot.flux
+                        self.assertAlmostEqual(sky / area, self.SKY,
+                                               delta = self.SKY_TOLERANCE)
+                        self.assertAlmostEqual(phot.stdev, self.SKY_NOISE,
+                                               delta = 2)
+
+                        mag = (aperture.ZMAG - 2.5 * math.log10(phot.flux) +
+                               2.5 * math.log10(self.EXPTIME))
+                        self.assertAlmostEqual(phot.mag, mag)
+
+    def test_run_indef_and_saturation(self):
+
+        # A star with a flux so high that its central pixels are above the
+        # saturation level has a magnitude of infinity; a position with no
+        # star is INDEF (None) if the flux is not positive, and also an
+        # object off the image (although we still get its coordinates).
+
+        stars = [(80.0, 80.0, 1e7), (170.0, 170.0, 1e5)]
+        coords = self.to_coordinates(stars + [(5.0, 128.0, 0)])
+        coords.append(astromatic.Coordinates(100.0, 11.0)) # one degree away
+
+        with self.mkfits(stars) as img:
+            kwargs = dict(self.RUN_KWARGS, maximum = 50000)
+            result = aperture.run(img, coords, **kwargs)
+
+            self.assertEqual(result[0].mag, float('infinity'))
+            self.assertTrue(0 < result[1].mag < float('infinity'))
+            # Within 'aperture' pixels of the left edge of the image
+            self.assertEqual(result[2].mag, None)
+            self.assertEqual(result[3].mag, None)
+            self.assertEqual(result[3].stdev, None)
+
+        # A position with only sky: the flux is zero within the noise, so,
+        # when negative, the magnitude must be INDEF, never a number.
+        for _ in xrange(NITERS):
+            with self.mkfits([]) as img:
+                empty = self.to_coordinates([(128.0, 128.0, 0)])
+                phot = aperture.run(img, empty, **self.RUN_KWARGS)[0]
+                if phot.flux <= 0:
+                    self.assertEqual(phot.mag, None)
+
+    def test_run_missing_exptime(self):
+
+        # The magnitudes are not normalized (and a warning is issued) if
+        # the exposure time cannot be read from the FITS header.
+        stars = [(128.0, 128.0, 1e5)]
+        coords = self.to_coordinates(stars)
+        with self.mkfits(stars) as img:
+            kwargs = dict(self.RUN_KWARGS, exptimek = 'MISSING')
+            with warnings.catch_warnings(record = True) as w:
+                warnings.simplefilter('always')
+                phot = aperture.run(img, coords, **kwargs)[0]
+                self.assertTrue(any(issubclass(x.category,
+                                               qphot.MissingFITSKeyword)
+                                    for x in w))
+            mag = aperture.ZMAG - 2.5 * math.log10(phot.flux)
+            self.assertAlmostEqual(phot.mag, mag)
+
+    def test_run_apertures(self):
+
+        # Measuring several apertures at once must give the same results as
+        # measuring them one by one, including the saturation: a star whose
+        # only saturated pixel is at some distance from the center is
+        # saturated in the larger apertures, but not in the smaller ones.
+        stars = [(80.0, 80.0, 2e5), (170.0, 170.0, 1e5)]
+        coords = self.to_coordinates(stars)
+        apertures = [4, 6, 10]
+
+        with self.mkfits(stars) as img:
+            handler = pyfits.open(img.path, mode = 'update')
+            handler[0].data[79, 87] = 1e6 # pixel (88, 80), eight pixels away
+            handler.close()
+
+            kwargs = dict(self.RUN_KWARGS, cbox = 5)
+            del kwargs['aperture']
+            result = aperture.run_apertures(img, coords,
+                                            apertures = apertures, **kwargs)
+            self.assertEqual(len(result), len(apertures))
+
+            for radius, aperture_phot in zip(apertures, result):
+                expected = aperture.run(img, coords, aperture = radius, **kwargs)
+                self.assertEqual(aperture_phot, expected)
+
+            self.assertTrue(result[0][0].mag < float('infinity'))
+            self.assertEqual(result[2][0].mag, float('infinity'))
+            self.assertTrue(all(x[1].mag < float('infinity') for x in result))
+
+            # The flux increases with the aperture (the curve of growth)
+            fluxes = [x[1].flux for x in result]
+            self.assertEqual(fluxes, sorted(fluxes))
+
+    def test_nan_stats(self):
+
+        # The same values as the NaN-aware functions of NumPy >= 1.9, with
+        # rows of different (even and odd) numbers of values, one of them
+        # with a single value and another one with none at all.
+        for _ in xrange(NITERS):
+            values = numpy.random.normal(500, 5, (6, random.randint(10, 50)))
+            for row in values[:4]:
+                nans = random.sample(xrange(len(row)), random.randint(0, 9))
+                row[nans] = numpy.nan
+            values[4, 1:] = numpy.nan
+            values[5, :] = numpy.nan
+
+            mean, median, stdev = aperture.nan_stats(values)
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)
+                expected = (numpy.nanmean(values, axis = 1),
+                            numpy.nanmedian(values, axis = 1),
+                            numpy.nanstd(values, axis = 1, ddof = 1))
+            for result, nan_result in zip((mean, median, stdev), expected):
+                numpy.testing.assert_allclose(result, nan_result)
+
+    def test_fit_sky(self):
+
+        # The sky of a flat distribution with outliers (for example, stars
+        # in the annulus) must not be affected by them. Rows of NaN (objects
+        # without any sky pixels) have a sky and standard deviation of NaN.
+        values = numpy.random.normal(500, 5, (3, 400))
+        values[0, :20] = 5000
+        values[1, :] = numpy.nan
+        values[2, 200:] = numpy.nan
+        skies, stdevs = aperture.fit_sky(values)
+        self.assertAlmostEqual(skies[0], 500, delta = 4)
+        self.assertAlmostEqual(stdevs[0], 5, delta = 1)
+        self.assertTrue(numpy.isnan(skies[1]))
+        self.assertTrue(numpy.isnan(stdevs[1]))
+        self.assertAlmostEqual(skies[2], 500, delta = 5)
+
+    def test_saturated_objects(self):
+
+        # An object is saturated if any pixel partially inside the aperture
+        # (less than aperture + 0.5 pixels away from the center) is above the
+        # saturation level, but not if the pixel is just outside. Objects off
+        # the image, or with non-finite coordinates, are never saturated.
+        data = numpy.zeros((100, 100))
+        data[49, 59] = 100  # pixel (60, 50), one-based
+        xs = [50.0, 50.6, 49.4, -1.0, numpy.nan, 60.0]
+        ys = [50.0, 50.0, 50.0, -1.0, numpy.nan, 50.0]
+        result = aperture.saturated_objects(data, xs, ys, 10, 99)
+        expected = [True, True, False, False, False, True]
+        self.assertEqual(list(result), expected)
+        self.assertFalse(aperture.saturated_objects(data, xs, ys, 10, 100).any())
+        self.assertEqual(len(aperture.saturated_objects(data, [], [], 10, 99)), 0)
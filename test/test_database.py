@@ -36,7 +36,8 @@ import time
 from test import unittest
 import passband
 from database import \
-  (DBStar,
+  (CurveStats,
+   DBStar,
    DuplicateLightCurvePointError,
    DuplicateImageError,
    DuplicatePhotometryError,
@@ -44,7 +45,9 @@ from database import \
    Image,
    LEMONdB,
    LightCurve,
+   LinkedDatabaseError,
    PhotometricParameters,
+   PhotometryMatrix,
    UnknownImageError,
    UnknownStarError)
 
@@ -52,6 +55,7 @@ from diffphot import Weights
 from json_parse import CandidateAnnuli
 import test.test_fitsimage
 # https://stackoverflow.com/q/12603541/184363
+from astromatic import Coordinates
 from test.test_astromatic import CoordinatesTest
 get_random_coords = CoordinatesTest.random
 
@@ -120,13 +124,12 @@ class DBStarTest(unittest.TestCase):
             pfilter = passband.Passband.random()
         size = random.randint(cls.MIN_SIZE, cls.MAX_SIZE)
         phot_info = numpy.empty((3, size))
-        times_indexes = {}
         for index, unix_time in enumerate(runix_times(size)):
             magnitude = random.uniform(cls.MIN_MAG, cls.MAX_MAG)
             snr = random.uniform(cls.MIN_SNR, cls.MAX_SNR)
             phot_info[:,index] = unix_time, magnitude, snr
-            times_indexes[unix_time] = index
-        return id_, pfilter, phot_info, times_indexes
+        times_order = numpy.argsort(phot_info[0])
+        return id_, pfilter, phot_info, times_order
 
     @classmethod
     def random(cls, pfilter = None):
@@ -141,32 +144,36 @@ class DBStarTest(unittest.TestCase):
 
     def test_init(self):
         for _ in xrange(NITERS):
-            id_, pfilter, phot_info, times_indexes = DBStarTest.random_data()
-            star = DBStar(id_, pfilter, phot_info, times_indexes)
+            id_, pfilter, phot_info, times_order = DBStarTest.random_data()
+            star = DBStar(id_, pfilter, phot_info, times_order)
             # Test that the attributes are correctly set at instantiation time
             self.assertEqual(star.id, id_)
             self.assertEqual(star.pfilter, pfilter)
             self.assertTrue(numpy.all(numpy.equal(star._phot_info, phot_info)))
-            self.assertEqual(star._time_indexes, times_indexes)
+            self.assertTrue(numpy.all(numpy.equal(star._times_order, times_order)))
+
+        # The indexes that sort the Unix times are computed if not given
+        star = DBStar(id_, pfilter, phot_info)
+        self.assertTrue(numpy.all(numpy.equal(star._times_order, times_order)))
 
         # ValueError must be raised if 'phot_info' does not have three rows
-        id_, pfilter, phot_info, times_indexes = DBStarTest.random_data()
+        id_, pfilter, phot_info, times_order = DBStarTest.random_data()
         row_index = random.randint(0, 2)
         phot_info = numpy.delete(phot_info, row_index, axis = 0)
         with self.assertRaises(ValueError):
-            DBStar(id_, pfilter, phot_info, times_indexes)
+            DBStar(id_, pfilter, phot_info, times_order)
 
     def test_len(self):
         for _ in xrange(NITERS):
-            id_, pfilter, phot_info, times_indexes = DBStarTest.random_data()
+            id_, pfilter, phot_info, times_order = DBStarTest.random_data()
             size = phot_info.shape[1] # as many photometric records as columns
-            star = DBStar(id_, pfilter, phot_info, times_indexes)
+            star = DBStar(id_, pfilter, phot_info, times_order)
             self.assertEqual(len(star), size)
 
     def test_time_mag_and_snr(self):
         for _ in xrange(NITERS):
-            id_, pfilter, phot_info, times_indexes = DBStarTest.random_data()
-            star = DBStar(id_, pfilter, phot_info, times_indexes)
+            id_, pfilter, phot_info, times_order = DBStarTest.random_data()
+            star = DBStar(id_, pfilter, phot_info, times_order)
             for index in xrange(len(star)):
                 unix_time, magnitude, snr = phot_info[:, index]
                 self.assertEqual(star.time(index), unix_time)
@@ -175,16 +182,20 @@ class DBStarTest(unittest.TestCase):
 
     def test_time_index(self):
         for _ in xrange(NITERS):
-            id_, pfilter, phot_info, times_indexes = DBStarTest.random_data()
-            star = DBStar(id_, pfilter, phot_info, times_indexes)
-            for unix_time in times_indexes.iterkeys():
-                unix_time_index = star._time_index(unix_time)
-                self.assertEqual(unix_time_index, times_indexes[unix_time])
+            id_, pfilter, phot_info, times_order = DBStarTest.random_data()
+            star = DBStar(id_, pfilter, phot_info, times_order)
+            for index, unix_time in enumerate(phot_info[0]):
+                self.assertEqual(star._time_index(unix_time), index)
+
+            # KeyError is raised if the star was not observed at a Unix time
+            unix_time = different_runix_time(phot_info[0])
+            with self.assertRaises(KeyError):
+                star._time_index(unix_time)
 
     def test_unix_times(self):
         for _ in xrange(NITERS):
-            id_, pfilter, phot_info, times_indexes = DBStarTest.random_data()
-            star = DBStar(id_, pfilter, phot_info, times_indexes)
+            id_, pfilter, phot_info, times_order = DBStarTest.random_data()
+            star = DBStar(id_, pfilter, phot_info, times_order)
             self.assertTrue(numpy.all(numpy.equal(star._unix_times, phot_info[0])))
 
     @classmethod
@@ -207,11 +218,7 @@ class DBStarTest(unittest.TestCase):
             snr = random.uniform(cls.MIN_SNR, cls.MAX_SNR)
             sphot_info[1:, index] = magnitude, snr
 
-        stimes_indexes = {}
-        for index, unix_time in enumerate(sphot_info[0, :]):
-            stimes_indexes[unix_time] = index
-
-        subset = DBStar(sid, star.pfilter, sphot_info, stimes_indexes)
+        subset = DBStar(sid, star.pfilter, sphot_info)
         assert 0 < len(subset) <= len(star)
         assert subset.issubset(star)
         return subset
@@ -228,7 +235,6 @@ class DBStarTest(unittest.TestCase):
         sid = random.randint(cls.MIN_ID, cls.MAX_ID)
         to_add = random.randint(0, len(star))
         sphot_info = numpy.copy(star._phot_info)
-        stimes_indexes = star._time_indexes.copy()
 
         for unix_time in runix_times(to_add):
             magnitude = random.uniform(cls.MIN_MAG, cls.MAX_MAG)
@@ -237,12 +243,8 @@ class DBStarTest(unittest.TestCase):
 
             size = sphot_info.shape[1]
             sphot_info = numpy.insert(sphot_info, size, row, axis = 1)
-            stimes_indexes[unix_time] = size
 
-        # There must be no gaps in the indexes mapped by the dictionary
-        assert sorted(stimes_indexes.values()) == range(sphot_info.shape[1])
-
-        superset = DBStar(sid, star.pfilter, sphot_info, stimes_indexes)
+        superset = DBStar(sid, star.pfilter, sphot_info)
         assert star.issubset(superset)
         return superset
 
@@ -284,10 +286,11 @@ class DBStarTest(unittest.TestCase):
                 if unix_time != subset.time(index):
                     break
 
-            # Update the Unix time (a key) in the 'time_indexes' dictionary
-            time_indexes = subset._time_indexes # shorter variable name
-            time_indexes[unix_time] = time_indexes.pop(subset.time(index))
-            subset._phot_info[0][index] = unix_time
+            # The sorted Unix times are computed at instantiation time,
+            # so we need a new DBStar with the modified Unix time
+            sphot_info = numpy.copy(subset._phot_info)
+            sphot_info[0][index] = unix_time
+            subset = DBStar(subset.id, subset.pfilter, sphot_info)
             assert subset.time(index) == unix_time
             self.assertFalse(subset.issubset(original))
 
@@ -341,11 +344,13 @@ class DBStarTest(unittest.TestCase):
                 self.assertEqual(trimmed.mag(index), original.mag(oindex))
                 self.assertEqual(trimmed.snr(index), original.snr(oindex))
 
-            # The internal dictionaries mapping each Unix time to its position
-            # in '_phot_info' must be identical, as both stars contain now
-            # information for exactly the same Unix times, in the same order.
+            # The Unix times and the indexes that sort them must be identical,
+            # as both stars contain now information for exactly the same Unix
+            # times, in the same order.
             self.assertTrue(numpy.all(numpy.equal(trimmed._unix_times,
                                                   subset._unix_times)))
+            self.assertTrue(numpy.all(numpy.equal(trimmed._times_order,
+                                                  subset._times_order)))
 
         # KeyError is raised if we attempt to trim a star which is not a subset
         star = DBStarTest.random()
@@ -412,7 +417,7 @@ class DBStarTest(unittest.TestCase):
 
         # Now random test cases
         for _ in xrange(NITERS):
-            id_, pfilter, phot_info, times_indexes = self.random_data()
+            id_, pfilter, phot_info, times_order = self.random_data()
             # Construct the row of three-element tuples, out of this random
             # NumPy array, and then check that the array in the DBStar returned
             # by DBStar.make_star is equal than this input, original array.
@@ -421,7 +426,7 @@ class DBStarTest(unittest.TestCase):
             self.assertEqual(star.id, id_)
             self.assertEqual(star.pfilter, pfilter)
             self.assertTrue(numpy.all(numpy.equal(star._phot_info, phot_info)))
-            self.assertEqual(star._time_indexes, times_indexes)
+            self.assertTrue(numpy.all(numpy.equal(star._times_order, times_order)))
 
     @staticmethod
     def equal(first, second):
@@ -712,6 +717,38 @@ class LightCurveTest(unittest.TestCase):
                 self.assertEqual(len(curve), index + 1)
                 self.assertEqual(curve[index], point)
 
+    def test_extend(self):
+        for _ in xrange(NITERS):
+            curve = self.random()
+            expected = []
+            for _ in xrange(random.randint(1, 5)):
+                size = random.randint(MIN_NSTARS, MAX_NSTARS)
+                points = list(self.random_points(size))
+                curve.extend(*zip(*points))
+                expected.extend(points)
+                self.assertEqual(len(curve), len(expected))
+
+            self.assertEqual(curve[:], expected)
+            expected.sort(key = operator.itemgetter(0))
+            self.assertEqual(list(curve), expected)
+
+            unix_times, magnitudes, snrs = zip(*expected)
+            self.assertEqual(tuple(curve.unix_times), unix_times)
+            self.assertEqual(tuple(curve.magnitudes), magnitudes)
+            self.assertEqual(tuple(curve.snrs), snrs)
+
+        # If 'snrs' is not given, so is the SNR of all the points (None)
+        curve = self.random()
+        curve.extend([15000, 12000], [14.5, 15.6])
+        self.assertEqual(list(curve), [(12000, 15.6, None), (15000, 14.5, None)])
+        self.assertTrue(numpy.isnan(curve.snrs).all())
+
+        # ValueError raised if the lengths of the sequences do not match
+        with self.assertRaises(ValueError):
+            curve.extend([16000, 17000], [14.5])
+        with self.assertRaises(ValueError):
+            curve.extend([16000, 17000], [14.5, 14.6], [100])
+
     def test_iter(self):
 
         # A specific, non-random test case...
@@ -1120,6 +1157,44 @@ class LEMONdBTest(unittest.TestCase):
         after_tables = self.images_filters_tables_status(db)
         self.assertEqual(before_tables, after_tables)
 
+    def test_get_image_id(self):
+
+        def get_image_id_query(db, unix_time, pfilter):
+            """ Read the ID of the image directly from the database """
+            t = (unix_time, hash(pfilter))
+            db._execute("SELECT id FROM images "
+                        "WHERE unix_time = ? AND filter_id = ?", t)
+            return list(db._rows)[0][0]
+
+        db = LEMONdB(':memory:')
+        nimages = random.randint(self.MIN_NIMAGES, self.MAX_NIMAGES)
+        images = list(ImageTest.nrandom(nimages))
+
+        # Half of the images are added before the IDs are first read from the
+        # database (LEMONdB._get_image_id loads them all), and the other half
+        # afterwards, so LEMONdB.add_image has to keep the cache up to date.
+        middle = len(images) // 2
+        for img in images[:middle]:
+            db.add_image(img)
+        for img in images[:middle]:
+            expected = get_image_id_query(db, img.unix_time, img.pfilter)
+            self.assertEqual(db._get_image_id(img.unix_time, img.pfilter), expected)
+
+        for img in images[middle:]:
+            db.add_image(img)
+            with self.assertRaises(DuplicateImageError):
+                db.add_image(img)
+
+        random.shuffle(images)
+        for img in images:
+            expected = get_image_id_query(db, img.unix_time, img.pfilter)
+            unix_time = numpy.float64(img.unix_time)
+            self.assertEqual(db._get_image_id(unix_time, img.pfilter), expected)
+
+        with self.assertRaises(KeyError):
+            unix_time = different_runix_time([img.unix_time for img in images])
+            db._get_image_id(unix_time, images[0].pfilter)
+
     def test_add_and_get_image_None_fields(self):
 
         def img_None_attr(attr):
@@ -1330,6 +1405,28 @@ class LEMONdBTest(unittest.TestCase):
             db.add_star(*star_info)
             self.assertEqual(sorted(stars_ids), db.star_ids)
 
+    def test_has_star_and_star_exists(self):
+        db = LEMONdB(':memory:')
+        size = random.randint(MIN_NSTARS, MAX_NSTARS)
+        stars_ids = []
+        for star_info in self.random_stars_info(size):
+            id_ = star_info[0]
+            self.assertFalse(db._has_star(id_))
+            self.assertFalse(db._star_exists(id_))
+            db.add_star(*star_info)
+            stars_ids.append(id_)
+            # The in-memory set must be invalidated by LEMONdB.add_star()
+            self.assertTrue(db._has_star(id_))
+            self.assertTrue(db._star_exists(numpy.int32(id_)))
+
+        for id_ in xrange(self.MIN_ID, self.MAX_ID + 1):
+            expected = id_ in stars_ids
+            self.assertEqual(db._has_star(id_), expected)
+            self.assertEqual(db._has_star(numpy.int64(id_)), expected)
+
+        for id_ in random.sample(xrange(self.MIN_ID, self.MAX_ID + 1), size):
+            self.assertEqual(db._star_exists(id_), id_ in stars_ids)
+
     @classmethod
     def random_stars(cls, size, unix_times):
         """ Return a generator which steps through 'size' random DBstars.
@@ -1627,6 +1724,614 @@ class LEMONdBTest(unittest.TestCase):
         empty_star = db.get_photometry(star_id, johnson_V)
         self.assertEqual(len(empty_star), 0)
 
+    def test_add_photometry_batch(self):
+
+        db = LEMONdB(':memory:')
+        johnson_B = passband.Passband('B')
+        star_ids = range(5)
+        for id_ in star_ids:
+            db.add_star(*self.random_star_info(id_ = id_))
+
+        img1 = ImageTest.random(johnson_B)
+        img2 = ImageTest.random(johnson_B)
+        img2 = img2._replace(unix_time = different_runix_time([img1.unix_time]))
+        db.add_image(img1)
+        db.add_image(img2)
+
+        records = [(numpy.int32(id_),
+                    numpy.float64(random.uniform(self.MIN_MAG, self.MAX_MAG)),
+                    random.uniform(self.MIN_SNR, self.MAX_SNR))
+                   for id_ in star_ids]
+        db.add_photometry_batch(img1, records)
+
+        # The records must be exactly the same as if they had been stored,
+        # one by one, using LEMONdB.add_photometry()
+        for star_id, magnitude, snr in records:
+            star = db.get_photometry(star_id, johnson_B)
+            self.assertEqual(len(star), 1)
+            self.assertEqual(star.time(0), img1.unix_time)
+            self.assertEqual(star.mag(0), magnitude)
+            self.assertEqual(star.snr(0), snr)
+
+        def photometry_count(db):
+            db._execute("SELECT COUNT(*) FROM photometry")
+            return list(db._rows)[0][0]
+
+        # Nothing is stored if any of the errors is raised, all of them
+        # listing (in the case of the stars) all the offending star IDs.
+        nrecords = photometry_count(db)
+
+        img3 = ImageTest.random(johnson_B)
+        img3 = img3._replace(unix_time = different_runix_time(
+                             [img1.unix_time, img2.unix_time]))
+        with self.assertRaises(UnknownImageError):
+            db.add_photometry_batch(img3, records)
+        self.assertEqual(photometry_count(db), nrecords)
+
+        unknown = records[:2] + [(7, 14.5, 100), (9, 15.1, 150)]
+        regexp = "stars with ID = 7, 9 not in database"
+        with self.assertRaisesRegexp(UnknownStarError, regexp):
+            db.add_photometry_batch(img2, unknown)
+        self.assertEqual(photometry_count(db), nrecords)
+
+        regexp = "photometry for stars with ID = 1, 3, Unix time"
+        with self.assertRaisesRegexp(DuplicatePhotometryError, regexp):
+            db.add_photometry_batch(img1, [records[1], records[3]])
+        with self.assertRaisesRegexp(DuplicatePhotometryError, regexp):
+            db.add_photometry_batch(img2, records + [records[1], records[3]])
+        self.assertEqual(photometry_count(db), nrecords)
+
+        # An empty batch does nothing
+        db.add_photometry_batch(img2, [])
+        self.assertEqual(photometry_count(db), nrecords)
+
+    def test_aperture_photometry(self):
+
+        db = LEMONdB(':memory:')
+        johnson_V = passband.Passband('V')
+        star_ids = range(4)
+        for id_ in star_ids:
+            db.add_star(*self.random_star_info(id_ = id_))
+
+        img1 = ImageTest.random(johnson_V)
+        img2 = ImageTest.random(johnson_V)
+        img2 = img2._replace(unix_time = different_runix_time([img1.unix_time]))
+        db.add_image(img1)
+        db.add_image(img2)
+
+        self.assertEqual(db.aperture_pparams, [])
+        pparams = [PhotometricParameters(aperture, 10, 5)
+                   for aperture in (4.5, 2.5, 3)]
+
+        def random_records():
+            return [(id_, random.uniform(self.MIN_MAG, self.MAX_MAG),
+                     random.uniform(self.MIN_SNR, self.MAX_SNR))
+                    for id_ in star_ids]
+
+        # Map each PhotometricParameters to the records of the two images
+        stored = {}
+        for params in pparams:
+            stored[params] = random_records(), random_records()
+            db.add_aperture_photometry_batch(img1, params, stored[params][0])
+            db.add_aperture_photometry_batch(img2, params, stored[params][1])
+
+        # The aperture photometry is not the photometry of the LEMONdB...
+        self.assertEqual(len(db.get_photometry(0, johnson_V)), 0)
+        expected = sorted(pparams, key = operator.attrgetter('aperture'))
+        self.assertEqual(db.aperture_pparams, expected)
+
+        # ... until one of the apertures is selected, which replaces it
+        db.add_photometry_batch(img1, random_records())
+        for params in (pparams[1], pparams[0]):
+            db.select_aperture_photometry(params)
+            for star_id in star_ids:
+                star = db.get_photometry(star_id, johnson_V)
+                self.assertEqual(len(star), 2)
+                for index, img in enumerate((img1, img2)):
+                    _, magnitude, snr = stored[params][index][star_id]
+                    position = star._time_index(img.unix_time)
+                    self.assertEqual(star.mag(position), magnitude)
+                    self.assertEqual(star.snr(position), snr)
+
+        # Records are unique for each star, image and set of parameters
+        regexp = "photometry for stars with ID = 2, Unix time"
+        with self.assertRaisesRegexp(DuplicatePhotometryError, regexp):
+            db.add_aperture_photometry_batch(img1, pparams[2],
+                                             [stored[pparams[2]][0][2]])
+        db.add_aperture_photometry_batch(img1, pparams[0]._replace(annulus = 11),
+                                         stored[pparams[2]][0])
+
+        unknown = PhotometricParameters(7, 10, 5)
+        self.assertRaises(KeyError, db.select_aperture_photometry, unknown)
+        # The photometry has not been modified
+        self.assertEqual(len(db.get_photometry(0, johnson_V)), 2)
+
+    def test_get_photometry_matrix(self):
+
+        db = LEMONdB(':memory:')
+        nstars = random.randint(MIN_NSTARS, MAX_NSTARS)
+        stars_ids = [star_info[0] for star_info in self.random_stars_info(nstars)]
+        for star_id in stars_ids:
+            db.add_star(*self.random_star_info(id_ = star_id))
+
+        nimages = random.randint(self.MIN_NIMAGES, self.MAX_NIMAGES)
+        images = list(ImageTest.nrandom(nimages))
+        for img in images:
+            db.add_image(img)
+            records = []
+            for star_id in stars_ids:
+                if random.random() < self.OBSERVED_PROB:
+                    mag = random.uniform(self.MIN_MAG, self.MAX_MAG)
+                    snr = random.uniform(self.MIN_SNR, self.MAX_SNR)
+                    records.append((star_id, mag, snr))
+            db.add_photometry_batch(img, records)
+
+        # The matrix must contain exactly the same information that is
+        # returned, star by star, by LEMONdB.get_photometry()
+        for pfilter in set(img.pfilter for img in images):
+            matrix = db.get_photometry_matrix(pfilter)
+            self.assertEqual(matrix.pfilter, pfilter)
+            self.assertEqual(list(matrix.star_ids), sorted(stars_ids))
+            self.assertEqual(list(matrix.unix_times),
+                             sorted(matrix.unix_times))
+
+            shape = (len(stars_ids), len(matrix.unix_times))
+            self.assertEqual(matrix.magnitudes.shape, shape)
+            self.assertEqual(matrix.snrs.shape, shape)
+            self.assertEqual(matrix.mask.shape, shape)
+            self.assertTrue(numpy.all(numpy.isnan(matrix.magnitudes[~matrix.mask])))
+            self.assertTrue(numpy.all(numpy.isnan(matrix.snrs[~matrix.mask])))
+
+            for index, star_id in enumerate(matrix.star_ids):
+                expected = db.get_photometry(star_id, pfilter)
+                star = matrix.star(index)
+                self.assertEqual(star.id, star_id)
+                self.assertEqual(star.pfilter, pfilter)
+                self.assertTrue(DBStarTest.equal(star, expected))
+                self.assertEqual(matrix.mask[index].sum(), len(expected))
+
+            self.assertEqual(len(matrix.stars()), len(stars_ids))
+
+        # A filter with no photometric records
+        matrix = db.get_photometry_matrix(passband.Passband('Z'))
+        self.assertEqual(len(matrix.unix_times), 0)
+        self.assertEqual(matrix.mask.shape, (len(stars_ids), 0))
+        for star in matrix.stars():
+            self.assertEqual(len(star), 0)
+
+    def test_photometry_matrix_complete_indexes(self):
+
+        for _ in xrange(NITERS // 10):
+            # Draw the mask of each star from a small pool, so that many of
+            # them have identical masks and others are a subset of each other
+            nstars = random.randint(MIN_NSTARS, MAX_NSTARS)
+            nimages = random.randint(1, self.MAX_NIMAGES)
+            pool = numpy.random.random((5, nimages)) < self.OBSERVED_PROB
+            pool[0] = True
+            mask = pool[numpy.random.randint(0, len(pool), nstars)]
+
+            star_ids = numpy.arange(1, nstars + 1)
+            unix_times = numpy.array(sorted(runix_times(nimages)))
+            magnitudes = numpy.random.uniform(self.MIN_MAG, self.MAX_MAG,
+                                              mask.shape)
+            snrs = numpy.random.uniform(self.MIN_SNR, self.MAX_SNR, mask.shape)
+            magnitudes[~mask] = snrs[~mask] = numpy.nan
+            args = (passband.Passband.random(), star_ids, unix_times,
+                    magnitudes, snrs, mask)
+            matrix = PhotometryMatrix(*args)
+
+            # The same stars that DBStar.complete_for finds
+            stars = matrix.stars()
+            complete_indexes = matrix.complete_indexes()
+            self.assertEqual(len(complete_indexes), nstars)
+            for star, indexes in zip(stars, complete_indexes):
+                complete_ids = [cstar.id for cstar in star.complete_for(stars)]
+                self.assertEqual(sorted(complete_ids),
+                                 sorted(star_ids[indexes].tolist()))
+
+    def test_bulk_load(self):
+
+        def count(db, table):
+            db._execute("SELECT COUNT(*) FROM %s" % table)
+            return list(db._rows)[0][0]
+
+        def pragma(db, name):
+            db._execute("PRAGMA %s" % name)
+            return list(db._rows)[0][0]
+
+        path = self.random_path()
+        try:
+            db = LEMONdB(path)
+            johnson_V = passband.Passband('V')
+            ntriggers = count(db, "sqlite_master WHERE type = 'trigger'")
+            self.assertTrue(ntriggers > 0)
+
+            # Non-default values, which must be restored on exit
+            db._execute("PRAGMA cache_size = -3000")
+            db._execute("PRAGMA mmap_size = 4096")
+            mmap_size = pragma(db, 'mmap_size')
+
+            star_ids = range(5)
+            images = list(ImageTest.nrandom(3, pfilter = johnson_V))
+            with db.bulk_load():
+                self.assertEqual(pragma(db, 'foreign_keys'), 0)
+                self.assertEqual(pragma(db, 'journal_mode'), 'wal')
+                for id_ in star_ids:
+                    db.add_star(*self.random_star_info(id_ = id_))
+                for img in images:
+                    db.add_image(img)
+                    for id_ in star_ids:
+                        db.add_photometry(id_, img.unix_time, johnson_V,
+                                          14.5, 100)
+
+            # Data committed, original configuration restored
+            self.assertEqual(len(db), len(star_ids))
+            self.assertEqual(count(db, 'photometry'), len(images) * len(star_ids))
+            self.assertEqual(pragma(db, 'foreign_keys'), 1)
+            self.assertEqual(pragma(db, 'journal_mode'), 'delete')
+            self.assertEqual(pragma(db, 'synchronous'), 2) # FULL
+            self.assertEqual(pragma(db, 'cache_size'), -3000)
+            self.assertEqual(pragma(db, 'mmap_size'), mmap_size)
+            self.assertEqual(count(db, "sqlite_master WHERE type = 'trigger'"),
+                             ntriggers)
+
+            # Photometry for an unknown star is not detected until the with
+            # statement exits, and everything since it started is rolled back
+            img = images[0]._replace(unix_time = different_runix_time(
+                                     [x.unix_time for x in images]))
+            with self.assertRaisesRegexp(sqlite3.IntegrityError, "foreign key"):
+                with db.bulk_load():
+                    db.add_image(img)
+                    db.add_photometry(99, img.unix_time, johnson_V, 14.5, 100)
+
+            self.assertEqual(count(db, 'images'), len(images))
+            self.assertEqual(count(db, 'photometry'), len(images) * len(star_ids))
+            with self.assertRaises(KeyError):
+                db._get_image_id(img.unix_time, img.pfilter)
+
+            # The same goes for the conditions enforced by the triggers
+            img = img._replace(ra = 360.5)
+            with self.assertRaisesRegexp(sqlite3.IntegrityError, "RA out of range"):
+                with db.bulk_load():
+                    db.add_image(img)
+
+            self.assertEqual(count(db, 'images'), len(images))
+            self.assertEqual(pragma(db, 'foreign_keys'), 1)
+            self.assertEqual(count(db, "sqlite_master WHERE type = 'trigger'"),
+                             ntriggers)
+            with self.assertRaisesRegexp(sqlite3.IntegrityError, "RA out of range"):
+                db.add_image(img)
+
+            # What is committed within the with statement survives an error
+            # raised later, while the changes since the last commit do not
+            unix_times = [x.unix_time for x in images]
+            new_images = []
+            for index in xrange(2):
+                new_time = different_runix_time(unix_times)
+                unix_times.append(new_time)
+                new_images.append(images[0]._replace(unix_time = new_time))
+
+            with self.assertRaises(ZeroDivisionError):
+                with db.bulk_load():
+                    db.add_image(new_images[0])
+                    db.commit()
+                    db.add_image(new_images[1])
+                    1 / 0
+
+            self.assertEqual(count(db, 'images'), len(images) + 1)
+            db._get_image_id(new_images[0].unix_time, johnson_V)
+            with self.assertRaises(KeyError):
+                db._get_image_id(new_images[1].unix_time, johnson_V)
+            self.assertEqual(pragma(db, 'foreign_keys'), 1)
+            self.assertEqual(count(db, "sqlite_master WHERE type = 'trigger'"),
+                             ntriggers)
+
+            # An intermediate commit validates the rows inserted since the
+            # previous one, and the triggers are never dropped, so another
+            # connection to the database, opened meanwhile, can see them
+            new_time = different_runix_time(unix_times)
+            img = images[0]._replace(unix_time = new_time)
+            with self.assertRaisesRegexp(sqlite3.IntegrityError, "foreign key"):
+                with db.bulk_load():
+                    db.add_image(img)
+                    db.add_photometry(99, img.unix_time, johnson_V, 14.5, 100)
+                    db.commit()
+
+            self.assertEqual(count(db, 'images'), len(images) + 1)
+            with self.assertRaises(KeyError):
+                db._get_image_id(img.unix_time, johnson_V)
+
+            with self.assertRaisesRegexp(sqlite3.IntegrityError, "foreign key"):
+                with db.bulk_load():
+                    db.add_image(img)
+                    db.add_photometry(0, img.unix_time, johnson_V, 14.5, 100)
+                    db.commit()
+                    db.add_photometry(99, img.unix_time, johnson_V, 17.5, 100)
+                    db.commit()
+
+            self.assertEqual(count(db, 'images'), len(images) + 2)
+            self.assertEqual(count(db, 'photometry'),
+                             len(images) * len(star_ids) + 1)
+            db._execute("DELETE FROM photometry WHERE image_id = ?",
+                        (db._get_image_id(img.unix_time, johnson_V),))
+            db._execute("DELETE FROM images WHERE unix_time = ?",
+                        (img.unix_time,))
+            db.commit()
+
+            with db.bulk_load():
+                self.assertEqual(count(db, "sqlite_master WHERE type = 'trigger'"),
+                                 ntriggers)
+                db.add_image(img)
+                db.commit()
+                other = sqlite3.connect(path)
+                rows = other.execute("SELECT COUNT(*) FROM sqlite_master "
+                                     "WHERE type = 'trigger'").fetchall()
+                other.close()
+                self.assertEqual(rows[0][0], ntriggers)
+
+        finally:
+            os.unlink(path)
+
+    def test_pack_and_unpack(self):
+
+        def count(db, table):
+            db._execute("SELECT COUNT(*) FROM %s" % table)
+            return list(db._rows)[0][0]
+
+        def snapshot(db, star_ids, pfilters):
+            """ Return a dictionary with everything that can be read, star by
+            star and filter by filter, about the photometry and light curves """
+
+            info = {'pfilters' : db.pfilters}
+            for pfilter in pfilters:
+                matrix = db.get_photometry_matrix(pfilter)
+                # Only the values not masked out: NaN != NaN
+                info[pfilter] = (matrix.unix_times.tolist(),
+                                 matrix.magnitudes[matrix.mask].tolist(),
+                                 matrix.snrs[matrix.mask].tolist(),
+                                 matrix.mask.tolist())
+                for star_id in star_ids:
+                    star = db.get_photometry(star_id, pfilter)
+                    records = [(star.time(x), star.mag(x), star.snr(x))
+                               for x in xrange(len(star))]
+                    curve = db.get_light_curve(star_id, pfilter)
+                    points = list(curve) if curve is not None else None
+                    magnitudes = db.get_instrumental_magnitudes(star_id, pfilter)
+                    info[(star_id, pfilter)] = (records, points, magnitudes)
+
+            for star_id in star_ids:
+                info[star_id] = db._star_pfilters(star_id)
+            return info
+
+        db = LEMONdB(':memory:')
+        nstars = random.randint(MIN_NSTARS, MAX_NSTARS)
+        star_ids = [info[0] for info in self.random_stars_info(nstars)]
+        for star_id in star_ids:
+            db.add_star(*self.random_star_info(id_ = star_id))
+
+        nimages = random.randint(self.MIN_NIMAGES, self.MAX_NIMAGES)
+        images = list(ImageTest.nrandom(nimages))
+        for img in images:
+            db.add_image(img)
+            records = []
+            for star_id in star_ids:
+                if random.random() < self.OBSERVED_PROB:
+                    mag = random.uniform(self.MIN_MAG, self.MAX_MAG)
+                    snr = random.uniform(self.MIN_SNR, self.MAX_SNR)
+                    records.append((star_id, mag, snr))
+            db.add_photometry_batch(img, records)
+
+        pfilters = set(img.pfilter for img in images)
+        if len(star_ids) > 1:
+            for pfilter in pfilters:
+                star_id, cstar_id = random.sample(star_ids, 2)
+                curve = LightCurveTest.random(pfilter = pfilter, cstars = [cstar_id])
+                pimages = [img for img in images if img.pfilter == pfilter]
+                db.add_light_curve(star_id, LightCurveTest.populate(curve, pimages))
+
+        # Packing the records does not change what is read from the database
+        expected = snapshot(db, star_ids, pfilters)
+        nphotometry = count(db, 'photometry')
+        ncurves = count(db, 'light_curves')
+        db.pack()
+        self.assertEqual(count(db, 'photometry'), 0)
+        self.assertEqual(count(db, 'light_curves'), 0)
+        self.assertEqual(snapshot(db, star_ids, pfilters), expected)
+
+        # Records added after packing are combined with the packed ones...
+        img = ImageTest.random(images[0].pfilter)
+        img = img._replace(unix_time = different_runix_time(
+                           [x.unix_time for x in images]))
+        db.add_image(img)
+        images.append(img)
+        records = [(star_id, random.uniform(self.MIN_MAG, self.MAX_MAG),
+                    random.uniform(self.MIN_SNR, self.MAX_SNR))
+                   for star_id in star_ids]
+        db.add_photometry_batch(img, records)
+        expected = snapshot(db, star_ids, pfilters)
+        for star_id, mag, snr in records:
+            star = db.get_photometry(star_id, img.pfilter)
+            self.assertEqual(star.mag(star._time_index(img.unix_time)), mag)
+
+        # ... until they are packed too
+        db.pack()
+        self.assertEqual(count(db, 'photometry'), 0)
+        self.assertEqual(snapshot(db, star_ids, pfilters), expected)
+
+        # A record for a star and image already in the packed format is
+        # detected as it is added, also for the images stored earlier...
+        star_id, mag, snr = records[0]
+        with self.assertRaises(DuplicatePhotometryError):
+            db.add_photometry(star_id, img.unix_time, img.pfilter, mag, snr)
+        with self.assertRaisesRegexp(DuplicatePhotometryError, str(star_id)):
+            db.add_photometry_batch(img, records[:1])
+        with self.assertRaises(DuplicatePhotometryError):
+            db.add_photometry_batch(images[0], records)
+        self.assertEqual(count(db, 'photometry'), 0)
+        self.assertEqual(snapshot(db, star_ids, pfilters), expected)
+
+        # ... while for the images added after packing there are no packed
+        # records, so the stars are not looked for in them
+        new_img = img._replace(unix_time = different_runix_time(
+                               [x.unix_time for x in images]))
+        db.add_image(new_img)
+        db.add_photometry_batch(new_img, records)
+        self.assertEqual(count(db, 'photometry'), len(records))
+        with self.assertRaises(DuplicatePhotometryError):
+            db.add_photometry(star_id, new_img.unix_time,
+                              new_img.pfilter, mag, snr)
+        db._execute("DELETE FROM photometry")
+        db._execute("DELETE FROM images WHERE unix_time = ?",
+                    (new_img.unix_time,))
+        db._image_ids_cache = None
+
+        # If a duplicate record makes it into the database anyway (e.g., by
+        # an older version of LEMON), it is detected when packing, which is
+        # then rolled back
+        db._execute("DELETE FROM metadata WHERE key = 'PACKED_IMAGE_ID'")
+        db.add_photometry(star_id, img.unix_time, img.pfilter, mag, snr)
+        with self.assertRaisesRegexp(sqlite3.IntegrityError, "same Unix time"):
+            db.pack()
+        self.assertEqual(count(db, 'photometry'), 1)
+        db._execute("DELETE FROM photometry")
+
+        # Finally, convert everything back to rows
+        db.unpack()
+        self.assertEqual(count(db, 'packed_photometry'), 0)
+        self.assertEqual(count(db, 'packed_light_curves'), 0)
+        self.assertEqual(count(db, 'photometry'), nphotometry + len(records))
+        self.assertEqual(count(db, 'light_curves'), ncurves)
+        self.assertEqual(snapshot(db, star_ids, pfilters), expected)
+
+    def test_link_photometry_and_materialize(self):
+
+        def count(db, table):
+            db._execute("SELECT COUNT(*) FROM main.%s" % table)
+            return list(db._rows)[0][0]
+
+        input_path = self.random_path()
+        output_path = self.random_path()
+        try:
+            # A LEMONdB with stars, images and photometric records
+            idb = LEMONdB(input_path)
+            nstars = random.randint(MIN_NSTARS, MAX_NSTARS)
+            star_ids = [info[0] for info in self.random_stars_info(nstars)]
+            for star_id in star_ids:
+                idb.add_star(*self.random_star_info(id_ = star_id))
+
+            nimages = random.randint(self.MIN_NIMAGES, self.MAX_NIMAGES)
+            images = list(ImageTest.nrandom(nimages))
+            for img in images:
+                idb.add_image(img)
+                records = [(star_id,
+                            random.uniform(self.MIN_MAG, self.MAX_MAG),
+                            random.uniform(self.MIN_SNR, self.MAX_SNR))
+                           for star_id in star_ids]
+                idb.add_photometry_batch(img, records)
+
+            idb.id = ''.join(random.sample(string.hexdigits, 16))
+            idb.commit()
+            pfilters = idb.pfilters
+
+            db = LEMONdB(output_path)
+            db.link_photometry(input_path)
+            db._execute("SELECT name FROM main.sqlite_master")
+            self.assertFalse('photometry' in [x[0] for x in db._rows])
+            self.assertEqual(db.star_ids, idb.star_ids)
+            self.assertEqual(db.pfilters, pfilters)
+            self.assertEqual(db.id, idb.id)
+
+            # Everything is read transparently from the linked LEMONdB...
+            def assertSamePhotometry(db, idb):
+                for pfilter in pfilters:
+                    for star_id in star_ids:
+                        self.assertEqual(db.get_star(star_id),
+                                         idb.get_star(star_id))
+                        star = db.get_photometry(star_id, pfilter)
+                        expected = idb.get_photometry(star_id, pfilter)
+                        self.assertTrue(DBStarTest.equal(star, expected))
+
+            assertSamePhotometry(db, idb)
+            ra, dec = idb.get_star(star_ids[0])[2:4]
+            self.assertEqual(db.stars_within(ra, dec, 1),
+                             idb.stars_within(ra, dec, 1))
+
+            # ... which is opened read-only, while light curves are stored in
+            # the linked LEMONdB, also after it is opened again
+            if len(star_ids) > 1:
+                pfilter = pfilters[0]
+                curve = LightCurveTest.random(pfilter = pfilter,
+                                              cstars = [star_ids[1]])
+                pimages = [img for img in images if img.pfilter == pfilter]
+                curve = LightCurveTest.populate(curve, pimages)
+                db.add_light_curve(star_ids[0], curve)
+                db.commit()
+                self.assertEqual(count(db, 'light_curves'), len(curve))
+                self.assertEqual(idb.get_light_curve(star_ids[0], pfilter), None)
+
+            img = images[0]
+            with self.assertRaisesRegexp(sqlite3.OperationalError, "readonly"):
+                db.add_photometry(star_ids[0], img.unix_time, img.pfilter, 1, 1)
+
+            del db
+            db = LEMONdB(output_path)
+            assertSamePhotometry(db, idb)
+            if len(star_ids) > 1:
+                ocurve = db.get_light_curve(star_ids[0], pfilter)
+                LightCurveTest.assertThatAreEqual(self, curve, ocurve)
+
+            with self.assertRaisesRegexp(ValueError, "already linked"):
+                db.link_photometry(input_path)
+
+            # The linked LEMONdB must not be replaced by a different one. Note
+            # that a read transaction on the linked LEMONdB (a SHARED lock)
+            # prevents it from being modified: end it with commit() first.
+            db.commit()
+            del db
+            idb_id = idb.id
+            idb.id = 'different ID'
+            idb.commit()
+            with self.assertRaisesRegexp(sqlite3.IntegrityError, "has changed"):
+                LEMONdB(output_path)
+            idb.id = idb_id
+            idb.commit()
+            db = LEMONdB(output_path)
+
+            # Once materialized, the linked LEMONdB is no longer needed
+            db.materialize()
+            del db, idb
+            os.unlink(input_path)
+            db = LEMONdB(output_path)
+            self.assertEqual(count(db, 'photometry'), len(star_ids) * nimages)
+            self.assertRaises(AttributeError, db._get_metadata, 'LINKED_DB')
+
+            idb = LEMONdB(input_path)
+            self.assertEqual(len(idb), 0)
+            with self.assertRaisesRegexp(ValueError, "empty"):
+                db.link_photometry(input_path)
+
+            # Nor can the photometry of the linked LEMONdB be modified, even
+            # if its ID is still the same, as in the case of a LEMONdB to which
+            # the photometry of new images is appended.
+            del idb
+            os.unlink(input_path)
+            ldb = LEMONdB(input_path)
+            ldb.link_photometry(output_path)
+            del ldb
+
+            unix_times = [x.unix_time for x in images]
+            img = images[0]._replace(unix_time = different_runix_time(unix_times))
+            db.add_image(img)
+            db.add_photometry_batch(img, [(star_ids[0], 14.5, 100)])
+            db.commit()
+            with self.assertRaisesRegexp(LinkedDatabaseError, "modified"):
+                LEMONdB(input_path)
+
+        finally:
+            for path in (input_path, output_path):
+                if os.path.exists(path):
+                    os.unlink(path)
+
     def test_pfilters_and_star_pfilters(self):
 
         db = LEMONdB(':memory:')
@@ -1882,6 +2587,74 @@ class LEMONdBTest(unittest.TestCase):
         with self.assertRaises(sqlite3.IntegrityError):
             db.get_light_curve(nstar_id, pfilter)
 
+    def test_get_curve_stats(self):
+
+        db = LEMONdB(':memory:')
+        nstars = random.randint(MIN_NSTARS, MAX_NSTARS)
+        for star_info in LEMONdBTest.random_stars_info(nstars):
+            db.add_star(*star_info)
+
+        images = collections.defaultdict(list)
+        size = random.randint(self.MIN_NIMAGES, self.MAX_NIMAGES)
+        for img in ImageTest.nrandom(size):
+            images[img.pfilter].append(img)
+            db.add_image(img)
+
+        # Leave one of the stars without light curves
+        star_ids = db.star_ids
+        no_curve_id = star_ids.pop()
+
+        light_curves = collections.defaultdict(dict)
+        for pfilter in images.iterkeys():
+            for star_id in star_ids:
+                cstars = [no_curve_id]
+                curve = LightCurveTest.random(pfilter = pfilter, cstars = cstars)
+                curve = LightCurveTest.populate(curve, images[pfilter])
+                light_curves[pfilter][star_id] = curve
+                db.add_light_curve(star_id, curve)
+
+        def assertStatsEqual(curve, stats):
+            self.assertTrue(isinstance(stats, CurveStats))
+            unix_times, magnitudes, snrs = zip(*curve)
+            self.assertEqual(stats.npoints, len(curve))
+            self.assertAlmostEqual(stats.mean, numpy.mean(magnitudes))
+            self.assertAlmostEqual(stats.stdev, curve.stdev)
+            self.assertAlmostEqual(stats.amplitude, curve.amplitude())
+            self.assertEqual(stats.min_time, min(unix_times))
+            self.assertEqual(stats.max_time, max(unix_times))
+            self.assertAlmostEqual(stats.median_snr, numpy.median(snrs))
+
+        for pfilter, curves in light_curves.iteritems():
+            curves_stats = db.get_curves_stats(pfilter)
+            self.assertEqual(sorted(curves_stats.keys()), star_ids)
+            for star_id, curve in curves.iteritems():
+                stats = db.get_curve_stats(star_id, pfilter)
+                self.assertEqual(stats, curves_stats[star_id])
+                assertStatsEqual(curve, stats)
+
+            # None if the star has no light curve in this filter...
+            self.assertEqual(None, db.get_curve_stats(no_curve_id, pfilter))
+
+        # ... while KeyError is raised if the star is not in the database
+        nstar_id = max(db.star_ids) + 1
+        with self.assertRaises(KeyError):
+            db.get_curve_stats(nstar_id, pfilter)
+
+        # The statistics of the curves stored by an older version of LEMON,
+        # which did not have the CURVE_STATS table, are computed when needed,
+        # but without writing them to the database
+        db._execute("DELETE FROM curve_stats")
+        pfilter = random.choice(light_curves.keys())
+        curves_stats = db.get_curves_stats(pfilter)
+        self.assertEqual(sorted(curves_stats.keys()), star_ids)
+        for star_id, curve in light_curves[pfilter].iteritems():
+            assertStatsEqual(curve, curves_stats[star_id])
+
+        star_id = random.choice(star_ids)
+        curve = light_curves[pfilter][star_id]
+        assertStatsEqual(curve, db.get_curve_stats(star_id, pfilter))
+        self.assertEqual(0, db._table_count('curve_stats'))
+
     def test_get_instrumental_magnitudes(self):
 
         db = LEMONdB(':memory:')
@@ -2436,6 +3209,45 @@ class LEMONdBTest(unittest.TestCase):
             db = LEMONdB(':memory:')
             db.foo
 
+    def test_stars_within(self):
+
+        db = LEMONdB(':memory:')
+        self.assertEqual(db.stars_within(24.19933, 41.40547, 180), [])
+
+        nstars = random.randint(MIN_NSTARS, MAX_NSTARS)
+        stars = {} # map each ID to the celestial coordinates
+        for star_info in self.random_stars_info(nstars):
+            stars[star_info[0]] = Coordinates(*star_info[3:5])
+            db.add_star(*star_info)
+
+        with self.assertRaises(ValueError):
+            db.stars_within(24.19933, 41.40547, -1)
+
+        for _ in xrange(NITERS // 10):
+            center = Coordinates(*get_random_coords()[:2])
+            radius = random.uniform(0, 90)
+
+            # The stars within the radius, found by brute force
+            distances = [(star_id, center.distance(coords))
+                         for star_id, coords in stars.iteritems()]
+            distances.sort(key = operator.itemgetter(1))
+            expected = [x for x in distances if x[1] <= radius]
+
+            found = db.stars_within(center.ra, center.dec, radius)
+            self.assertEqual([x[0] for x in found], [x[0] for x in expected])
+            for (_, distance), (_, expected_distance) in zip(found, expected):
+                self.assertAlmostEqual(distance, expected_distance)
+
+            # The closest star is found by LEMONdB.star_closest_to_world_coords
+            closest = distances[0]
+            star_id, distance = db.star_closest_to_world_coords(*center[:2])
+            self.assertEqual(star_id, closest[0])
+            self.assertAlmostEqual(distance, closest[1])
+
+        # The whole sky contains all the stars
+        found = db.stars_within(0, 0, 180)
+        self.assertEqual(sorted(x[0] for x in found), sorted(stars.keys()))
+
     def test_star_closest_to_world_coords(self):
 
         db = LEMONdB(':memory:')
@@ -24,12 +24,16 @@ import copy
 import functools
 import math
 import numpy
+import optparse
 import random
+import sys
 
 from test import unittest
 import passband
 import test_database
 from database import DBStar
+import diffphot
+from database import PhotometryMatrix
 from diffphot import Weights, StarSet
 
 NITERS = 50  # How many times some test cases are run with random data
@@ -595,12 +599,7 @@ class StarSetTest(unittest.TestCase):
         method, an unconditional test failure is signaled.
 
         The value of the '_exclude_index' keyword argument is passed down to
-        StarSet.light_curve. The value of 'no_snr', the other keyword argument
-        of the method, needs not be set: each light curve is in actuality
-        computed twice, once with signal-to-noise ratios and once without
-        them. In this manner, we always verify that the differential magnitudes
-        are the same regardless of the value of 'no_snr', and that the SNRs are
-        set to None when it evaluates to True.
+        StarSet.light_curve.
 
         It is probably sort of obvious that there must be as many weights as
         stars in the StarSet and that 'star_mags', 'star_snrs', 'expected_mags'
@@ -638,21 +637,12 @@ class StarSetTest(unittest.TestCase):
         id_ = random.choice(list(candidate_ids))
         star = DBStar.make_star(id_, cmp_stars.pfilter, rows)
 
-        kwargs = dict(_exclude_index = _exclude_index, no_snr = False)
+        kwargs = dict(_exclude_index = _exclude_index)
         curve = cmp_stars.light_curve(weights, star, **kwargs)
         returned_mags, returned_snrs = zip(*[x[1:] for x in curve])
         assertSequencesAlmostEqual(self, returned_mags, expected_mags)
         assertSequencesAlmostEqual(self, returned_snrs, expected_snrs)
 
-        # The differental magnitudes must be the same when the 'no_snr' keyword
-        # argument is set to True. It is only the signal-to-noise ratios, which
-        # are set to None, that should be affected.
-        kwargs['no_snr'] = True
-        curve = cmp_stars.light_curve(weights, star, **kwargs)
-        returned_mags, returned_snrs = zip(*[x[1:] for x in curve])
-        assertSequencesAlmostEqual(self, returned_mags, expected_mags)
-        self.assertEqual(set(returned_snrs), set([None]))
-
     def test_light_curve_errors(self):
 
         nstars = random.randint(*self.NSTARS_RANGE)
@@ -1032,6 +1022,61 @@ class StarSetTest(unittest.TestCase):
         self._assert_broeg_weights(*args, pct = 0.315, max_iters = None)
         self._assert_broeg_weights(*args, pct = None, max_iters = 2)
 
+    @staticmethod
+    def _loop_broeg_weights(set_, pct = 0.01, max_iters = None, minimum = None):
+        """ Compute the Broeg weights one light curve at a time.
+
+        This is the reference implementation of StarSet.broeg_weights, which
+        generates the light curve of each star in the set, with respect to all
+        the others, with StarSet.light_curve and the '_exclude_index' keyword
+        argument. It is slow, but it uses nothing but the public semantics of
+        the algorithm, so the output of the vectorized version must match it.
+
+        """
+
+        weights = [set_.flux_proportional_weights()]
+        curves_stdevs = numpy.empty(len(set_), dtype = set_.dtype)
+        for iteration in xrange(max_iters or sys.getrecursionlimit()):
+            for star_index in xrange(len(set_)):
+                star_curve = set_.light_curve(weights[-1], set_[star_index],
+                                              _exclude_index = star_index)
+                curves_stdevs[star_index] = star_curve.stdev
+            if not all(curves_stdevs):
+                break
+            weights.append(Weights.inversely_proportional(curves_stdevs))
+            if weights[-2].absolute_percent_change(weights[-1], minimum = minimum) < pct:
+                break
+        return weights[-1]
+
+    def test_broeg_weights_loop_equivalence(self):
+
+        # The weights computed, at once, from the matrix of magnitudes must be
+        # the same (and also store the same standard deviations in the 'values'
+        # attribute) as if the light curves were generated one by one.
+        for _ in xrange(NITERS // 5):
+            set_ = self.random_set(size = random.randint(3, 15))[0]
+            for kwargs in (dict(), dict(pct = 0.1, max_iters = 3),
+                           dict(pct = 0.001, minimum = 0.001)):
+                bweights = set_.broeg_weights(**kwargs)
+                eweights = self._loop_broeg_weights(set_, **kwargs)
+                assertSequencesAlmostEqual(self, bweights, eweights)
+                assertSequencesAlmostEqual(self, bweights.values,
+                                           eweights.values)
+
+    def test_broeg_weights_initial(self):
+
+        # Starting from the weights to which the algorithm has converged, it
+        # must stop after a single iteration, returning (almost) the same
+        # weights. The number of initial weights must match that of stars.
+        for _ in xrange(NITERS // 5):
+            set_ = self.random_set(size = random.randint(3, 15))[0]
+            bweights = set_.broeg_weights(pct = 0.0001)
+            iweights = set_.broeg_weights(pct = 0.01, max_iters = 1,
+                                          initial = bweights)
+            self.assertTrue(numpy.allclose(bweights, iweights, rtol = 0.01))
+            with self.assertRaises(ValueError):
+                set_.broeg_weights(initial = bweights[:-1])
+
     def test_worst_fraction_out_of_range(self):
 
         # # Valid fractions are in the range (0, 1]
@@ -1398,3 +1443,158 @@ class StarSetTest(unittest.TestCase):
         self.assertRaises(ValueError, set_.best, len(set_) + 1)
         self.assertRaises(ValueError, set_.best, len(set_) + 5)
 
+    def test_approximate_ensemble(self):
+
+        # All the stars are observed in all the images, so they share the same
+        # coverage mask and the ensemble must be computed only once. For each
+        # star, the returned comparison stars must be 'ncstars' of the others.
+
+        nstars = random.randint(*self.NSTARS_RANGE)
+        nimages = random.randint(*self.NRECORDS_RANGE)
+        shape = (nstars, nimages)
+        star_ids = numpy.array(random.sample(xrange(*self.IDS_RANGE), nstars))
+        unix_times = numpy.array(sorted(test_database.runix_times(nimages)))
+        magnitudes = numpy.random.uniform(*(self.MAG_RANGE + (shape,)))
+        snrs = numpy.random.uniform(*(self.SNR_RANGE + (shape,)))
+        mask = numpy.ones(shape, dtype = bool)
+        matrix = PhotometryMatrix(passband.Passband.random(), star_ids,
+                                  unix_times, magnitudes, snrs, mask)
+
+        options = optparse.Values(dict(worst_fraction = 0.1, pct = 0.01,
+                                       wminimum = 0.0001, max_iters = None))
+
+        backup = (diffphot.matrix, diffphot.complete_indexes,
+                  diffphot.candidates, diffphot.ensembles)
+        try:
+            diffphot.matrix = matrix
+            diffphot.complete_indexes = matrix.complete_indexes()
+            diffphot.candidates = None
+            diffphot.ensembles = {}
+
+            for ncstars in (2, random.randint(2, nstars - 2), nstars - 1):
+                diffphot.ensembles.clear()
+                for index in xrange(nstars):
+                    star = matrix.star(index)
+                    cstars = diffphot.approximate_ensemble(index, star,
+                                                           ncstars, options)
+                    self.assertEqual(len(cstars), ncstars)
+                    self.assertFalse(star.id in cstars.star_ids)
+                    self.assertTrue(set(cstars.star_ids) <= set(star_ids))
+                    self.assertEqual(len(diffphot.ensembles), 1)
+
+                    # There is no choice if all the others have to be used
+                    if ncstars == nstars - 1:
+                        others = set(star_ids) - set([star.id])
+                        self.assertEqual(set(cstars.star_ids), others)
+
+                    # The cached ensemble must not have been modified
+                    ensemble = diffphot.ensembles.values()[0]
+                    self.assertEqual(len(ensemble), ncstars + 1)
+        finally:
+            (diffphot.matrix, diffphot.complete_indexes,
+             diffphot.candidates, diffphot.ensembles) = backup
+
+    def test_complete_stars(self):
+
+        # The StarSet returned for each star, built from the candidates shared
+        # with the other stars with the same coverage mask, must be identical
+        # to that of the stars complete for it, trimmed to its images. Stars
+        # are observed in all the images but one (or none), so that there are
+        # several masks, and the tasks are not sorted by mask, so that the
+        # candidates of each mask are computed more than once.
+
+        nstars = random.randint(*self.NSTARS_RANGE)
+        nimages = random.randint(*self.NRECORDS_RANGE)
+        shape = (nstars, nimages)
+        star_ids = numpy.array(random.sample(xrange(*self.IDS_RANGE), nstars))
+        unix_times = numpy.array(sorted(test_database.runix_times(nimages)))
+        magnitudes = numpy.random.uniform(*(self.MAG_RANGE + (shape,)))
+        snrs = numpy.random.uniform(*(self.SNR_RANGE + (shape,)))
+        mask = numpy.ones(shape, dtype = bool)
+        for index in xrange(nstars):
+            missing = random.randint(-1, min(nimages, 3) - 1)
+            if missing >= 0:
+                mask[index, missing] = False
+        matrix = PhotometryMatrix(passband.Passband.random(), star_ids,
+                                  unix_times, magnitudes, snrs, mask)
+
+        backup = (diffphot.matrix, diffphot.complete_indexes,
+                  diffphot.candidates)
+        try:
+            diffphot.matrix = matrix
+            diffphot.complete_indexes = matrix.complete_indexes()
+            diffphot.candidates = None
+
+            for index in xrange(nstars):
+                star = matrix.star(index)
+                complete = diffphot.complete_stars(index, star)
+                expected = StarSet([matrix.star(x)._trim_to(star)
+                                    for x in diffphot.complete_indexes[index]])
+                self.assertEqual(complete.star_ids, expected.star_ids)
+                self.assertTrue(numpy.array_equal(complete._phot_info,
+                                                  expected._phot_info))
+                self.assertTrue(numpy.array_equal(complete._unix_times,
+                                                  expected._unix_times))
+                self.assertFalse(star.id in complete.star_ids)
+
+                if len(complete) >= 3:
+                    best = complete.best(2)
+                    self.assertEqual(best.star_ids, expected.best(2).star_ids)
+        finally:
+            (diffphot.matrix, diffphot.complete_indexes,
+             diffphot.candidates) = backup
+
+    def test_extended_light_curve(self):
+
+        # Compute the light curve of a star using only the first images, and
+        # then extend it with the rest: the result must be the same as if the
+        # light curve had been computed with the same comparison stars and
+        # weights in all the images.
+
+        nstars = random.randint(*self.NSTARS_RANGE)
+        nimages = random.randint(*self.NRECORDS_RANGE)
+        shape = (nstars, nimages)
+        star_ids = numpy.array(random.sample(xrange(*self.IDS_RANGE), nstars))
+        unix_times = numpy.array(sorted(test_database.runix_times(nimages)))
+        magnitudes = numpy.random.uniform(*(self.MAG_RANGE + (shape,)))
+        snrs = numpy.random.uniform(*(self.SNR_RANGE + (shape,)))
+        mask = numpy.ones(shape, dtype = bool)
+        matrix = PhotometryMatrix(passband.Passband.random(), star_ids,
+                                  unix_times, magnitudes, snrs, mask)
+
+        index = random.randrange(nstars)
+        star = matrix.star(index)
+        cstars = StarSet([matrix.star(x) for x in xrange(nstars) if x != index])
+        weights = cstars.broeg_weights()
+        expected = cstars.light_curve(weights, star)
+
+        # The light curve in the first 'nprevious' images only
+        nprevious = random.randint(1, nimages - 1)
+        trim = lambda x: DBStar(x.id, x.pfilter, x._phot_info[:, :nprevious])
+        previous_star = trim(star)
+        previous_cstars = StarSet([trim(x) for x in cstars])
+        curve = previous_cstars.light_curve(weights, previous_star)
+
+        backup = diffphot.matrix
+        try:
+            diffphot.matrix = matrix
+
+            # Nothing to do if there are no new images
+            no_new = diffphot.extended_light_curve(index, previous_star, curve)
+            self.assertTrue(no_new is curve)
+            self.assertEqual(len(curve), nprevious)
+
+            extended = diffphot.extended_light_curve(index, star, curve)
+            self.assertTrue(extended is curve)
+            self.assertEqual(len(extended), nimages)
+            self.assertEqual(list(extended.cstars), list(expected.cstars))
+            self.assertTrue(numpy.all(extended.unix_times == expected.unix_times))
+            self.assertTrue(numpy.allclose(extended.magnitudes, expected.magnitudes))
+            self.assertTrue(numpy.allclose(extended.snrs, expected.snrs))
+
+            # A star with no previous light curve, or not observed at some of
+            # its points, must have its light curve computed from scratch
+            self.assertEqual(diffphot.extended_light_curve(index, star, None), None)
+            self.assertEqual(diffphot.extended_light_curve(index, previous_star, extended), None)
+        finally:
+            diffphot.matrix = backup
@@ -21,6 +21,8 @@
 from __future__ import division
 
 import StringIO
+import multiprocessing
+import numpy
 import operator
 import os
 import Queue
@@ -278,6 +280,30 @@ class MethodsFunctionsTests(unittest.TestCase):
         self.assertEqual(None, methods.func_catchall(foo_except))
         self.assertEqual(None, methods.func_catchall(operator.div, 1, 0))
 
+    def test_shared_array(self):
+
+        for dtype in (numpy.bool_, numpy.int64, numpy.longdouble):
+            array = (numpy.random.random((17, 23)) * 100).astype(dtype)
+            shared = methods.shared_array(array)
+            self.assertEqual(shared.dtype, array.dtype)
+            self.assertEqual(shared.shape, array.shape)
+            self.assertTrue(numpy.all(shared == array))
+
+        # Changes made by a child process are seen by the parent
+        def double(array):
+            array *= 2
+
+        array = numpy.arange(10, dtype = numpy.float64)
+        shared = methods.shared_array(array)
+        child = multiprocessing.Process(target = double, args = (shared,))
+        child.start()
+        child.join()
+        self.assertTrue(numpy.all(shared == array * 2))
+
+        # Empty arrays are also supported
+        shared = methods.shared_array(numpy.empty((5, 0)))
+        self.assertEqual(shared.shape, (5, 0))
+
 
 class StreamToWarningFilterTest(unittest.TestCase):
 
@@ -0,0 +1,141 @@
+#! /usr/bin/env python
+
+# Copyright (c) 2012 Victor Terron. All rights reserved.
+# Institute of Astrophysics of Andalusia, IAA-CSIC
+#
+# This file is part of LEMON.
+#
+# LEMON is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import division
+
+import os
+import shutil
+import sys
+import tempfile
+import StringIO
+
+# LEMON modules
+from test import unittest
+import database
+import passband
+import photometry
+import test.test_aperture
+
+class PhotometryTest(unittest.TestCase):
+
+    NSTARS = 8
+    NIMAGES = 4
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def mkimages(self, stars):
+        """ Return the paths to NIMAGES synthetic images of the 'stars' """
+
+        paths = []
+        for index in xrange(self.NIMAGES):
+            keywords = {'FILTER' : 'V',
+                        'DATE-OBS' : '2015-01-01T00:%02d:00' % index,
+                        'AIRMASS' : 1.1,
+                        'GAIN' : 2.0,
+                        'OBJECT' : 'synthetic'}
+            img = test.test_aperture.ApertureTest.mkfits(stars, **keywords)
+            path = os.path.join(self.tmp_dir, 'img%02d.fits' % index)
+            shutil.move(img.path, path)
+            paths.append(path)
+        return paths
+
+    @staticmethod
+    def run_main(args):
+        """ Run photometry.main() with 'args', discarding its output """
+
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            return photometry.main(args)
+        finally:
+            sys.stdout = stdout
+
+    def test_append(self):
+
+        # The photometry of new images is added to an existing LEMONdB: the
+        # stars (and their IDs) are those already in it, and the images that
+        # are already stored are skipped, so all of them can be given again.
+
+        stars = test.test_aperture.ApertureTest.random_stars(self.NSTARS)
+        coordinates = test.test_aperture.ApertureTest.to_coordinates(stars)
+        paths = self.mkimages(stars)
+
+        db_path = os.path.join(self.tmp_dir, 'phot.LEMONdB')
+        db = database.LEMONdB(db_path)
+        for star_id, ((x, y, _), coords) in enumerate(zip(stars, coordinates)):
+            args = (star_id, x, y, coords.ra, coords.dec, 2000, 0, 0, 15.0)
+            db.add_star(*args)
+        db.date, db.id = 1420070400.0, 'a' * 32
+        db.commit()
+        del db
+
+        args = ['--append', '--engine', 'numpy', '--cores', '1',
+                '--aperture-pix', '8', '--annulus-pix', '12',
+                '--dannulus-pix', '6']
+
+        nold = self.NIMAGES // 2
+        self.assertEqual(0, self.run_main(args + paths[:nold] + [db_path]))
+
+        johnson_V = passband.Passband('V')
+        db = database.LEMONdB(db_path)
+        self.assertEqual(db.star_ids, range(self.NSTARS))
+        self.assertEqual(db._table_count('images'), nold)
+        old_magnitudes = {}
+        for star_id in db.star_ids:
+            magnitudes = db.get_instrumental_magnitudes(star_id, johnson_V)
+            old_magnitudes[star_id] = magnitudes
+        del db
+
+        self.assertEqual(0, self.run_main(args + paths + [db_path]))
+
+        db = database.LEMONdB(db_path)
+        self.assertEqual(db.star_ids, range(self.NSTARS))
+        for star_id, (x, y, _) in zip(db.star_ids, stars):
+            self.assertEqual(db.get_star(star_id)[:2], (x, y))
+
+        # The measurements in the images already in the LEMONdB are unchanged
+        self.assertEqual(db._table_count('images'), self.NIMAGES)
+        for star_id in db.star_ids:
+            magnitudes = db.get_instrumental_magnitudes(star_id, johnson_V)
+            self.assertEqual(len(magnitudes), self.NIMAGES)
+            for unix_time, record in old_magnitudes[star_id].iteritems():
+                self.assertEqual(magnitudes[unix_time], record)
+        del db
+
+        # Nothing to do if all the images are already in the LEMONdB
+        self.assertEqual(0, self.run_main(args + paths + [db_path]))
+        db = database.LEMONdB(db_path)
+        self.assertEqual(db._table_count('images'), self.NIMAGES)
+
+        # The date and ID of the LEMONdB are kept, the append recorded apart
+        self.assertEqual(db.date, 1420070400.0)
+        self.assertEqual(db.id, 'a' * 32)
+        self.assertTrue(db.append_date > db.date)
+        self.assertTrue(db.append_author)
+        self.assertTrue(db.append_hostname)
+        del db
+
+        # --append does not work with a LEMONdB that does not exist
+        os.unlink(db_path)
+        self.assertEqual(1, self.run_main(args + paths + [db_path]))
@@ -298,3 +298,69 @@ class QPhotTest(unittest.TestCase):
             f = self.assertAlmostEqual
             f(ra,  expected_coordinates.ra,  delta = 1e-3) # delta = 0.24 arcsec
             f(dec, expected_coordinates.dec, delta = 1e-3) # delta = 3.6 arcsec
+
+    def test_qphot_run_apertures_txdump(self):
+
+        # PyRAF is replaced by two stubs: qphot, which records the apertures
+        # it is run with, and txdump, which writes these two lines, in the
+        # layout that we request for three apertures: xcenter and ycenter,
+        # followed by the magnitude, sum and flux of each aperture, and then
+        # the standard deviation of the sky. The second line has an invalid
+        # xcenter (as may be output for coordinates far off the image), and
+        # INDEF values for the magnitude of the last aperture and the stdev.
+
+        txdump_output = (
+            "755.241  75.308  17.821  17.615  17.508  6015410.  "
+            "7220142.  7995318.  3124231.  3787512.  4138950.  579.0784\n"
+            "-299866.375-58  406.437  18.12  18.01  INDEF  4804557.  "
+            "5112308.  5401245.  2372792.  2625118.  -118432.  INDEF\n")
+
+        R = qphot.QPhotResult
+        expected = [
+            #   x        y        mag     sum      flux     stdev
+            [R(755.241, 75.308,  17.821, 6015410, 3124231, 579.0784),
+             R(-1,      406.437, 18.12,  4804557, 2372792, None)],
+            [R(755.241, 75.308,  17.615, 7220142, 3787512, 579.0784),
+             R(-1,      406.437, 18.01,  5112308, 2625118, None)],
+            [R(755.241, 75.308,  17.508, 7995318, 4138950, 579.0784),
+             R(-1,      406.437, None,   5401245, -118432, None)]]
+
+        calls = []
+
+        class apphot(object):
+            @staticmethod
+            def qphot(path, **kwargs):
+                calls.append(kwargs['aperture'])
+                with open(kwargs['output'], 'wt') as fd:
+                    fd.write("#N ID XCENTER YCENTER ...\n")
+
+        class pyraf(object):
+            class iraf(object):
+                @staticmethod
+                def txdump(path, fields, Stdout, expr):
+                    expected_fields = 'xcenter,ycenter,mag,sum,flux,stdev'
+                    self.assertEqual(fields, expected_fields)
+                    with open(Stdout, 'wt') as fd:
+                        fd.write(txdump_output)
+
+        fd, coords_path = tempfile.mkstemp(suffix = '.coords')
+        os.write(fd, "100.1543316 9.7909363\n100.2933265 9.8838196\n")
+        os.close(fd)
+
+        # 'apphot' is not defined by the module if PyRAF is not installed
+        backup = qphot.pyraf, getattr(qphot, 'apphot', None)
+        qphot.pyraf, qphot.apphot = pyraf, apphot
+        try:
+            with test.test_fitsimage.FITSImageTest.random() as img:
+                img_qphot = qphot.QPhot(img.path, coords_path)
+                apertures = [4.0, 6, 8.5]
+                qphots = img_qphot.run_apertures(13, 8, apertures, 'EXPOSURE')
+                self.assertEqual(calls, ['4.0,6,8.5'])
+                self.assertEqual(len(qphots), len(apertures))
+                self.assertTrue(qphots[0] is img_qphot)
+                for result, records in zip(qphots, expected):
+                    self.assertEqual(result.path, img.path)
+                    self.assertEqual(list(result), records)
+        finally:
+            qphot.pyraf, qphot.apphot = backup
+            os.unlink(coords_path)
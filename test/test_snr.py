@@ -381,3 +381,33 @@ class SNRTest(unittest.TestCase):
             back_to_error = snr_to_error(csnr)[1]
             self.assertAlmostEqual(back_to_error, cerror)
 
+    def test_snr_arrays(self):
+
+        # The conversion and combination functions also work with NumPy arrays,
+        # element-wise, and the mean along the first axis of a two-dimensional
+        # array of SNRs (as many rows as stars, as many columns as images) must
+        # give the same results as calling mean_snr once for each column.
+
+        for _ in xrange(NITERS // 10):
+            nstars = random.randint(MIN_NERR, MAX_NERR)
+            nimages = random.randint(MIN_NERR, MAX_NERR)
+            snrs = numpy.random.uniform(MIN_SNR, MAX_SNR, (nstars, nimages))
+            weights = [self._random_weight() for i in xrange(nstars)]
+            star_snrs = numpy.random.uniform(MIN_SNR, MAX_SNR, nimages)
+
+            errors = snr_to_error(star_snrs)[1]
+            back_to_snr = error_to_snr(errors)
+            for index in xrange(nimages):
+                self.assertAlmostEqual(back_to_snr[index], star_snrs[index])
+
+            msnrs = mean_snr(snrs, weights = weights)
+            dsnrs = difference_snr(star_snrs, msnrs)
+            self.assertEqual(msnrs.shape, (nimages,))
+            self.assertEqual(dsnrs.shape, (nimages,))
+
+            for index in xrange(nimages):
+                column = list(snrs[:, index])
+                csnr = mean_snr(column, weights = weights)
+                self.assertAlmostEqual(msnrs[index], csnr)
+                dsnr = difference_snr(star_snrs[index], csnr)
+                self.assertAlmostEqual(dsnrs[index], dsnr)